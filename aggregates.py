@@ -0,0 +1,259 @@
+"""
+aggregates.py
+
+Incrementally maintained statistics for /statistics and query_database.py.
+
+Triggers on predictions, images, image_variants and users keep running
+totals in the prediction_stats table, grouped by dimension ('total',
+'emotion', 'source', 'day', 'store', 'users'). Reading statistics is then a handful of primary-key
+lookups instead of full table scans. rebuild_statistics() recomputes
+everything from the base tables if the totals ever drift.
+"""
+import sqlite3
+
+from db import transaction
+
+# Per-prediction contribution: count, confidence and the stored image size
+_PREDICTION_DIMENSIONS = [
+    ("'total'", "''"),
+    ("'emotion'", "{row}.predicted_emotion"),
+    ("'source'", "{row}.source"),
+    ("'day'", "substr({row}.timestamp, 1, 10)"),
+]
+
+_IMAGE_SIZE = "COALESCE((SELECT size FROM images WHERE hash = {row}.image_hash), 0)"
+
+
+def _prediction_trigger_body(row, sign):
+    statements = []
+    for dimension, key in _PREDICTION_DIMENSIONS:
+        key = key.format(row=row)
+        size = _IMAGE_SIZE.format(row=row)
+        statements.append(f"""
+            INSERT INTO prediction_stats (dimension, key, count, confidence_sum, image_bytes)
+            VALUES ({dimension}, {key}, {sign}1, {sign}{row}.confidence, {sign}{size})
+            ON CONFLICT (dimension, key) DO UPDATE SET
+                count = count + excluded.count,
+                confidence_sum = confidence_sum + excluded.confidence_sum,
+                image_bytes = image_bytes + excluded.image_bytes;""")
+    return ''.join(statements)
+
+
+def _image_trigger_body(row, sign):
+    """
+    Add or remove an image's size for predictions that already reference it.
+
+    Predictions count their image's bytes when inserted; when the retention
+    job removes an image (or one comes back) their totals follow here.
+    """
+    statements = []
+    for dimension, key in _PREDICTION_DIMENSIONS:
+        key = key.format(row='p')
+        statements.append(f"""
+            INSERT INTO prediction_stats (dimension, key, count, confidence_sum, image_bytes)
+            SELECT {dimension}, {key}, 0, 0, {sign}COUNT(*) * {row}.size
+            FROM predictions p
+            WHERE p.image_hash = {row}.hash
+            GROUP BY {key}
+            ON CONFLICT (dimension, key) DO UPDATE SET
+                image_bytes = image_bytes + excluded.image_bytes;""")
+    return ''.join(statements)
+
+
+def _counter_trigger_body(dimension, key, sign, size_expr='0'):
+    return f"""
+            INSERT INTO prediction_stats (dimension, key, count, confidence_sum, image_bytes)
+            VALUES ('{dimension}', '{key}', {sign}1, 0, {sign}{size_expr})
+            ON CONFLICT (dimension, key) DO UPDATE SET
+                count = count + excluded.count,
+                image_bytes = image_bytes + excluded.image_bytes;"""
+
+
+def create_statistics_tables(conn: sqlite3.Connection) -> bool:
+    """
+    Create the summary table and its triggers.
+
+    Returns True if the table was just created or its triggers were out of
+    date (and so it needs a rebuild).
+    """
+    with transaction(conn):
+        exists = conn.execute("""
+            SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'prediction_stats'
+        """).fetchone() is not None
+
+        # Earlier image triggers only updated the 'store' totals, so
+        # predictions kept counting images the retention job had removed
+        outdated = False
+        row = conn.execute("""
+            SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_images_stats_delete'
+        """).fetchone()
+        if row is not None and 'predictions' not in row[0]:
+            conn.execute("DROP TRIGGER trg_images_stats_insert")
+            conn.execute("DROP TRIGGER trg_images_stats_delete")
+            outdated = True
+        # Thumbnail bytes were added later and need seeding from the table
+        if exists and conn.execute("""
+            SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_image_variants_stats_insert'
+        """).fetchone() is None:
+            outdated = True
+
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS prediction_stats (
+                dimension TEXT NOT NULL,
+                key TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                confidence_sum REAL NOT NULL DEFAULT 0,
+                image_bytes INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (dimension, key)
+            ) WITHOUT ROWID
+        """)
+
+        # Top users are read straight off this index
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_users_total_predictions
+            ON users(total_predictions DESC)
+        """)
+
+        # The image triggers find an image's predictions through this index
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_predictions_image
+            ON predictions(image_hash)
+        """)
+
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_predictions_stats_insert
+            AFTER INSERT ON predictions
+            BEGIN {_prediction_trigger_body('NEW', '+')}
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_predictions_stats_delete
+            AFTER DELETE ON predictions
+            BEGIN {_prediction_trigger_body('OLD', '-')}
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_predictions_stats_update
+            AFTER UPDATE OF predicted_emotion, source, timestamp, confidence, image_hash ON predictions
+            BEGIN {_prediction_trigger_body('OLD', '-')}{_prediction_trigger_body('NEW', '+')}
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_images_stats_insert
+            AFTER INSERT ON images
+            BEGIN {_counter_trigger_body('store', 'images', '+', 'NEW.size')}{_image_trigger_body('NEW', '+')}
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_images_stats_delete
+            AFTER DELETE ON images
+            BEGIN {_counter_trigger_body('store', 'images', '-', 'OLD.size')}{_image_trigger_body('OLD', '-')}
+            END
+        """)
+        # Thumbnail eviction reads its byte total here instead of summing the table
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_image_variants_stats_insert
+            AFTER INSERT ON image_variants
+            BEGIN {_counter_trigger_body('store', 'variants', '+', 'NEW.size')}
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_image_variants_stats_delete
+            AFTER DELETE ON image_variants
+            BEGIN {_counter_trigger_body('store', 'variants', '-', 'OLD.size')}
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_users_stats_insert
+            AFTER INSERT ON users
+            BEGIN {_counter_trigger_body('users', 'total', '+')}
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_users_stats_delete
+            AFTER DELETE ON users
+            BEGIN {_counter_trigger_body('users', 'total', '-')}
+            END
+        """)
+    return not exists or outdated
+
+
+def rebuild_statistics(conn: sqlite3.Connection):
+    """Recompute every aggregate from the base tables in one transaction."""
+    with transaction(conn):
+        conn.execute("DELETE FROM prediction_stats")
+        for dimension, key in _PREDICTION_DIMENSIONS:
+            key = key.format(row='p')
+            conn.execute(f"""
+                INSERT INTO prediction_stats (dimension, key, count, confidence_sum, image_bytes)
+                SELECT {dimension}, {key}, COUNT(*), COALESCE(SUM(p.confidence), 0),
+                       COALESCE(SUM(i.size), 0)
+                FROM predictions p LEFT JOIN images i ON i.hash = p.image_hash
+                GROUP BY {key}
+                HAVING COUNT(*) > 0
+            """)
+        conn.execute("""
+            INSERT INTO prediction_stats (dimension, key, count, confidence_sum, image_bytes)
+            SELECT 'store', 'images', COUNT(*), 0, COALESCE(SUM(size), 0) FROM images
+        """)
+        conn.execute("""
+            INSERT INTO prediction_stats (dimension, key, count, confidence_sum, image_bytes)
+            SELECT 'store', 'variants', COUNT(*), 0, COALESCE(SUM(size), 0) FROM image_variants
+        """)
+        conn.execute("""
+            INSERT INTO prediction_stats (dimension, key, count, confidence_sum, image_bytes)
+            SELECT 'users', 'total', COUNT(*), 0, 0 FROM users
+        """)
+
+
+def get_summary(conn: sqlite3.Connection, top_users=10, days=30) -> dict:
+    """Read the aggregates; cost doesn't depend on the number of predictions."""
+    # IN (not dimension != 'day') lets the primary key skip the daily rows
+    rows = conn.execute("""
+        SELECT dimension, key, count, confidence_sum, image_bytes
+        FROM prediction_stats
+        WHERE dimension IN ('total', 'emotion', 'source', 'store', 'users')
+    """).fetchall()
+
+    summary = {
+        'total_predictions': 0,
+        'average_confidence': None,
+        'image_bytes': 0,
+        'stored_images': 0,
+        'stored_image_bytes': 0,
+        'total_users': 0,
+        'emotions_count': {},
+        'source_count': {},
+    }
+    for dimension, key, count, confidence_sum, image_bytes in rows:
+        if dimension == 'total':
+            summary['total_predictions'] = count
+            summary['average_confidence'] = confidence_sum / count if count else None
+            summary['image_bytes'] = image_bytes
+        elif dimension == 'emotion' and count:
+            summary['emotions_count'][key] = count
+        elif dimension == 'source' and count:
+            summary['source_count'][key] = count
+        elif dimension == 'store' and key == 'images':
+            summary['stored_images'] = count
+            summary['stored_image_bytes'] = image_bytes
+        elif dimension == 'users':
+            summary['total_users'] = count
+
+    summary['daily_counts'] = dict(conn.execute("""
+        SELECT key, count FROM prediction_stats
+        WHERE dimension = 'day' AND count > 0
+        ORDER BY key DESC
+        LIMIT ?
+    """, (days,)).fetchall())
+
+    summary['top_users'] = [
+        {'name': name, 'predictions': total}
+        for name, total in conn.execute("""
+            SELECT name, total_predictions
+            FROM users
+            ORDER BY total_predictions DESC
+            LIMIT ?
+        """, (top_users,))
+    ]
+    return summary
@@ -4,92 +4,228 @@ app.py - Flask Backend for Emotion Detection Web App
 Complete backend with database integration for storing predictions and images.
 Configured for sklearn MLPClassifier model with 48x48 grayscale images.
 """
-import json
+import atexit
 import os
-import sqlite3
-from datetime import datetime
-from io import BytesIO
+import time
 import base64
+import json
+import zipfile
 
-import numpy as np
 import cv2
-from flask import Flask, render_template, request, jsonify, send_file
+import numpy as np
+from flask import Flask, Response, g, render_template, request, jsonify
+from werkzeug.datastructures import ContentRange
 from PIL import Image
-import joblib
+from inference import InferenceEngine, export_weights, file_sha256, load_weights, read_weights_meta
+from preprocessing import (JPEG_QUALITY, STORAGE_MODES, StorageOptions, face_pixels,
+                           prepare_image, tensor_pixels, to_pixels, to_features)
+from batching import MicroBatcher
+from persistence import PredictionWriter
+from db import connect, ensure_schema, get_connection
+from image_store import get_prediction_image_info, image_key, iter_image_blob, sniff_mimetype
+from image_archive import get_archived_image_info, read_archived_image
+from retention import RetentionWorker, policy_enabled, policy_from_env
+from cache import ByteLRUCache, PredictionCache, SessionStore
+from aggregates import get_summary
+from exporter import Export, ExportError, settled_until
+from history import DEFAULT_LIMIT as DEFAULT_HISTORY_LIMIT, HistoryQueryError, get_upload, query_history
+from thumbnails import get_or_create_thumbnail, make_thumbnail, snap_size
+from streaming import StreamRegistry
+from smoothing import SmootherRegistry
+from faces import FaceDetector, FaceTracker
+from metrics import (SIZE_BUCKETS, begin_request, end_request, ensure_started, histogram,
+                     register_collector, render as render_metrics, server_timing, stage)
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB max upload
 
 # Configuration
 MODEL_PATH = 'model.pkl'  # Your sklearn model
+# Exported float32 weights (export_model.py), memory-mapped at startup so
+# sklearn isn't imported and forked workers share the pages. Rebuilt from
+# MODEL_PATH when missing or stale.
+MODEL_WEIGHTS_DIR = os.environ.get('MODEL_WEIGHTS_DIR', 'model_weights')
+# Forward-pass precision: 'float32' (default), 'float64' or 'int8'. Compare
+# them with `python inference.py model.pkl --report` before switching.
+INFERENCE_PRECISION = os.environ.get('INFERENCE_PRECISION', 'float32')
 DB_FILE = 'emotion_detection.db'
-IMG_SIZE = (48, 48)  # Model expects 48x48 images
+# Micro-batching: concurrent requests arriving within this window (or until
+# BATCH_MAX_SIZE rows are queued) share one forward pass. 0 disables batching.
+BATCH_WINDOW_MS = float(os.environ.get('BATCH_WINDOW_MS', '0'))
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', '32'))
+
+# Write-behind persistence: predictions are committed by a background thread
+# in grouped transactions. Set WRITE_BEHIND=0 to commit inline (e.g. in tests).
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '1') != '0'
+WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', '64'))
+WRITE_MAX_PENDING = int(os.environ.get('WRITE_MAX_PENDING', '1000'))
+
+# /image/<id> caching: stored images never change, so responses are
+# immutable and the hottest ones are kept in an in-process LRU
+IMAGE_CACHE_BYTES = int(os.environ.get('IMAGE_CACHE_BYTES', str(32 * 1024 * 1024)))
+IMAGE_CACHE_MAX_ITEM = 1024 * 1024  # Larger images are streamed from SQLite instead
+IMAGE_MAX_AGE = 365 * 24 * 3600
+
+# /image/<id>?size=N thumbnails. THUMBNAIL_PRECOMPUTE lists sizes (e.g. "96,256")
+# to generate when a prediction is saved instead of on first request.
+THUMBNAIL_PRECOMPUTE = tuple(
+    snap_size(int(size)) for size in os.environ.get('THUMBNAIL_PRECOMPUTE', '').split(',') if size.strip()
+)
+
+# What is kept of each image: STORAGE_MODE 'jpeg' (the decoded grayscale
+# image as JPEG, so large JPEGs at 1/2 to 1/8 scale, see DECODE_MAX_SIDE),
+# 'preview' (at most STORAGE_PREVIEW_SIDE pixels, STORAGE_PREVIEW_FORMAT
+# 'webp' or 'jpeg'), 'tensor' (the exact 2304-byte 48x48 model input, served
+# by /image as a PNG) or 'original' (the uploaded file). Recorded per row.
+STORAGE = StorageOptions(
+    mode=os.environ.get('STORAGE_MODE', 'jpeg'),
+    quality=int(os.environ.get('STORAGE_QUALITY', str(JPEG_QUALITY))),
+    preview_side=int(os.environ.get('STORAGE_PREVIEW_SIDE', '256')),
+    preview_format=os.environ.get('STORAGE_PREVIEW_FORMAT', 'webp')
+)
+if STORAGE.mode not in STORAGE_MODES:
+    raise ValueError(f"STORAGE_MODE must be one of {', '.join(STORAGE_MODES)}, not {STORAGE.mode!r}")
+
+# Prediction cache: inputs that reduce to the same 48x48 model image skip the
+# forward pass. PREDICTION_CACHE_SIZE=0 disables it; PREDICTION_CACHE_TTL=0
+# means entries only leave by LRU eviction. WEBCAM_CACHE_TOLERANCE >= 0 gives
+# webcam frames a perceptual-hash cache that also matches frames differing in
+# at most that many of the 64 hash bits.
+PREDICTION_CACHE_SIZE = int(os.environ.get('PREDICTION_CACHE_SIZE', '4096'))
+PREDICTION_CACHE_TTL = float(os.environ.get('PREDICTION_CACHE_TTL', '0')) or None
+WEBCAM_CACHE_TOLERANCE = int(os.environ.get('WEBCAM_CACHE_TOLERANCE', '-1'))
+
+# Streaming webcam sessions (/stream). Sessions live in the worker that
+# created them, so gunicorn.conf.py sets STREAMING=0 unless it runs a single
+# worker (STREAMING=1), and /stream then refuses new sessions. The
+# single-process development server keeps it on.
+STREAMING = os.environ.get('STREAMING', '1') != '0'
+STREAM_MAX_SESSIONS = int(os.environ.get('STREAM_MAX_SESSIONS', '100'))
+STREAM_IDLE_TIMEOUT = float(os.environ.get('STREAM_IDLE_TIMEOUT', '60'))
+STREAM_KEEPALIVE = 15.0  # Seconds between SSE comments on an idle stream
+STREAM_MAX_FRAME_BYTES = 2 * 1024 * 1024
+
+# Face localization: the model sees a crop around the largest face instead
+# of the whole frame (whole frame if no face is found). Webcam sessions track
+# the face between frames instead of searching the full frame every time.
+FACE_DETECTION = os.environ.get('FACE_DETECTION', '1') != '0'
+FACE_REDETECT_EVERY = 10  # Full-frame detection at least this often while tracking
+MAX_FACES = 32  # Faces predicted per uploaded image, largest first
+
+# Temporal smoothing for webcam sessions (/stream and /predict_webcam with a
+# session_id). SMOOTHING_MODE is 'ema', 'majority' or 'off'. A frame whose
+# 48x48 image differs from the last processed one by less than
+# SKIP_DIFF_THRESHOLD gray levels on average reuses the smoothed result
+# without running the model (0 disables skipping).
+SMOOTHING_MODE = os.environ.get('SMOOTHING_MODE', 'ema')
+SMOOTHING_WINDOW = int(os.environ.get('SMOOTHING_WINDOW', '5'))
+SMOOTHING_HYSTERESIS = float(os.environ.get('SMOOTHING_HYSTERESIS', '0.1'))
+SKIP_DIFF_THRESHOLD = float(os.environ.get('SKIP_DIFF_THRESHOLD', '2.0'))
+SKIP_MAX_FRAMES = 10  # Run the model at least every this many frames
+SMOOTHING_IDLE_TIMEOUT = 120.0
+
+# Per-stage timings are always recorded for /metrics; SERVER_TIMING=0 stops
+# sending them back as Server-Timing headers. Under gunicorn, METRICS_DIR
+# (set by gunicorn.conf.py) lets /metrics report every worker.
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '1') != '0'
+
+# Image retention (retention.py): RETENTION_DAYS and/or RETENTION_MAX_MB move
+# the oldest images out of the database every RETENTION_INTERVAL seconds,
+# into IMAGE_ARCHIVE_DIR segments (RETENTION_ACTION=archive, still served by
+# /image) or deleted (RETENTION_ACTION=delete). Unset: images are kept.
+RETENTION_POLICY = policy_from_env()
+
+# /predict_batch limits
+MAX_BATCH_IMAGES = 256
+MAX_ARCHIVE_BYTES = 64 * 1024 * 1024  # Total uncompressed size allowed in a zip
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.webp', '.tif', '.tiff')
 
 # Emotion labels - UPDATE THIS to match your model's training data
 # Your model was trained on 5 emotions
 EMOTION_LABELS = ['Angry', 'Fear', 'Happy', 'Sad', 'Suprise']
 
 # Global variables
-model = None
+model = None  # sklearn model, only set when loaded from the pickle
+model_source = None  # 'mmap' or 'pickle'
+engine = None  # InferenceEngine built from the loaded model's weights
+batcher = None  # MicroBatcher wrapping the engine when batching is enabled
+writer = PredictionWriter(DB_FILE, batch_size=WRITE_BATCH_SIZE, max_pending=WRITE_MAX_PENDING,
+                          synchronous=not WRITE_BEHIND, thumbnail_sizes=THUMBNAIL_PRECOMPUTE,
+                          logger=app.logger)
+atexit.register(writer.close)  # Flush queued predictions on shutdown
+image_cache = ByteLRUCache(max_bytes=IMAGE_CACHE_BYTES, max_item_bytes=IMAGE_CACHE_MAX_ITEM)
+streams = StreamRegistry(max_sessions=STREAM_MAX_SESSIONS, idle_timeout=STREAM_IDLE_TIMEOUT)
+face_detector = FaceDetector() if FACE_DETECTION else None
+face_trackers = SessionStore(lambda: FaceTracker(redetect_every=FACE_REDETECT_EVERY),
+                             idle_timeout=SMOOTHING_IDLE_TIMEOUT)
+smoothers = None
+if SMOOTHING_MODE != 'off':
+    smoothers = SmootherRegistry(idle_timeout=SMOOTHING_IDLE_TIMEOUT, mode=SMOOTHING_MODE,
+                                 window=SMOOTHING_WINDOW, hysteresis=SMOOTHING_HYSTERESIS,
+                                 skip_threshold=SKIP_DIFF_THRESHOLD, max_skip=SKIP_MAX_FRAMES)
+retention = RetentionWorker(DB_FILE, RETENTION_POLICY) if policy_enabled(RETENTION_POLICY) else None
+prediction_cache = None
+webcam_cache = None
+if PREDICTION_CACHE_SIZE > 0:
+    prediction_cache = PredictionCache(max_items=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL)
+    webcam_cache = prediction_cache
+    if WEBCAM_CACHE_TOLERANCE >= 0:
+        webcam_cache = PredictionCache(max_items=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL,
+                                       perceptual=True, tolerance=WEBCAM_CACHE_TOLERANCE)
 
 
 def init_database():
-    """Initialize SQLite database with required tables."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    # Table 1: predictions - stores all prediction results with images
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS predictions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_name TEXT NOT NULL,
-            image_path TEXT,
-            image_data BLOB NOT NULL,
-            predicted_emotion TEXT NOT NULL,
-            confidence REAL NOT NULL,
-            all_probabilities TEXT,
-            timestamp TEXT NOT NULL,
-            source TEXT NOT NULL
-        )
-    """)
-    
-    # Table 2: users - tracks users (optional, for statistics)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            first_used TEXT NOT NULL,
-            total_predictions INTEGER DEFAULT 0
-        )
-    """)
-    
-    # Table 3: model_info - stores model training information
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS model_info (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            model_name TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            accuracy REAL,
-            epochs INTEGER,
-            description TEXT
-        )
-    """)
-    
-    conn.commit()
-    conn.close()
+    """Initialize SQLite database with required tables, migrating old layouts."""
+    ensure_schema(get_connection(DB_FILE),
+                  progress=lambda n: print(f"   Moved {n} images into the image store..."))
     print(f"✅ Database '{DB_FILE}' initialized successfully")
 
 
+def weights_are_current():
+    """True if MODEL_WEIGHTS_DIR holds an export of the current MODEL_PATH."""
+    meta = read_weights_meta(MODEL_WEIGHTS_DIR)
+    if meta is None:
+        return False
+    if not os.path.exists(MODEL_PATH):
+        return True  # Deployed with the exported weights only
+    return meta.get('source_sha256') == file_sha256(MODEL_PATH)
+
+
+def load_engine():
+    """Build the inference engine, preferring the memory-mapped weights."""
+    global model, model_source
+    if weights_are_current():
+        loaded, meta = load_weights(MODEL_WEIGHTS_DIR, mmap_mode='r')
+        if meta.get('labels') and meta['labels'] != EMOTION_LABELS:
+            print(f"⚠️ Exported labels {meta['labels']} differ from {EMOTION_LABELS}")
+        model, model_source = None, 'mmap'
+        print(f"✅ Weights memory-mapped from {MODEL_WEIGHTS_DIR}/")
+        return loaded
+
+    import joblib  # Only needed when falling back to the pickle
+    model = joblib.load(MODEL_PATH)
+    model_source = 'pickle'
+    loaded = InferenceEngine.from_sklearn(model)
+    print(f"✅ Model loaded from {MODEL_PATH}")
+    print(f"✅ Model type: {type(model)}")
+    try:
+        export_weights(loaded, MODEL_WEIGHTS_DIR, labels=EMOTION_LABELS, source_path=MODEL_PATH)
+        print(f"✅ Weights exported to {MODEL_WEIGHTS_DIR}/ for faster startup")
+    except OSError as e:
+        print(f"⚠️ Could not export weights: {e}")
+    return loaded
+
+
 def load_model_and_labels():
-    """Load the trained sklearn model."""
-    global model
+    """Load the trained model and build the inference engine."""
+    global engine, batcher
     
     # Debug: Print current working directory and files
     print(f"Current working directory: {os.getcwd()}")
     print(f"Files in current directory: {os.listdir('.')}")
     print(f"Looking for model at: {os.path.abspath(MODEL_PATH)}")
     
-    if not os.path.exists(MODEL_PATH):
+    if not os.path.exists(MODEL_PATH) and read_weights_meta(MODEL_WEIGHTS_DIR) is None:
         print(f"❌ Model file not found: {MODEL_PATH}")
         print(f"Absolute path checked: {os.path.abspath(MODEL_PATH)}")
         # Try alternative locations
@@ -104,9 +240,14 @@ def load_model_and_labels():
             return False
     
     try:
-        model = joblib.load(MODEL_PATH)
-        print(f"✅ Model loaded from {MODEL_PATH}")
-        print(f"✅ Model type: {type(model)}")
+        engine = load_engine().with_precision(INFERENCE_PRECISION)
+        print(f"✅ Inference precision: {engine.precision}")
+        if BATCH_WINDOW_MS > 0:
+            batcher = MicroBatcher(forward, window_ms=BATCH_WINDOW_MS,
+                                   max_batch_size=BATCH_MAX_SIZE)
+        for cache in (prediction_cache, webcam_cache):
+            if cache is not None:
+                cache.clear()  # Cached outputs belong to the previous model
         print(f"✅ Emotion labels: {EMOTION_LABELS}")
         return True
     except Exception as e:
@@ -119,122 +260,249 @@ def load_model_and_labels():
 def preprocess_image(img: Image.Image) -> np.ndarray:
     """
     Preprocess PIL image for sklearn model prediction.
-    Converts to 48x48 grayscale and flattens to 1D array.
+    Converts to 48x48 grayscale and flattens to a (1, 2304) float32 array.
+
+    The routes decode raw bytes with preprocessing.prepare_image instead;
+    this stays for callers that already hold a PIL image.
     """
-    # Convert PIL image to numpy array
-    img_array = np.array(img)
-    
-    # Convert to grayscale using OpenCV
-    if len(img_array.shape) == 3:  # Color image
-        img_gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
-    else:  # Already grayscale
-        img_gray = img_array
-    
-    # Resize to 48x48
-    img_resized = cv2.resize(img_gray, IMG_SIZE)
-    
-    # Flatten to 1D array (2304 features)
-    img_flattened = img_resized.flatten()
+    return to_features(to_pixels(np.asarray(img)))
+
+
+def forward(features: np.ndarray):
+    """One forward pass of the engine, recorded in the model metrics."""
+    started = time.perf_counter()
+    outputs = engine.predict(features)
+    MODEL_SECONDS.observe(time.perf_counter() - started)
+    MODEL_BATCH_ROWS.observe(len(features))
+    return outputs
+
+
+def run_model(features: np.ndarray):
+    """Run the model on an (n, 2304) matrix, through the batcher if enabled."""
+    with stage('inference'):
+        if batcher is not None:
+            return batcher.submit(features)
+        return forward(features)
+
+
+def format_prediction(index: int, probabilities: np.ndarray) -> dict:
+    """Build the JSON-ready result for one row of model output."""
+    predicted_emotion = EMOTION_LABELS[engine.classes[index]]
+    confidence = float(probabilities[index])
     
-    # Normalize to 0-1
-    img_normalized = img_flattened / 255.0
+    # All probabilities
+    all_probs = {
+        EMOTION_LABELS[i]: float(probabilities[i]) 
+        for i in range(len(EMOTION_LABELS))
+    }
     
-    # Reshape for sklearn (1 sample, 2304 features)
-    img_preprocessed = img_normalized.reshape(1, -1)
+    return {
+        'success': True,
+        'emotion': predicted_emotion,
+        'confidence': confidence,
+        'all_probabilities': all_probs
+    }
+
+
+def predict_row(features: np.ndarray, pixels=None, cache=None):
+    """
+    Return (class index, probabilities) for one (1, 2304) feature row.
+
+    When the 48x48 uint8 pixels and a PredictionCache are given, repeated
+    inputs are answered from the cache without running the model.
+    """
+    if cache is not None and pixels is not None:
+        cached = cache.get(pixels)
+        if cached is not None:
+            return cached
     
-    return img_preprocessed
+    # Single forward pass gives both the class index and probabilities
+    indices, probabilities = run_model(features)
+    if cache is not None and pixels is not None:
+        cache.put(pixels, indices[0], probabilities[0])
+    return int(indices[0]), probabilities[0]
 
 
-def predict_emotion(img: Image.Image):
-    """Run emotion prediction on image using sklearn model."""
-    if model is None:
+def predict_rows(pixels, features: np.ndarray, cache=None):
+    """
+    Return (class index, probabilities) for each row of an (n, 2304) matrix.
+
+    pixels are the matching 48x48 model images. Rows found in the cache are
+    answered directly; the rest share one forward pass.
+    """
+    outputs = [cache.get(image) if cache is not None else None for image in pixels]
+    misses = [row for row, output in enumerate(outputs) if output is None]
+    if misses:
+        with stage('inference'):
+            indices, probabilities = forward(features[misses])
+        for row, index, probs in zip(misses, indices, probabilities):
+            outputs[row] = (int(index), probs)
+            if cache is not None:
+                cache.put(pixels[row], index, probs)
+    return outputs
+
+
+def predict_emotion(img, pixels=None, cache=None):
+    """
+    Run emotion prediction using the sklearn model.
+
+    Accepts a PIL image or an already preprocessed (1, 2304) feature row.
+    """
+    if engine is None:
         return {'error': 'Model not loaded'}
     
     try:
-        img_array = preprocess_image(img)
-        
-        # Get prediction (class index)
-        predicted_idx = model.predict(img_array)[0]
-        
-        # Get probabilities for all classes
-        probabilities = model.predict_proba(img_array)[0]
-        
-        predicted_emotion = EMOTION_LABELS[predicted_idx]
-        confidence = float(probabilities[predicted_idx])
-        
-        # All probabilities
-        all_probs = {
-            EMOTION_LABELS[i]: float(probabilities[i]) 
-            for i in range(len(EMOTION_LABELS))
-        }
-        
-        return {
-            'success': True,
-            'emotion': predicted_emotion,
-            'confidence': confidence,
-            'all_probabilities': all_probs
-        }
+        img_array = img if isinstance(img, np.ndarray) else preprocess_image(img)
+        return format_prediction(*predict_row(img_array, pixels, cache))
     except Exception as e:
         return {'error': str(e)}
 
 
-def save_prediction_to_db(user_name: str, image_path: str, image_bytes: bytes,
-                          predicted_emotion: str, confidence: float, 
-                          all_probs: dict, source: str):
-    """Save prediction result to database."""
+def face_locator(session_id=None):
+    """Return the detect callable for prepare_image, tracking per session if given."""
+    if face_detector is None or not face_detector.available:
+        return None
+    if session_id is None:
+        return face_detector.detect
+    tracker = face_trackers.get(session_id)
+    return lambda gray: tracker.detect(face_detector, gray)
+
+
+def main_face_box(prepared):
+    """Box of the face used as the model input, or None."""
+    if prepared.faces is None or not prepared.faces.boxes:
+        return None
+    return prepared.faces.boxes[0]
+
+
+def face_fields(prepared) -> dict:
+    """Face detection details for a response, empty if detection didn't run."""
+    if prepared.faces is None:
+        return {}
+    boxes = prepared.faces.boxes
+    return {
+        'face_box': list(boxes[0]) if boxes else None,
+        'faces_detected': len(boxes),
+        'face_detection_ms': round(prepared.faces.elapsed_ms, 2),
+        'face_tracked': prepared.faces.tracked
+    }
+
+
+def predict_webcam_frame(prepared, session_id=None):
+    """
+    Predict a webcam frame, smoothed over the session's previous frames.
+
+    Frames nearly identical to the session's last processed frame reuse the
+    smoothed result without running the model. Without a session id (or
+    with smoothing off) this is a plain prediction.
+    """
+    if smoothers is None or session_id is None:
+        return predict_emotion(prepared.features, prepared.pixels, webcam_cache)
+    if engine is None:
+        return {'error': 'Model not loaded'}
+    
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        timestamp = datetime.utcnow().isoformat()
-        
-        cursor.execute("""
-            INSERT INTO predictions 
-            (user_name, image_path, image_data, predicted_emotion, 
-             confidence, all_probabilities, timestamp, source)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            user_name,
-            image_path,
-            image_bytes,
-            predicted_emotion,
-            confidence,
-            json.dumps(all_probs),
-            timestamp,
-            source
-        ))
-        
-        # Update user statistics
-        cursor.execute("""
-            SELECT id FROM users WHERE name = ?
-        """, (user_name,))
-        
-        user = cursor.fetchone()
-        if user:
-            cursor.execute("""
-                UPDATE users 
-                SET total_predictions = total_predictions + 1
-                WHERE name = ?
-            """, (user_name,))
+        smoother = smoothers.get(session_id)
+        skipped = smoother.should_skip(prepared.pixels)
+        smoothers.count(skipped)
+        if skipped:
+            raw_index = None
+            index, probabilities = smoother.current()
         else:
-            cursor.execute("""
-                INSERT INTO users (name, first_used, total_predictions)
-                VALUES (?, ?, 1)
-            """, (user_name, timestamp))
-        
-        conn.commit()
-        prediction_id = cursor.lastrowid
-        conn.close()
-        
-        return prediction_id
+            raw_index, raw_probabilities = predict_row(prepared.features, prepared.pixels, webcam_cache)
+            index, probabilities = smoother.update(prepared.pixels, raw_probabilities)
         
+        result = format_prediction(index, probabilities)
+        result['smoothed'] = True
+        result['inference_skipped'] = skipped
+        if raw_index is not None:
+            result['raw_emotion'] = EMOTION_LABELS[engine.classes[raw_index]]
+        return result
+    except Exception as e:
+        return {'error': str(e)}
+
+
+def save_predictions_to_db(records: list):
+    """
+    Save several prediction results in a single transaction.
+
+    Each record is a dict with the keyword arguments of save_prediction_to_db.
+    Returns the list of prediction ids in input order, or None on error. With
+    write-behind enabled the ids are handed out before the rows are committed.
+    """
+    try:
+        with stage('db'):
+            return writer.submit(records)
     except Exception as e:
         print(f"❌ Database error: {e}")
         return None
 
 
+def save_prediction_to_db(user_name: str, image_path: str, image_bytes: bytes,
+                          predicted_emotion: str, confidence: float, 
+                          all_probs: dict, source: str, face_box=None, storage_mode='jpeg'):
+    """Save prediction result to database."""
+    prediction_ids = save_predictions_to_db([{
+        'user_name': user_name,
+        'image_path': image_path,
+        'image_bytes': image_bytes,
+        'predicted_emotion': predicted_emotion,
+        'confidence': confidence,
+        'all_probs': all_probs,
+        'source': source,
+        'face_box': face_box,
+        'storage_mode': storage_mode
+    }])
+    return prediction_ids[0] if prediction_ids else None
+
+
+def _decode_base64_image(image_data: str) -> bytes:
+    """Decode a base64 string or data URL into raw image bytes."""
+    image_data = image_data.split(',')[1] if ',' in image_data else image_data
+    return base64.b64decode(image_data)
+
+
+def _read_zip_images(stream):
+    """Return (filename, bytes) for every image in a zip archive, in archive order."""
+    items = []
+    total_size = 0
+    with zipfile.ZipFile(stream) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            total_size += info.file_size
+            if total_size > MAX_ARCHIVE_BYTES:
+                raise ValueError('Archive too large')
+            items.append((info.filename, archive.read(info)))
+    return items
+
+
 # ==================== ROUTES ====================
 
+@app.before_request
+def start_request_timing():
+    ensure_started()
+    if retention is not None:
+        retention.ensure_started()
+    begin_request()
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def add_server_timing(response):
+    """Record the request latency and report its stages in a Server-Timing header."""
+    stages = end_request()
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    REQUEST_SECONDS.observe(elapsed, request.endpoint or 'unmatched', request.method,
+                            str(response.status_code))
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = server_timing(stages, elapsed)
+    return response
+
+
 @app.route('/')
 def index():
     """Render main page."""
@@ -243,7 +511,13 @@ def index():
 
 @app.route('/predict', methods=['POST'])
 def predict_upload():
-    """Handle image upload and prediction."""
+    """
+    Handle image upload and prediction.
+
+    Every detected face (up to MAX_FACES) gets its own prediction, from one
+    forward pass over the stacked crops, and its own predictions row linked
+    to one uploads row. The top-level fields describe the largest face.
+    """
     if 'image' not in request.files:
         return jsonify({'error': 'No image uploaded'}), 400
     
@@ -253,42 +527,53 @@ def predict_upload():
     
     user_name = request.form.get('name', 'Anonymous')
     
+    if engine is None:
+        return jsonify({'error': 'Model not loaded'}), 500
+    
     try:
-        # Load and process image
-        img = Image.open(file.stream)
+        # Decode once: model input and stored image come from the same buffer
+        prepared = prepare_image(file.read(), detect=face_locator(), storage=STORAGE)
+        boxes = prepared.faces.boxes[:MAX_FACES] if prepared.faces is not None else []
         
-        # Convert to grayscale for model (this is what the model expects)
-        if img.mode != 'L':
-            img_gray = img.convert('L')
+        # All faces go through the model together
+        if len(boxes) > 1:
+            pixels = face_pixels(prepared.gray, boxes)
+            outputs = predict_rows(pixels, to_features(pixels), prediction_cache)
         else:
-            img_gray = img
-        
-        # Get prediction on grayscale image
-        result = predict_emotion(img_gray)
-        
-        # Convert grayscale to RGB only for JPEG storage (JPEG doesn't support single-channel grayscale well)
-        img_rgb = img_gray.convert('RGB')
-        
-        # Convert image to bytes for database
-        img_byte_arr = BytesIO()
-        img_rgb.save(img_byte_arr, format='JPEG')
-        img_bytes = img_byte_arr.getvalue()
-        
-        if 'error' in result:
-            return jsonify(result), 500
+            pixels = [prepared.pixels]
+            outputs = [predict_row(prepared.features, prepared.pixels, prediction_cache)]
         
-        # Save to database
-        prediction_id = save_prediction_to_db(
-            user_name=user_name,
-            image_path=file.filename,
-            image_bytes=img_bytes,
-            predicted_emotion=result['emotion'],
-            confidence=result['confidence'],
-            all_probs=result['all_probabilities'],
-            source='upload'
-        )
+        # Save every face in one transaction, linked to one upload
+        upload = {'face_count': len(boxes)}
+        faces = []
+        records = []
+        for output, box, face_input in zip(outputs, boxes or [None], pixels):
+            face = format_prediction(*output)
+            faces.append(face)
+            records.append({
+                'user_name': user_name,
+                'image_path': file.filename,
+                # In tensor mode each face keeps its own model input
+                'image_bytes': face_input.tobytes() if STORAGE.mode == 'tensor' else prepared.stored_bytes,
+                'storage_mode': prepared.storage_mode,
+                'predicted_emotion': face['emotion'],
+                'confidence': face['confidence'],
+                'all_probs': face['all_probabilities'],
+                'source': 'upload',
+                'face_box': box,
+                'upload': upload
+            })
+        prediction_ids = save_predictions_to_db(records) or [None] * len(records)
         
-        result['prediction_id'] = prediction_id
+        result = dict(faces[0])
+        result.update(face_fields(prepared))
+        result['prediction_id'] = prediction_ids[0]
+        result['upload_id'] = upload.get('id')
+        # One entry per stored prediction; the whole image when no face was found
+        result['faces'] = [
+            dict(face, face_box=list(box) if box is not None else None, prediction_id=prediction_id)
+            for face, box, prediction_id in zip(faces, boxes or [None], prediction_ids)
+        ]
         return jsonify(result)
         
     except Exception as e:
@@ -297,7 +582,11 @@ def predict_upload():
 
 @app.route('/predict_webcam', methods=['POST'])
 def predict_webcam():
-    """Handle webcam capture prediction."""
+    """
+    Handle webcam capture prediction.
+
+    Frames sent with the same session_id are smoothed over time.
+    """
     data = request.get_json()
     
     if not data or 'image' not in data:
@@ -306,27 +595,15 @@ def predict_webcam():
     user_name = data.get('name', 'Anonymous')
     
     try:
-        # Decode base64 image
-        image_data = data['image'].split(',')[1] if ',' in data['image'] else data['image']
-        img_bytes = base64.b64decode(image_data)
-        img = Image.open(BytesIO(img_bytes))
-        
-        # Convert to grayscale for model (this is what the model expects)
-        if img.mode != 'L':
-            img_gray = img.convert('L')
-        else:
-            img_gray = img
+        # Decode base64 image once into model input and stored image
+        session_id = data.get('session_id')
+        prepared = prepare_image(_decode_base64_image(data['image']), detect=face_locator(session_id),
+                                 storage=STORAGE)
         
         # Get prediction on grayscale image
-        result = predict_emotion(img_gray)
-        
-        # Convert grayscale to RGB only for JPEG storage
-        img_rgb = img_gray.convert('RGB')
-        
-        # Convert to JPEG for consistent storage
-        img_byte_arr = BytesIO()
-        img_rgb.save(img_byte_arr, format='JPEG')
-        stored_img_bytes = img_byte_arr.getvalue()
+        result = predict_webcam_frame(prepared, session_id)
+        result.update(face_fields(prepared))
+        stored_img_bytes = prepared.stored_bytes
         
         if 'error' in result:
             return jsonify(result), 500
@@ -339,7 +616,9 @@ def predict_webcam():
             predicted_emotion=result['emotion'],
             confidence=result['confidence'],
             all_probs=result['all_probabilities'],
-            source='webcam'
+            source='webcam',
+            face_box=main_face_box(prepared),
+            storage_mode=prepared.storage_mode
         )
         
         result['prediction_id'] = prediction_id
@@ -349,49 +628,442 @@ def predict_webcam():
         return jsonify({'error': f'Processing failed: {str(e)}'}), 500
 
 
+@app.route('/stream', methods=['POST'])
+def open_stream():
+    """
+    Open a streaming webcam session.
+
+    JSON options: name, persist_every (save every Nth frame) and
+    persist_on_change (save when the emotion changes). By default stream
+    frames are not saved.
+    """
+    if not STREAMING:
+        return jsonify({'error': 'Live streaming is disabled on this server '
+                                 '(it needs a single worker process: WEB_CONCURRENCY=1)'}), 503
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        session = streams.create(
+            user_name=data.get('name') or 'Anonymous',
+            persist_every=max(int(data.get('persist_every') or 0), 0),
+            persist_on_change=bool(data.get('persist_on_change'))
+        )
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid persist_every'}), 400
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 503
+    
+    return jsonify({
+        'session_id': session.session_id,
+        'frames_url': f'/stream/{session.session_id}/frame',
+        'events_url': f'/stream/{session.session_id}/events'
+    }), 201
+
+
+@app.route('/stream/<session_id>/frame', methods=['POST'])
+def push_stream_frame(session_id):
+    """
+    Accept one raw JPEG/PNG frame (the request body, no base64).
+
+    Returns straight away; the frame replaces any frame still waiting for
+    inference. The latest result is included for clients without SSE.
+    """
+    session = streams.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Stream not found'}), 404
+    if request.content_length and request.content_length > STREAM_MAX_FRAME_BYTES:
+        return jsonify({'error': 'Frame too large'}), 413
+    
+    frame = request.get_data(cache=False)
+    if not frame:
+        return jsonify({'error': 'No frame data provided'}), 400
+    
+    session.push(frame)
+    return jsonify({'accepted': True, 'latest': session.last_result, **session.stats()}), 202
+
+
+def _process_stream_frame(session, frame: bytes) -> dict:
+    """Predict one stream frame and save it if the session samples it."""
+    try:
+        prepared = prepare_image(frame, detect=face_locator(session.session_id), storage=STORAGE)
+    except Exception as e:
+        return {'error': f'Processing failed: {str(e)}'}
+    
+    result = predict_webcam_frame(prepared, session.session_id)
+    if 'error' in result:
+        return result
+    result.update(face_fields(prepared))
+    
+    if session.record(result):
+        result['prediction_id'] = save_prediction_to_db(
+            user_name=session.user_name,
+            image_path='webcam_stream.jpg',
+            image_bytes=prepared.stored_bytes,
+            predicted_emotion=result['emotion'],
+            confidence=result['confidence'],
+            all_probs=result['all_probabilities'],
+            source='webcam',
+            face_box=main_face_box(prepared),
+            storage_mode=prepared.storage_mode
+        )
+    result['frame'] = session.processed
+    result['dropped'] = session.dropped
+    return result
+
+
+@app.route('/stream/<session_id>/events')
+def stream_events(session_id):
+    """
+    Server-Sent Events stream of predictions for a session.
+
+    Inference runs here, on the newest frame available each time the
+    previous one finishes.
+    """
+    session = streams.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Stream not found'}), 404
+    
+    def generate():
+        yield 'retry: 1000\n\n'
+        while not session.closed:
+            frame = session.next_frame(timeout=STREAM_KEEPALIVE)
+            if frame is None:
+                yield ': keepalive\n\n'
+                continue
+            result = _process_stream_frame(session, frame)
+            event = 'error' if 'error' in result else 'prediction'
+            yield f'event: {event}\ndata: {json.dumps(result)}\n\n'
+        yield 'event: end\ndata: {}\n\n'
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/stream/<session_id>', methods=['DELETE'])
+def close_stream(session_id):
+    """Close a streaming session and end its event stream."""
+    if not streams.close(session_id):
+        return jsonify({'error': 'Stream not found'}), 404
+    if smoothers is not None:
+        smoothers.discard(session_id)
+    face_trackers.discard(session_id)
+    return jsonify({'success': True})
+
+
+@app.route('/predict_batch', methods=['POST'])
+def predict_batch():
+    """
+    Predict many images in one request.
+
+    Accepts multipart files under 'images' (zip archives are expanded in
+    place), or JSON {"images": [<base64 or data URL>, ...], "name": ...}
+    (a bare array is taken as the images).
+    All images go through one forward pass and one database transaction;
+    results are returned in input order.
+    """
+    if engine is None:
+        return jsonify({'error': 'Model not loaded'}), 500
+    
+    try:
+        if request.is_json:
+            data = request.get_json(silent=True)
+            if isinstance(data, list):
+                data = {'images': data}
+            if not isinstance(data, dict) or not isinstance(data.get('images'), list):
+                return jsonify({'error': 'No images provided'}), 400
+            user_name = data.get('name', 'Anonymous')
+            source = 'webcam'
+            # Decoded per item below, so one bad frame only fails itself
+            items = [(f'frame_{i}.jpg', frame) for i, frame in enumerate(data['images'])]
+        else:
+            user_name = request.form.get('name', 'Anonymous')
+            source = 'upload'
+            items = []
+            for file in request.files.getlist('images'):
+                if file.filename.lower().endswith('.zip'):
+                    items.extend(_read_zip_images(file.stream))
+                elif file.filename:
+                    items.append((file.filename, file.read()))
+        
+        if not items:
+            return jsonify({'error': 'No images provided'}), 400
+        if len(items) > MAX_BATCH_IMAGES:
+            return jsonify({'error': f'Too many images (max {MAX_BATCH_IMAGES})'}), 400
+        
+        # Decode everything first; bad images get an error entry and are
+        # left out of the model batch.
+        results = [None] * len(items)
+        prepared = []
+        for position, (filename, img_bytes) in enumerate(items):
+            try:
+                if request.is_json:
+                    img_bytes = _decode_base64_image(img_bytes)
+                prepared.append((position, filename, prepare_image(img_bytes, detect=face_locator(),
+                                                                         storage=STORAGE)))
+            except Exception as e:
+                results[position] = {'filename': filename, 'error': f'Processing failed: {str(e)}'}
+        
+        if prepared:
+            # Cached inputs are answered directly; the rest share one forward pass
+            cache = webcam_cache if source == 'webcam' else prediction_cache
+            outputs = predict_rows([image.pixels for _, _, image in prepared],
+                                   np.vstack([image.features for _, _, image in prepared]), cache)
+            
+            records = []
+            for (position, filename, image), output in zip(prepared, outputs):
+                result = format_prediction(*output)
+                result.update(face_fields(image))
+                result['filename'] = filename
+                results[position] = result
+                records.append({
+                    'user_name': user_name,
+                    'image_path': filename,
+                    'image_bytes': image.stored_bytes,
+                    'predicted_emotion': result['emotion'],
+                    'confidence': result['confidence'],
+                    'all_probs': result['all_probabilities'],
+                    'source': source,
+                    'face_box': main_face_box(image),
+                    'storage_mode': image.storage_mode
+                })
+            
+            prediction_ids = save_predictions_to_db(records) or [None] * len(records)
+            for (position, *_), prediction_id in zip(prepared, prediction_ids):
+                results[position]['prediction_id'] = prediction_id
+        
+        return jsonify({
+            'success': True,
+            'count': len(results),
+            'results': results
+        })
+        
+    except Exception as e:
+        return jsonify({'error': f'Processing failed: {str(e)}'}), 500
+
+
 @app.route('/history')
 def get_history():
-    """Get prediction history (without image data for performance)."""
+    """
+    Get prediction history (without image data for performance).
+
+    Keyset-paginated: pass the returned next_cursor as ?cursor= for the next
+    page. Optional filters: user, emotion, source, min_confidence,
+    max_confidence, since, until (ISO timestamps) and limit.
+    """
     try:
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        args = request.args
+        predictions, next_cursor = query_history(
+            get_connection(DB_FILE),
+            limit=args.get('limit', DEFAULT_HISTORY_LIMIT),
+            cursor=args.get('cursor'),
+            user=args.get('user'),
+            emotion=args.get('emotion'),
+            source=args.get('source'),
+            min_confidence=args.get('min_confidence'),
+            max_confidence=args.get('max_confidence'),
+            since=args.get('since'),
+            until=args.get('until')
+        )
         
-        cursor.execute("""
-            SELECT id, user_name, image_path, predicted_emotion, 
-                   confidence, all_probabilities, timestamp, source
-            FROM predictions
-            ORDER BY timestamp DESC
-            LIMIT 50
-        """)
+        return jsonify({'predictions': predictions, 'next_cursor': next_cursor})
         
-        predictions = [dict(row) for row in cursor.fetchall()]
+    except HistoryQueryError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/export')
+def export_predictions():
+    """
+    Stream predictions as a download.
+
+    Query parameters: format (csv, jsonl, parquet, arrow), gzip=1 (csv and
+    jsonl), since, until (ISO timestamps) and after_id. until defaults to a
+    cutoff a minute in the past (exporter.SETTLE_SECONDS), so rows still in
+    a worker's write-behind queue aren't skipped. For incremental exports
+    pass X-Export-Until back as since. Ids are reserved in blocks per worker
+    and commit out of order, so after_id=X-Export-Last-Id can miss rows.
+    """
+    conn = None
+    try:
+        args = request.args
+        # Its own connection: the response is read long after this function returns
+        conn = connect(DB_FILE)
+        export = Export(
+            conn,
+            fmt=args.get('format', 'csv'),
+            compress=args.get('gzip', '').lower() in ('1', 'true', 'yes'),
+            since=args.get('since'),
+            until=args.get('until') or settled_until(),
+            after_id=args.get('after_id')
+        )
+    except ExportError as e:
         conn.close()
-        
-        return jsonify({'predictions': predictions})
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        if conn is not None:
+            conn.close()
+        return jsonify({'error': str(e)}), 500
+
+    response = Response(export.chunks(), mimetype=export.media_type, headers={
+        'Content-Disposition': f'attachment; filename="{export.filename()}"',
+        'X-Export-Last-Id': str(export.last_id),
+        'X-Export-Until': export.until,
+    })
+    # A generator that never started skips its finally, so a client that
+    # disconnects before the first chunk would leak the connection
+    response.call_on_close(conn.close)
+    return response
+
+
+@app.route('/uploads/<int:upload_id>')
+def get_upload_faces(upload_id):
+    """Get an uploaded image's record and one prediction per detected face."""
+    try:
+        upload = get_upload(get_connection(DB_FILE), upload_id)
+        if upload is None:
+            return jsonify({'error': 'Upload not found'}), 404
+        return jsonify(upload)
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def _image_response(key: str, size: int, data: bytes = None, rowid: int = None,
+                    mimetype='image/jpeg'):
+    """
+    Serve stored image bytes with a strong ETag, immutable caching, 304 and Range.
+
+    Either data (the whole image) or rowid (read lazily from the images
+    table via incremental blob I/O) must be given. mimetype may be a callable,
+    so a 304 doesn't have to read the image to tell its type.
+    """
+    response = Response()
+    response.set_etag(key)
+    response.cache_control.public = True
+    response.cache_control.max_age = IMAGE_MAX_AGE
+    response.cache_control.immutable = True
+    response.accept_ranges = 'bytes'
+    
+    if request.if_none_match.contains(key):
+        response.status_code = 304
+        return response
+    
+    response.mimetype = mimetype() if callable(mimetype) else mimetype
+    start, stop = 0, size
+    # Multipart byteranges aren't served; RFC 9110 lets us ignore such a
+    # Range header and send the whole image
+    if (request.range is not None and len(request.range.ranges) == 1
+            and request.if_range.etag in (None, key)):
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            response.status_code = 416
+            response.headers['Content-Range'] = f'bytes */{size}'
+            return response
+        start, stop = byte_range
+        response.status_code = 206
+        response.content_range = ContentRange('bytes', start, stop, size)
+    
+    if data is None:
+        data = image_cache.get(key)
+        if data is None and start == 0 and stop == size and size <= IMAGE_CACHE_MAX_ITEM:
+            data = b''.join(iter_image_blob(get_connection(DB_FILE), rowid))
+            image_cache.put(key, data)
+    
+    if data is not None:
+        response.set_data(data[start:stop])
+    else:
+        # Large image or partial request: stream straight from the blob
+        response.response = iter_image_blob(get_connection(DB_FILE), rowid, start, stop)
+        response.content_length = stop - start
+    return response
+
+
+def _thumbnail_response(key: str, max_side: int, load_thumbnail):
+    """Serve a thumbnail of the image stored under key, via the LRU cache."""
+    variant_key = f'{key}-{max_side}'
+    data = image_cache.get(variant_key)
+    if data is None:
+        data = load_thumbnail()
+        image_cache.put(variant_key, data)
+    return _image_response(variant_key, len(data), data=data)
+
+
+def _stored_mimetype(storage_mode: str, read_head) -> str:
+    """Media type of stored bytes; only modes other than jpeg need read_head() to tell."""
+    if storage_mode == 'jpeg':
+        return 'image/jpeg'
+    return sniff_mimetype(read_head())
+
+
+def _tensor_response(key: str, load_tensor):
+    """Serve a stored 48x48 model input as a lossless PNG (at every ?size=)."""
+    variant_key = f'{key}-png'
+    data = image_cache.get(variant_key)
+    if data is None:
+        ok, encoded = cv2.imencode('.png', tensor_pixels(load_tensor()))
+        if not ok:
+            raise ValueError('PNG encoding failed')
+        data = encoded.tobytes()
+        image_cache.put(variant_key, data)
+    return _image_response(variant_key, len(data), data=data, mimetype='image/png')
+
+
+def _archived_image_response(conn, prediction_id: int, max_side=None):
+    """Serve an image the retention job moved to the archive segments."""
+    info = get_archived_image_info(conn, prediction_id)
+    if info is None:
+        return jsonify({'error': 'Image not found'}), 404
+    
+    key, size, storage_mode = info
+    if storage_mode == 'tensor':
+        return _tensor_response(key, lambda: read_archived_image(conn, key))
+    if max_side is not None:
+        return _thumbnail_response(key, max_side, lambda: get_or_create_thumbnail(
+            conn, key, max_side, lambda: read_archived_image(conn, key)))
+    data = image_cache.get(key)
+    if data is None:
+        data = read_archived_image(conn, key)
+        image_cache.put(key, data)
+    return _image_response(key, size, data=data, mimetype=_stored_mimetype(storage_mode, lambda: data))
+
+
 @app.route('/image/<int:prediction_id>')
 def get_image(prediction_id):
-    """Retrieve stored image from database."""
+    """Retrieve stored image from database (cacheable, supports Range and ?size=)."""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
+        max_side = request.args.get('size', type=int)
+        if max_side is not None:
+            if max_side <= 0:
+                return jsonify({'error': f'Invalid size: {max_side}'}), 400
+            max_side = snap_size(max_side)
         
-        cursor.execute("""
-            SELECT image_data FROM predictions WHERE id = ?
-        """, (prediction_id,))
+        # Rows still queued in the write-behind buffer
+        pending = writer.pending_image(prediction_id)
+        if pending is not None:
+            data, storage_mode = pending
+            if storage_mode == 'tensor':
+                return _tensor_response(image_key(data), lambda: data)
+            if max_side is not None:
+                return _thumbnail_response(image_key(data), max_side,
+                                           lambda: make_thumbnail(data, max_side))
+            return _image_response(image_key(data), len(data), data=data,
+                                   mimetype=_stored_mimetype(storage_mode, lambda: data))
         
-        row = cursor.fetchone()
-        conn.close()
+        conn = get_connection(DB_FILE)
+        info = get_prediction_image_info(conn, prediction_id)
+        if info is None:
+            return _archived_image_response(conn, prediction_id, max_side)
         
-        if row and row[0]:
-            return send_file(BytesIO(row[0]), mimetype='image/jpeg')
-        else:
-            return jsonify({'error': 'Image not found'}), 404
+        key, size, rowid, storage_mode = info
+        if storage_mode == 'tensor':
+            return _tensor_response(key, lambda: b''.join(iter_image_blob(conn, rowid)))
+        if max_side is not None:
+            return _thumbnail_response(key, max_side, lambda: get_or_create_thumbnail(
+                conn, key, max_side, lambda: b''.join(iter_image_blob(conn, rowid))))
+        return _image_response(key, size, rowid=rowid, mimetype=lambda: _stored_mimetype(
+            storage_mode, lambda: next(iter_image_blob(conn, rowid, 0, 16), b'')))
             
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -399,76 +1071,93 @@ def get_image(prediction_id):
 
 @app.route('/statistics')
 def get_statistics():
-    """Get statistics about predictions and users."""
+    """Get statistics about predictions and users (from maintained aggregates)."""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # Total predictions
-        cursor.execute("SELECT COUNT(*) FROM predictions")
-        total_predictions = cursor.fetchone()[0]
-        
-        # Predictions by emotion
-        cursor.execute("""
-            SELECT predicted_emotion, COUNT(*) as count
-            FROM predictions
-            GROUP BY predicted_emotion
-        """)
-        emotions_count = dict(cursor.fetchall())
-        
-        # Total users
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-        
-        # Top users
-        cursor.execute("""
-            SELECT name, total_predictions
-            FROM users
-            ORDER BY total_predictions DESC
-            LIMIT 10
-        """)
-        top_users = [{'name': row[0], 'predictions': row[1]} for row in cursor.fetchall()]
-        
-        # Upload vs Webcam
-        cursor.execute("""
-            SELECT source, COUNT(*) as count
-            FROM predictions
-            GROUP BY source
-        """)
-        source_count = dict(cursor.fetchall())
-        
-        conn.close()
+        summary = get_summary(get_connection(DB_FILE))
         
         return jsonify({
-            'total_predictions': total_predictions,
-            'emotions_count': emotions_count,
-            'total_users': total_users,
-            'top_users': top_users,
-            'source_count': source_count
+            'total_predictions': summary['total_predictions'],
+            'emotions_count': summary['emotions_count'],
+            'total_users': summary['total_users'],
+            'top_users': summary['top_users'],
+            'source_count': summary['source_count'],
+            'average_confidence': summary['average_confidence'],
+            'daily_counts': summary['daily_counts']
         })
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/metrics')
+def get_metrics():
+    """Prometheus metrics for every worker of this server."""
+    try:
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/health')
 def health_check():
     """Health check endpoint."""
     return jsonify({
         'status': 'running',
-        'model_loaded': model is not None,
+        'model_loaded': engine is not None,
+        'model_source': model_source,
+        'inference_precision': engine.precision if engine is not None else None,
         'model_path': MODEL_PATH,
         'model_exists': os.path.exists(MODEL_PATH),
         'cwd': os.getcwd(),
         'files_in_dir': os.listdir('.'),
         'database': os.path.exists(DB_FILE),
-        'emotions': EMOTION_LABELS
+        'emotions': EMOTION_LABELS,
+        'batching': batcher.stats() if batcher is not None else None,
+        'storage': STORAGE._asdict(),
+        'writer': writer.stats(),
+        'retention': retention.stats() if retention is not None else None,
+        'image_cache': image_cache.stats(),
+        'streams': dict(streams.stats(), enabled=STREAMING),
+        'smoothing': smoothers.stats() if smoothers is not None else None,
+        'face_detection': face_detector.stats() if face_detector is not None else None,
+        'prediction_cache': prediction_cache.stats() if prediction_cache is not None else None,
+        'webcam_cache': webcam_cache.stats() if webcam_cache not in (None, prediction_cache) else None
     })
 
 
 # ==================== MAIN ====================
 
 # ==================== INITIALIZE ON STARTUP ====================
+REQUEST_SECONDS = histogram('emotion_http_request_seconds', 'Request latency by endpoint',
+                            ['endpoint', 'method', 'status'])
+MODEL_SECONDS = histogram('emotion_model_forward_seconds', 'Duration of one forward pass')
+MODEL_BATCH_ROWS = histogram('emotion_model_batch_rows', 'Rows per forward pass', buckets=SIZE_BUCKETS)
+
+
+def _cache_counters():
+    values = {}
+    caches = {'prediction': prediction_cache, 'webcam': webcam_cache, 'image': image_cache}
+    for name, cache in caches.items():
+        if cache is None or (name == 'webcam' and cache is prediction_cache):
+            continue
+        stats = cache.stats()
+        values[(name, 'hit')] = stats['hits']
+        values[(name, 'miss')] = stats['misses']
+    return values
+
+
+register_collector('emotion_cache_lookups_total', 'counter', 'Cache lookups by cache and result',
+                   ['cache', 'result'], _cache_counters)
+register_collector('emotion_db_rows_total', 'counter', 'Prediction rows by write outcome', ['outcome'],
+                   lambda: {('written',): writer.written, ('failed',): writer.failed,
+                            ('inline',): writer.inline_writes})
+register_collector('emotion_db_queue_depth', 'gauge', 'Prediction rows waiting for the writer', [],
+                   lambda: {(): writer.stats()['pending']})
+register_collector('emotion_stream_sessions', 'gauge', 'Open streaming sessions', [],
+                   lambda: {(): streams.stats()['open']})
+register_collector('emotion_inference_skipped_total', 'counter', 'Webcam frames answered without inference', [],
+                   lambda: {(): smoothers.skipped_frames if smoothers is not None else 0})
+
 # This runs when gunicorn loads the app module
 print("=" * 60)
 print("🎭 EMOTION DETECTION WEB APP - BACKEND")
@@ -488,6 +1177,8 @@ else:
     print(f"\n✅ Backend ready!")
     print(f"📁 Database: {DB_FILE}")
     print(f"🎯 Emotions: {EMOTION_LABELS}")
+if face_detector is not None and not face_detector.available:
+    print(f"⚠️ Face cascade not found ({face_detector.cascade_path}); using whole images")
 print("=" * 60)
 
 
@@ -0,0 +1,167 @@
+"""
+batching.py
+
+Per-worker micro-batching scheduler for model inference.
+
+Concurrent requests hand their preprocessed (n, 2304) rows to a MicroBatcher.
+A background thread collects everything that arrives within a short window
+(or until max_batch_size rows are queued), runs one stacked forward pass and
+hands each caller back its own slice of the result.
+"""
+import os
+import queue
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+
+class _PendingRequest:
+    """A caller's rows waiting in the batch queue."""
+
+    __slots__ = ('features', 'enqueued_at', 'done', 'result', 'error')
+
+    def __init__(self, features):
+        self.features = features
+        self.enqueued_at = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    Group concurrent inference calls into a single forward pass.
+
+    predict_fn takes an (N, n_features) matrix and returns a tuple
+    (indices, probabilities) with N rows each, e.g. InferenceEngine.predict.
+    """
+
+    def __init__(self, predict_fn, window_ms=2.0, max_batch_size=32):
+        self.predict_fn = predict_fn
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    # ---------------- worker lifecycle ----------------
+
+    def _ensure_started(self):
+        # Threads don't survive fork(), so a worker inherited from a
+        # preloading master has to start its own batching thread.
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def _collect(self):
+        """Block for the first request, then gather more until the window closes."""
+        first = self._queue.get()
+        batch = [first]
+        rows = len(first.features)
+        deadline = time.perf_counter() + self.window
+
+        while rows < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            rows += len(item.features)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            try:
+                if len(batch) == 1:
+                    features = batch[0].features
+                else:
+                    features = np.concatenate([item.features for item in batch])
+                indices, probabilities = self.predict_fn(features)
+
+                offset = 0
+                for item in batch:
+                    n = len(item.features)
+                    item.result = (indices[offset:offset + n], probabilities[offset:offset + n])
+                    offset += n
+            except Exception as e:
+                for item in batch:
+                    item.error = e
+
+            self._record(batch, started)
+            for item in batch:
+                item.done.set()
+
+    # ---------------- public API ----------------
+
+    def submit(self, features: np.ndarray, timeout=None):
+        """Queue rows for inference and wait for their (indices, probabilities)."""
+        features = np.asarray(features)
+        if features.ndim == 1:
+            features = features.reshape(1, -1)
+
+        self._ensure_started()
+        request = _PendingRequest(features)
+        self._queue.put(request)
+
+        if not request.done.wait(timeout):
+            raise TimeoutError('Inference batch timed out')
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    # ---------------- metrics ----------------
+
+    def _record(self, batch, started):
+        rows = sum(len(item.features) for item in batch)
+        waits = [started - item.enqueued_at for item in batch]
+        with self._stats_lock:
+            self._batches += 1
+            self._requests += len(batch)
+            self._samples += rows
+            self._batch_sizes[rows] += 1
+            self._wait_total += sum(waits)
+            self._wait_max = max(self._wait_max, max(waits))
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._batches = 0
+            self._requests = 0
+            self._samples = 0
+            self._batch_sizes = Counter()
+            self._wait_total = 0.0
+            self._wait_max = 0.0
+
+    def stats(self):
+        """Snapshot of batch size and queue wait metrics."""
+        with self._stats_lock:
+            batches = self._batches
+            requests = self._requests
+            return {
+                'window_ms': self.window * 1000.0,
+                'max_batch_size': self.max_batch_size,
+                'batches': batches,
+                'requests': requests,
+                'samples': self._samples,
+                'avg_batch_size': self._samples / batches if batches else 0.0,
+                'batch_size_histogram': dict(sorted(self._batch_sizes.items())),
+                'avg_queue_wait_ms': self._wait_total / requests * 1000.0 if requests else 0.0,
+                'max_queue_wait_ms': self._wait_max * 1000.0,
+            }
@@ -0,0 +1,1132 @@
+"""
+benchmark.py
+
+Micro-benchmarks for the emotion detection backend.
+
+Usage:
+    python benchmark.py [--json] preprocess [--runs 20]
+    python benchmark.py [--json] db-writers [--processes 4] [--writes 200]
+    python benchmark.py [--json] image-store [--rows 5000] [--duplicates 0.5]
+    python benchmark.py [--json] history [--rows 1000000]
+    python benchmark.py [--json] model-load [--workers 4] [--model model.pkl]
+    python benchmark.py [--json] dataset [--images 5000] [--data DIR]
+    python benchmark.py [--json] storage [--images 200] [--quality 75]
+    python benchmark.py [--json] e2e [--runs 30] [--gunicorn] [--stub] [--output results.json]
+                                     [--baseline before.json --threshold 0.15]
+"""
+import argparse
+import base64
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import resource
+import sys
+import time
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# name -> (width, height)
+IMAGE_SIZES = {
+    'small': (160, 160),
+    'webcam': (640, 480),
+    '12mp': (4000, 3000),
+}
+
+
+def make_synthetic_jpeg(width, height, seed=0, quality=90) -> bytes:
+    """Build a face-like RGB JPEG (smooth background, ellipse, some noise)."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    img = np.empty((height, width, 3), dtype=np.uint8)
+    img[..., 0] = (x * 255 // max(width - 1, 1)).astype(np.uint8)
+    img[..., 1] = (y * 255 // max(height - 1, 1)).astype(np.uint8)
+    img[..., 2] = 128
+
+    center = (width // 2, height // 2)
+    axes = (width // 5, height // 3)
+    cv2.ellipse(img, center, axes, 0, 0, 360, (210, 180, 160), -1)
+    cv2.circle(img, (center[0] - axes[0] // 2, center[1] - axes[1] // 3), max(axes[0] // 8, 1), (40, 40, 40), -1)
+    cv2.circle(img, (center[0] + axes[0] // 2, center[1] - axes[1] // 3), max(axes[0] // 8, 1), (40, 40, 40), -1)
+    noise = rng.integers(0, 16, size=img.shape, dtype=np.uint8)
+    img = cv2.add(img, noise)
+
+    buffer = BytesIO()
+    Image.fromarray(img).save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def _reset_peak_rss():
+    """Reset the kernel's peak RSS counter where supported (Linux)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    """Peak resident set size of this process, in MB."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss survives fork/exec, so it is only a fallback
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+# ==================== PREPROCESSING ====================
+
+def legacy_preprocess(data: bytes):
+    """The pre-refactor route pipeline: PIL decode, float64 features, RGB JPEG re-encode."""
+    img = Image.open(BytesIO(data))
+    img_gray = img.convert('L') if img.mode != 'L' else img
+
+    img_array = np.array(img_gray)
+    img_resized = cv2.resize(img_array, (48, 48))
+    features = (img_resized.flatten() / 255.0).reshape(1, -1)
+
+    img_byte_arr = BytesIO()
+    img_gray.convert('RGB').save(img_byte_arr, format='JPEG')
+    return features, img_byte_arr.getvalue()
+
+
+def current_preprocess(data: bytes):
+    """The shared single-decode pipeline used by the routes."""
+    from preprocessing import prepare_image
+    prepared = prepare_image(data)
+    return prepared.features, prepared.stored_bytes
+
+
+PIPELINES = {
+    'legacy': legacy_preprocess,
+    'current': current_preprocess,
+}
+
+
+def _time_pipeline(pipeline_name, size_name, data, runs, queue):
+    """Child process: measure latency and peak RSS growth of one pipeline."""
+    pipeline = PIPELINES[pipeline_name]
+    pipeline(make_synthetic_jpeg(64, 64))  # Warm up imports and codecs
+
+    _reset_peak_rss()
+    rss_before = _peak_rss_mb()
+    timings = []
+    stored_size = 0
+    for _ in range(runs):
+        started = time.perf_counter()
+        _, stored = pipeline(data)
+        timings.append((time.perf_counter() - started) * 1000.0)
+        stored_size = len(stored)
+
+    queue.put({
+        'pipeline': pipeline_name,
+        'image': size_name,
+        'input_bytes': len(data),
+        'stored_bytes': stored_size,
+        'median_ms': float(np.median(timings)),
+        'p95_ms': float(np.percentile(timings, 95)),
+        'peak_rss_growth_mb': _peak_rss_mb() - rss_before,
+    })
+
+
+def bench_preprocess(runs=20):
+    """Compare legacy and current preprocessing, each in a fresh process."""
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for size_name, (width, height) in IMAGE_SIZES.items():
+        # Built here so its own allocations don't show up in the child's peak RSS
+        data = make_synthetic_jpeg(width, height)
+        for pipeline_name in PIPELINES:
+            queue = ctx.Queue()
+            process = ctx.Process(target=_time_pipeline, args=(pipeline_name, size_name, data, runs, queue))
+            process.start()
+            results.append(queue.get())
+            process.join()
+    return results
+
+
+def print_preprocess(results):
+    print("\n🖼️  PREPROCESSING BENCHMARK\n")
+    print("-" * 86)
+    print(f"{'Image':<8} {'Pipeline':<9} {'Input KB':>9} {'Stored KB':>10} {'Median ms':>10} {'p95 ms':>9} {'Peak RSS +MB':>13}")
+    print("-" * 86)
+    for r in results:
+        print(f"{r['image']:<8} {r['pipeline']:<9} {r['input_bytes'] / 1024:>9.1f} {r['stored_bytes'] / 1024:>10.1f} "
+              f"{r['median_ms']:>10.2f} {r['p95_ms']:>9.2f} {r['peak_rss_growth_mb']:>13.1f}")
+    print("-" * 86)
+
+
+# ==================== DATABASE WRITERS ====================
+
+LEGACY_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS predictions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_name TEXT NOT NULL,
+        image_path TEXT,
+        image_data BLOB NOT NULL,
+        predicted_emotion TEXT NOT NULL,
+        confidence REAL NOT NULL,
+        all_probabilities TEXT,
+        timestamp TEXT NOT NULL,
+        source TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        first_used TEXT NOT NULL,
+        total_predictions INTEGER DEFAULT 0
+    );
+"""
+
+
+def create_legacy_tables(db_file):
+    """Create the original schema (inline image BLOBs, rollback journal)."""
+    conn = sqlite3.connect(db_file)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.close()
+
+
+def _prediction_record(image_bytes, user_name):
+    return {
+        'user_name': user_name,
+        'image_path': 'bench.jpg',
+        'image_bytes': image_bytes,
+        'predicted_emotion': 'Happy',
+        'confidence': 0.9,
+        'all_probs': {'Angry': 0.025, 'Fear': 0.025, 'Happy': 0.9, 'Sad': 0.025, 'Suprise': 0.025},
+        'source': 'upload',
+    }
+
+
+def legacy_save(db_file, record):
+    """The pre-refactor save path: fresh connection, default journal, commit per row."""
+    try:
+        conn = sqlite3.connect(db_file)
+        cursor = conn.cursor()
+        timestamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+        cursor.execute("""
+            INSERT INTO predictions
+            (user_name, image_path, image_data, predicted_emotion,
+             confidence, all_probabilities, timestamp, source)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (record['user_name'], record['image_path'], record['image_bytes'],
+              record['predicted_emotion'], record['confidence'],
+              json.dumps(record['all_probs']), timestamp, record['source']))
+        cursor.execute("SELECT id FROM users WHERE name = ?", (record['user_name'],))
+        if cursor.fetchone():
+            cursor.execute("UPDATE users SET total_predictions = total_predictions + 1 WHERE name = ?",
+                           (record['user_name'],))
+        else:
+            cursor.execute("INSERT INTO users (name, first_used, total_predictions) VALUES (?, ?, 1)",
+                           (record['user_name'], timestamp))
+        conn.commit()
+        conn.close()
+        return True
+    except Exception:
+        return False
+
+
+def pooled_save(db_file, record):
+    """The shared db layer: pooled WAL connection, BEGIN IMMEDIATE with retries."""
+    from db import get_connection
+    from persistence import write_predictions
+    try:
+        write_predictions(get_connection(db_file), [record])
+        return True
+    except Exception:
+        return False
+
+
+WRITERS = {
+    'legacy': legacy_save,
+    'pooled': pooled_save,
+}
+
+
+def _run_writer(mode, db_file, writes, image_bytes, start, queue):
+    save = WRITERS[mode]
+    user_name = f'worker-{os.getpid()}'
+    latencies = []
+    failures = 0
+    start.wait()
+    for _ in range(writes):
+        started = time.perf_counter()
+        if not save(db_file, _prediction_record(image_bytes, user_name)):
+            failures += 1
+        latencies.append((time.perf_counter() - started) * 1000.0)
+    queue.put((latencies, failures))
+
+
+def bench_db_writers(processes=4, writes=200):
+    """Concurrent writer processes against a fresh database, legacy vs pooled."""
+    from db import connect, create_tables
+
+    ctx = multiprocessing.get_context('spawn')
+    image_bytes = make_synthetic_jpeg(640, 480)
+    results = []
+    for mode in WRITERS:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_file = os.path.join(tmp, 'bench.db')
+            if mode == 'legacy':
+                create_legacy_tables(db_file)
+            else:
+                conn = connect(db_file)
+                create_tables(conn)
+                conn.close()
+
+            start = ctx.Event()
+            queue = ctx.Queue()
+            workers = [
+                ctx.Process(target=_run_writer, args=(mode, db_file, writes, image_bytes, start, queue))
+                for _ in range(processes)
+            ]
+            for worker in workers:
+                worker.start()
+            time.sleep(1.0)  # Let every process finish importing
+
+            started = time.perf_counter()
+            start.set()
+            outcomes = [queue.get() for _ in workers]
+            elapsed = time.perf_counter() - started
+            for worker in workers:
+                worker.join()
+
+        latencies = [ms for worker_latencies, _ in outcomes for ms in worker_latencies]
+        failures = sum(f for _, f in outcomes)
+        total = processes * writes
+        results.append({
+            'mode': mode,
+            'processes': processes,
+            'writes': total,
+            'failures': failures,
+            'writes_per_sec': (total - failures) / elapsed,
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+        })
+    return results
+
+
+def print_db_writers(results):
+    print("\n💾 CONCURRENT WRITER BENCHMARK\n")
+    print("-" * 72)
+    print(f"{'Mode':<8} {'Procs':>6} {'Writes':>7} {'Failed':>7} {'Writes/s':>10} {'p50 ms':>9} {'p99 ms':>9}")
+    print("-" * 72)
+    for r in results:
+        print(f"{r['mode']:<8} {r['processes']:>6} {r['writes']:>7} {r['failures']:>7} "
+              f"{r['writes_per_sec']:>10.1f} {r['p50_ms']:>9.2f} {r['p99_ms']:>9.2f}")
+    print("-" * 72)
+
+
+# ==================== IMAGE STORE ====================
+
+HISTORY_QUERY = """
+    SELECT id, user_name, image_path, predicted_emotion,
+           confidence, all_probabilities, timestamp, source
+    FROM predictions
+    ORDER BY timestamp DESC
+    LIMIT 50
+"""
+
+STATISTICS_QUERIES = [
+    "SELECT COUNT(*) FROM predictions",
+    "SELECT predicted_emotion, COUNT(*) FROM predictions GROUP BY predicted_emotion",
+    "SELECT source, COUNT(*) FROM predictions GROUP BY source",
+]
+
+EMOTIONS = ['Angry', 'Fear', 'Happy', 'Sad', 'Suprise']
+
+
+def fill_legacy_database(db_file, rows, duplicates=0.5, image_size=8 * 1024, seed=0):
+    """Populate a legacy-schema database with inline images, a share of them repeated."""
+    rng = np.random.default_rng(seed)
+    distinct = max(1, int(rows * (1 - duplicates)))
+    pool = [rng.integers(0, 256, image_size, dtype=np.uint8).tobytes() for _ in range(distinct)]
+
+    create_legacy_tables(db_file)
+    conn = sqlite3.connect(db_file)
+    with conn:
+        conn.executemany("""
+            INSERT INTO predictions
+            (user_name, image_path, image_data, predicted_emotion,
+             confidence, all_probabilities, timestamp, source)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            (f'user{i % 50}', 'bench.jpg', pool[i % distinct], EMOTIONS[i % 5], 0.5, '{}',
+             f'2025-01-01T00:00:{i:09d}', 'upload' if i % 3 else 'webcam')
+            for i in range(rows)
+        ))
+    conn.close()
+
+
+def _median_query_ms(conn, queries, runs=5):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        for query in queries:
+            conn.execute(query).fetchall()
+        timings.append((time.perf_counter() - started) * 1000.0)
+    return float(np.median(timings))
+
+
+def bench_image_store(rows=5000, duplicates=0.5):
+    """History/statistics query times with inline BLOBs vs the content-addressed store."""
+    import shutil
+    from migrate_database import migrate
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_file = os.path.join(tmp, 'legacy.db')
+        store_file = os.path.join(tmp, 'store.db')
+        fill_legacy_database(legacy_file, rows, duplicates)
+        shutil.copy(legacy_file, store_file)
+
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            migrate(store_file, vacuum=True)
+        migration_s = time.perf_counter() - started
+
+        for layout, db_file in (('inline', legacy_file), ('content-addressed', store_file)):
+            conn = sqlite3.connect(db_file)
+            results.append({
+                'layout': layout,
+                'rows': rows,
+                'file_mb': os.path.getsize(db_file) / (1024 * 1024),
+                'history_ms': _median_query_ms(conn, [HISTORY_QUERY]),
+                'statistics_ms': _median_query_ms(conn, STATISTICS_QUERIES),
+                'migration_s': migration_s if layout != 'inline' else None,
+            })
+            conn.close()
+    return results
+
+
+def print_image_store(results):
+    print("\n🗄️  IMAGE STORE BENCHMARK\n")
+    print("-" * 72)
+    print(f"{'Layout':<18} {'Rows':>7} {'File MB':>9} {'History ms':>11} {'Stats ms':>10} {'Migrate s':>10}")
+    print("-" * 72)
+    for r in results:
+        migration = f"{r['migration_s']:.2f}" if r['migration_s'] is not None else '-'
+        print(f"{r['layout']:<18} {r['rows']:>7} {r['file_mb']:>9.1f} {r['history_ms']:>11.2f} "
+              f"{r['statistics_ms']:>10.2f} {migration:>10}")
+    print("-" * 72)
+
+
+# ==================== HISTORY ====================
+
+def fill_history_database(db_file, rows, seed=0):
+    """Populate a current-schema database with prediction rows (no triggers, no indexes)."""
+    from db import connect, create_tables
+
+    rng = np.random.default_rng(seed)
+    conn = connect(db_file)
+    create_tables(conn)
+    chunk = 100_000
+    for start in range(0, rows, chunk):
+        n = min(chunk, rows - start)
+        confidences = rng.random(n)
+        users = rng.integers(0, 1000, n)
+        emotions = rng.integers(0, 5, n)
+        conn.execute("BEGIN")
+        conn.executemany("""
+            INSERT INTO predictions
+            (user_name, image_path, image_hash, predicted_emotion,
+             confidence, all_probabilities, timestamp, source)
+            VALUES (?, 'bench.jpg', 'x', ?, ?, '{}', ?, ?)
+        """, (
+            (f'user{users[i]}', EMOTIONS[emotions[i]], float(confidences[i]),
+             f'2025-01-01T{(start + i) // 3600 % 24:02d}:{(start + i) // 60 % 60:02d}:{(start + i) % 60:02d}.{start + i:09d}',
+             'webcam' if (start + i) % 3 == 0 else 'upload')
+            for i in range(n)
+        ))
+        conn.execute("COMMIT")
+    return conn
+
+
+def _time_pages(fetch_page, pages, runs=3):
+    """Median time to fetch the first page and to reach page number `pages`."""
+    first, deep = [], []
+    for _ in range(runs):
+        started = time.perf_counter()
+        cursor = fetch_page(None, 0)
+        first.append((time.perf_counter() - started) * 1000.0)
+
+        started = time.perf_counter()
+        for page in range(1, pages):
+            cursor = fetch_page(cursor, page)
+        deep.append((time.perf_counter() - started) * 1000.0 / max(pages - 1, 1))
+    return float(np.median(first)), float(np.median(deep))
+
+
+def bench_history(rows=1_000_000, pages=20):
+    """/history queries: unindexed LIMIT/OFFSET vs keyset pagination on composite indexes."""
+    from history import HISTORY_COLUMNS, create_history_indexes, query_history
+
+    scenarios = {
+        'latest': {},
+        'by_user': {'user': 'user42'},
+        'by_emotion_conf': {'emotion': 'Happy', 'min_confidence': 0.8},
+    }
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = fill_history_database(os.path.join(tmp, 'history.db'), rows)
+
+        def offset_pager(filters):
+            conditions = []
+            params = []
+            if 'user' in filters:
+                conditions.append('user_name = ?')
+                params.append(filters['user'])
+            if 'emotion' in filters:
+                conditions.append('predicted_emotion = ?')
+                params.append(filters['emotion'])
+            if 'min_confidence' in filters:
+                conditions.append('confidence >= ?')
+                params.append(filters['min_confidence'])
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+            def fetch(cursor, page):
+                conn.execute(f"""
+                    SELECT {HISTORY_COLUMNS} FROM predictions {where}
+                    ORDER BY timestamp DESC LIMIT 50 OFFSET ?
+                """, (*params, page * 50)).fetchall()
+            return fetch
+
+        def keyset_pager(filters):
+            def fetch(cursor, page):
+                return query_history(conn, limit=50, cursor=cursor, **filters)[1]
+            return fetch
+
+        for name, filters in scenarios.items():
+            first, deep = _time_pages(offset_pager(filters), pages, runs=1)
+            results.append({'scenario': name, 'mode': 'offset, no index', 'rows': rows,
+                            'first_page_ms': first, 'per_page_ms': deep})
+
+        started = time.perf_counter()
+        create_history_indexes(conn)
+        index_build_s = time.perf_counter() - started
+
+        for name, filters in scenarios.items():
+            first, deep = _time_pages(keyset_pager(filters), pages)
+            results.append({'scenario': name, 'mode': 'keyset, indexed', 'rows': rows,
+                            'first_page_ms': first, 'per_page_ms': deep,
+                            'index_build_s': index_build_s})
+        conn.close()
+    return results
+
+
+def print_history(results):
+    print("\n📜 HISTORY PAGINATION BENCHMARK\n")
+    print("-" * 72)
+    print(f"{'Scenario':<17} {'Mode':<18} {'Rows':>9} {'First page ms':>14} {'Next pages ms':>14}")
+    print("-" * 72)
+    for r in results:
+        print(f"{r['scenario']:<17} {r['mode']:<18} {r['rows']:>9} {r['first_page_ms']:>14.2f} {r['per_page_ms']:>14.2f}")
+    print("-" * 72)
+
+
+# ==================== MODEL LOADING ====================
+
+def _memory_mb():
+    """(rss, pss, private) of this process in MB, from smaps_rollup (Linux)."""
+    values = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].endswith(':') and parts[1].isdigit():
+                    values[parts[0][:-1]] = int(parts[1]) / 1024
+    except OSError:
+        return None, None, None
+    private = values.get('Private_Clean', 0) + values.get('Private_Dirty', 0)
+    return values.get('Rss'), values.get('Pss'), private
+
+
+def _run_model_load(mode, model_path, weights_dir, ready, done, queue):
+    started = time.perf_counter()
+    if mode == 'pickle':
+        import joblib
+        from inference import InferenceEngine
+        engine = InferenceEngine.from_sklearn(joblib.load(model_path))
+    else:
+        from inference import load_weights
+        engine = load_weights(weights_dir, mmap_mode='r')[0]
+    load_s = time.perf_counter() - started
+
+    # Touch every weight page, as serving does on the first request
+    engine.predict(np.zeros((1, engine.coefs[0].shape[0]), dtype=np.float32))
+    ready.wait()  # Measure while every worker is alive, so shared pages are split in PSS
+    rss, pss, private = _memory_mb()
+    queue.put({
+        'load_s': load_s,
+        'rss_mb': rss,
+        'pss_mb': pss,
+        'private_mb': private,
+        'sklearn_imported': 'sklearn' in sys.modules,
+    })
+    done.wait()
+
+
+def _synthetic_model(model_path, hidden_layer_sizes=(256, 128), classes=5, seed=0):
+    """Fit a small MLP with the production layer sizes and pickle it."""
+    import joblib
+    from sklearn.neural_network import MLPClassifier
+
+    rng = np.random.default_rng(seed)
+    X = rng.random((200, 48 * 48), dtype=np.float32)
+    y = np.arange(200) % classes
+    mlp = MLPClassifier(hidden_layer_sizes=hidden_layer_sizes, max_iter=2, random_state=seed)
+    with contextlib.redirect_stderr(io.StringIO()):
+        mlp.fit(X, y)
+    joblib.dump(mlp, model_path)
+
+
+def bench_model_load(workers=4, model_path=None):
+    """Startup time and per-worker memory, unpickling model.pkl vs mmap'd exported weights."""
+    from export_model import export
+
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        if model_path is None:
+            model_path = os.path.join(tmp, 'model.pkl')
+            _synthetic_model(model_path)
+        weights_dir = os.path.join(tmp, 'model_weights')
+        with contextlib.redirect_stdout(io.StringIO()):
+            export(model_path, weights_dir)
+
+        for mode in ('pickle', 'mmap'):
+            ready, done = ctx.Barrier(workers + 1), ctx.Event()
+            queue = ctx.Queue()
+            processes = [
+                ctx.Process(target=_run_model_load,
+                            args=(mode, model_path, weights_dir, ready, done, queue))
+                for _ in range(workers)
+            ]
+            for process in processes:
+                process.start()
+            ready.wait()
+            outcomes = [queue.get() for _ in processes]
+            done.set()
+            for process in processes:
+                process.join()
+
+            def mean(key):
+                values = [o[key] for o in outcomes if o[key] is not None]
+                return float(np.mean(values)) if values else None
+
+            results.append({
+                'mode': mode,
+                'workers': workers,
+                'load_s': mean('load_s'),
+                'rss_mb': mean('rss_mb'),
+                'pss_mb': mean('pss_mb'),
+                'private_mb': mean('private_mb'),
+                'sklearn_imported': any(o['sklearn_imported'] for o in outcomes),
+            })
+    return results
+
+
+def print_model_load(results):
+    def mb(value):
+        return f"{value:.1f}" if value is not None else '-'
+
+    print("\n🧠 MODEL LOADING BENCHMARK (per worker)\n")
+    print("-" * 72)
+    print(f"{'Mode':<8} {'Workers':>8} {'Load ms':>9} {'RSS MB':>8} {'PSS MB':>8} {'Private MB':>11} {'sklearn':>8}")
+    print("-" * 72)
+    for r in results:
+        print(f"{r['mode']:<8} {r['workers']:>8} {r['load_s'] * 1000:>9.1f} {mb(r['rss_mb']):>8} "
+              f"{mb(r['pss_mb']):>8} {mb(r['private_mb']):>11} {'yes' if r['sklearn_imported'] else 'no':>8}")
+    print("-" * 72)
+
+
+# ==================== TRAINING DATASET ====================
+
+def legacy_load_data(data_dir):
+    """The original model.py loader: serial decode, Python lists, float64 scaling."""
+    X, y = [], []
+    classes = sorted(os.listdir(data_dir))
+    class_to_label = {c: i for i, c in enumerate(classes)}
+    for emotion in classes:
+        emotion_dir = os.path.join(data_dir, emotion)
+        for img_name in os.listdir(emotion_dir):
+            img = cv2.imread(os.path.join(emotion_dir, img_name), cv2.IMREAD_GRAYSCALE)
+            img = cv2.resize(img, (48, 48))
+            X.append(img.flatten())
+            y.append(class_to_label[emotion])
+    return np.array(X) / 255.0, np.array(y), classes
+
+
+def current_load_data(data_dir, cache_dir):
+    from dataset import load_dataset, to_features
+    X, y, classes = load_dataset(data_dir, cache_dir)
+    return to_features(X), y, classes
+
+
+def _time_loader(mode, data_dir, cache_dir, queue):
+    """Child process: one load of the dataset, with its time and peak RSS growth."""
+    _reset_peak_rss()
+    rss_before = _peak_rss_mb()
+    started = time.perf_counter()
+    if mode == 'legacy':
+        X, y, _ = legacy_load_data(data_dir)
+    else:
+        X, y, _ = current_load_data(data_dir, cache_dir)
+    queue.put({
+        'mode': mode,
+        'images': len(y),
+        'seconds': time.perf_counter() - started,
+        'features_mb': X.nbytes / (1024 * 1024),
+        'peak_rss_growth_mb': _peak_rss_mb() - rss_before,
+    })
+
+
+def make_synthetic_dataset(data_dir, images, classes=5, size=(96, 96)):
+    """A folder-per-class dataset of distinct JPEGs."""
+    for i in range(images):
+        class_dir = os.path.join(data_dir, f'class_{i % classes}')
+        os.makedirs(class_dir, exist_ok=True)
+        with open(os.path.join(class_dir, f'{i:06d}.jpg'), 'wb') as f:
+            f.write(make_synthetic_jpeg(*size, seed=i))
+
+
+def bench_dataset(images=5000, data_dir=None):
+    """Training data load: original serial loader vs pooled decode, then a cached rerun."""
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        if data_dir is None:
+            data_dir = os.path.join(tmp, 'data')
+            make_synthetic_dataset(data_dir, images)
+        cache_dir = os.path.join(tmp, 'cache')
+        for mode, label in (('legacy', 'legacy'), ('current', 'pool (cold)'), ('current', 'cached')):
+            queue = ctx.Queue()
+            process = ctx.Process(target=_time_loader, args=(mode, data_dir, cache_dir, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            result['mode'] = label
+            results.append(result)
+    return results
+
+
+def print_dataset(results):
+    print("\n🗂️  TRAINING DATASET LOADING BENCHMARK\n")
+    print("-" * 72)
+    print(f"{'Mode':<13} {'Images':>8} {'Seconds':>9} {'Features MB':>12} {'Peak RSS +MB':>13}")
+    print("-" * 72)
+    for r in results:
+        print(f"{r['mode']:<13} {r['images']:>8} {r['seconds']:>9.2f} {r['features_mb']:>12.1f} "
+              f"{r['peak_rss_growth_mb']:>13.1f}")
+    print("-" * 72)
+
+
+# ==================== END TO END ====================
+
+def unique_jpeg(data: bytes, n: int) -> bytes:
+    """Same pixels, different bytes: insert a JPEG comment so hashes and the image store see a new file."""
+    comment = f'bench-{n}'.encode()
+    return data[:2] + b'\xff\xfe' + (len(comment) + 2).to_bytes(2, 'big') + comment + data[2:]
+
+
+def write_stub_weights(directory, hidden_layer_sizes=(256, 128), classes=5, seed=0):
+    """Random weights with the production layer sizes, exported like a real model."""
+    from inference import InferenceEngine, export_weights
+
+    rng = np.random.default_rng(seed)
+    sizes = [48 * 48, *hidden_layer_sizes, classes]
+    engine = InferenceEngine(
+        coefs=[rng.normal(0, 0.05, (a, b)) for a, b in zip(sizes, sizes[1:])],
+        intercepts=[np.zeros(b) for b in sizes[1:]],
+        classes=np.arange(classes),
+    )
+    export_weights(engine, directory, labels=EMOTIONS)
+
+
+def prepare_model(directory, stub=False):
+    """Export model.pkl (or model_weights/) for the benchmark, or a stub; returns the model kind."""
+    weights_dir = os.path.join(directory, 'model_weights')
+    if not stub and os.path.exists('model.pkl'):
+        from export_model import export
+        with contextlib.redirect_stdout(io.StringIO()):
+            export('model.pkl', weights_dir)
+        return 'model.pkl'
+    if not stub and os.path.exists(os.path.join('model_weights', 'meta.json')):
+        import shutil
+        shutil.copytree('model_weights', weights_dir)
+        return 'model_weights'
+    write_stub_weights(weights_dir)
+    return 'stub'
+
+
+def _latency_row(scenario, image, latencies_ms, wall_s, cpu_s, peak_rss_mb):
+    count = len(latencies_ms)
+    return {
+        'scenario': scenario,
+        'image': image,
+        'runs': count,
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p95_ms': float(np.percentile(latencies_ms, 95)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+        'ops_per_sec': count / wall_s,
+        # Throughput per fully busy core: operations per CPU-second used
+        'ops_per_core_sec': count / cpu_s if cpu_s > 0 else None,
+        'peak_rss_mb': peak_rss_mb,
+    }
+
+
+def _measure(scenario, image, runs, fn):
+    fn(0)  # Warm-up
+    _reset_peak_rss()
+    latencies = []
+    wall_started, cpu_started = time.perf_counter(), time.process_time()
+    for n in range(1, runs + 1):
+        started = time.perf_counter()
+        fn(n)
+        latencies.append((time.perf_counter() - started) * 1000.0)
+    return _latency_row(scenario, image, latencies, time.perf_counter() - wall_started,
+                        time.process_time() - cpu_started, _peak_rss_mb())
+
+
+def _run_e2e_inprocess(workdir, runs, queue):
+    """Child process: import the app against workdir and time its functions and routes."""
+    os.chdir(workdir)
+    os.environ.update(MODEL_WEIGHTS_DIR=os.path.join(workdir, 'model_weights'),
+                      PREDICTION_CACHE_SIZE='0', SERVER_TIMING='0')
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app
+    client = app.app.test_client()
+    results = []
+
+    for image, (width, height) in IMAGE_SIZES.items():
+        data = make_synthetic_jpeg(width, height)
+        size_runs = runs if width * height < 1_000_000 else max(5, runs // 5)
+        prepared = app.prepare_image(data)
+
+        results.append(_measure('preprocess_image', image, size_runs,
+                                lambda n: app.preprocess_image(Image.open(BytesIO(data)))))
+        results.append(_measure('prepare_image', image, size_runs,
+                                lambda n: app.prepare_image(unique_jpeg(data, n))))
+        results.append(_measure('save_prediction_to_db', image, size_runs, lambda n: app.save_prediction_to_db(
+            'bench', f'{image}.jpg', unique_jpeg(prepared.stored_bytes, n), 'Happy', 0.9,
+            {'Happy': 0.9}, 'upload')))
+        app.writer.flush()
+        # The same save committed inline, as with WRITE_BEHIND=0 or under backpressure
+        app.writer.synchronous = True
+        results.append(_measure('save_prediction_to_db (sync)', image, size_runs, lambda n: app.save_prediction_to_db(
+            'bench', f'{image}.jpg', unique_jpeg(prepared.stored_bytes, runs + n), 'Happy', 0.9,
+            {'Happy': 0.9}, 'upload')))
+        app.writer.synchronous = False
+        results.append(_measure('POST /predict', image, size_runs, lambda n: client.post(
+            '/predict', data={'image': (BytesIO(unique_jpeg(data, n)), f'{image}.jpg'), 'name': 'bench'})))
+        if image == 'webcam':
+            frame = 'data:image/jpeg;base64,' + base64.b64encode(data).decode()
+            results.append(_measure('POST /predict_webcam', image, size_runs, lambda n: client.post(
+                '/predict_webcam', json={'image': frame, 'name': 'bench'})))
+        app.writer.flush()
+
+    features = prepared.features
+    results.append(_measure('predict_emotion', '-', runs * 10, lambda n: app.predict_emotion(features)))
+    results.append(_measure('GET /history', '-', runs, lambda n: client.get('/history?limit=50')))
+    results.append(_measure('GET /image/<id>', '-', runs, lambda n: client.get(f'/image/{n % 10 + 1}')))
+    queue.put(results)
+
+
+def _process_tree_cpu_seconds(pid):
+    """utime + stime of a process and its children, from /proc (Linux)."""
+    ticks = os.sysconf('SC_CLK_TCK')
+    total = 0.0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f'/proc/{current}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / ticks
+            with open(f'/proc/{current}/task/{current}/children') as f:
+                pids.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError, IndexError):
+            continue
+    return total
+
+
+def _run_e2e_gunicorn(workdir, duration, port=8765):
+    """Drive /predict on a real local gunicorn with the autotuned layout."""
+    from loadtest import launch, multipart_body, run_level, wait_for_server
+
+    url = f'http://127.0.0.1:{port}'
+    data = make_synthetic_jpeg(*IMAGE_SIZES['webcam'])
+    bodies = [multipart_body(unique_jpeg(data, n)) for n in range(512)]
+    concurrency = 2 * os.cpu_count()
+    server = launch(None, None, port, cwd=workdir,
+                    extra_env={'MODEL_WEIGHTS_DIR': os.path.join(workdir, 'model_weights')})
+    try:
+        if not wait_for_server(url):
+            raise RuntimeError('gunicorn did not start')
+        run_level(url, bodies, concurrency, 2.0)  # Warm-up
+        cpu_started = _process_tree_cpu_seconds(server.pid)
+        level = run_level(url, bodies, concurrency, duration)
+        cpu_s = _process_tree_cpu_seconds(server.pid) - cpu_started
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        'scenario': f'gunicorn POST /predict x{concurrency}',
+        'image': 'webcam',
+        'runs': level['requests'],
+        'p50_ms': level['p50_ms'],
+        'p95_ms': level['p95_ms'],
+        'p99_ms': level['p99_ms'],
+        'ops_per_sec': level['requests_per_sec'],
+        'ops_per_core_sec': level['requests'] / cpu_s if cpu_s > 0 else None,
+        'peak_rss_mb': None,
+        'errors': level['errors'],
+    }
+
+
+def compare_results(results, baseline, threshold=0.15, min_delta_ms=0.1):
+    """
+    Scenarios whose p50/p95 latency grew, or throughput fell, by more than threshold.
+
+    Latency changes under min_delta_ms are ignored as timer noise.
+    """
+    before = {(r['scenario'], r['image']): r for r in baseline['scenarios']}
+    regressions = []
+    for row in results['scenarios']:
+        old = before.get((row['scenario'], row['image']))
+        if old is None:
+            continue
+        checks = [(key, row[key], old[key],
+                   row[key] > old[key] * (1 + threshold) and row[key] - old[key] > min_delta_ms)
+                  for key in ('p50_ms', 'p95_ms') if row.get(key) and old.get(key)]
+        if row.get('ops_per_sec') and old.get('ops_per_sec'):
+            checks.append(('ops_per_sec', row['ops_per_sec'], old['ops_per_sec'],
+                           row['ops_per_sec'] < old['ops_per_sec'] * (1 - threshold)))
+        for metric, now, then, regressed in checks:
+            if regressed:
+                regressions.append({'scenario': row['scenario'], 'image': row['image'], 'metric': metric,
+                                    'baseline': then, 'current': now, 'change': now / then - 1})
+    return regressions
+
+
+def bench_e2e(runs=30, gunicorn=False, stub=False, duration=10.0, baseline=None, threshold=0.15):
+    """End-to-end timings of the prediction and persistence paths, in a fresh process."""
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp:
+        model = prepare_model(tmp, stub)
+        queue = ctx.Queue()
+        process = ctx.Process(target=_run_e2e_inprocess, args=(tmp, runs, queue))
+        process.start()
+        scenarios = queue.get()
+        process.join()
+        if gunicorn:
+            server_dir = os.path.join(tmp, 'server')
+            os.makedirs(server_dir)
+            os.symlink(os.path.join(tmp, 'model_weights'), os.path.join(server_dir, 'model_weights'))
+            scenarios.append(_run_e2e_gunicorn(server_dir, duration))
+
+    results = {
+        'environment': {
+            'cpus': os.cpu_count(),
+            'python': sys.version.split()[0],
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'model': model,
+        },
+        'scenarios': scenarios,
+    }
+    if baseline is not None:
+        with open(baseline) as f:
+            results['regressions'] = compare_results(results, json.load(f), threshold)
+        results['threshold'] = threshold
+    return results
+
+
+def print_e2e(results):
+    env = results['environment']
+    print(f"\n🏁 END-TO-END BENCHMARK ({env['cpus']} CPUs, model: {env['model']})\n")
+    print("-" * 100)
+    print(f"{'Scenario':<32} {'Image':<7} {'Runs':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'Ops/s':>8} {'Ops/core-s':>11} {'Peak RSS MB':>12}")
+    print("-" * 100)
+    for r in results['scenarios']:
+        per_core = f"{r['ops_per_core_sec']:.1f}" if r['ops_per_core_sec'] else '-'
+        rss = f"{r['peak_rss_mb']:.1f}" if r['peak_rss_mb'] else '-'
+        print(f"{r['scenario']:<32} {r['image']:<7} {r['runs']:>5} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} "
+              f"{r['p99_ms']:>8.2f} {r['ops_per_sec']:>8.1f} {per_core:>11} {rss:>12}")
+    print("-" * 100)
+    if 'regressions' in results:
+        if not results['regressions']:
+            print(f"✅ No regressions beyond {results['threshold']:.0%}")
+        for r in results['regressions']:
+            print(f"❌ {r['scenario']} ({r['image']}) {r['metric']}: "
+                  f"{r['baseline']:.2f} -> {r['current']:.2f} ({r['change']:+.0%})")
+
+
+# ==================== STORAGE MODES ====================
+
+# label -> StorageOptions keyword arguments
+STORAGE_VARIANTS = {
+    'jpeg': {'mode': 'jpeg'},
+    'preview-webp': {'mode': 'preview', 'preview_format': 'webp'},
+    'preview-jpeg': {'mode': 'preview', 'preview_format': 'jpeg'},
+    'tensor': {'mode': 'tensor'},
+    'original': {'mode': 'original'},
+}
+
+
+def _database_bytes(db_file):
+    return sum(os.path.getsize(db_file + suffix) for suffix in ('', '-wal') if os.path.exists(db_file + suffix))
+
+
+def bench_storage(images=200, sizes=('webcam', '12mp'), quality=None):
+    """Stored bytes, encode cost, write throughput and re-scoring error per storage mode."""
+    from db import connect, ensure_schema
+    from persistence import write_predictions
+    from preprocessing import JPEG_QUALITY, StorageOptions, prepare_image, stored_pixels
+
+    quality = quality or JPEG_QUALITY
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size_name in sizes:
+            count = images if size_name != '12mp' else max(1, images // 5)
+            # Distinct pixels, so the image store can't deduplicate the stored bytes
+            inputs = [make_synthetic_jpeg(*IMAGE_SIZES[size_name], seed=i) for i in range(count)]
+            for label, variant in STORAGE_VARIANTS.items():
+                options = StorageOptions(quality=quality, **variant)
+                db_file = os.path.join(tmp, f'{size_name}-{label}.db')
+                conn = connect(db_file)
+                ensure_schema(conn)
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                empty_bytes = _database_bytes(db_file)
+
+                prepare_ms, stored_sizes, diffs = [], [], []
+                started = time.perf_counter()
+                for data in inputs:
+                    t0 = time.perf_counter()
+                    prepared = prepare_image(data, storage=options)
+                    prepare_ms.append((time.perf_counter() - t0) * 1000.0)
+                    record = _prediction_record(prepared.stored_bytes, 'bench')
+                    record['storage_mode'] = options.mode
+                    write_predictions(conn, [record])
+                    stored_sizes.append(len(prepared.stored_bytes))
+                    rescored = stored_pixels(prepared.stored_bytes, options.mode)
+                    diffs.append(np.abs(rescored.astype(np.int16) - prepared.pixels))
+                elapsed = time.perf_counter() - started
+
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                results.append({
+                    'size': size_name,
+                    'mode': label,
+                    'predictions': count,
+                    'stored_bytes_per_prediction': float(np.mean(stored_sizes)),
+                    'db_bytes_per_prediction': (_database_bytes(db_file) - empty_bytes) / count,
+                    'prepare_p50_ms': float(np.percentile(prepare_ms, 50)),
+                    'writes_per_sec': count / elapsed,
+                    'rescore_mean_pixel_diff': float(np.mean(diffs)),
+                    'rescore_max_pixel_diff': int(np.max(diffs)),
+                })
+                conn.close()
+    return results
+
+
+def print_storage(results):
+    print("\n🗜️  IMAGE STORAGE MODES BENCHMARK\n")
+    print("-" * 72)
+    print(f"{'Size':<7} {'Mode':<13} {'Stored B':>9} {'DB B/pred':>10} {'Prep ms':>8} {'Writes/s':>9} {'Diff':>10}")
+    print("-" * 72)
+    for r in results:
+        print(f"{r['size']:<7} {r['mode']:<13} {r['stored_bytes_per_prediction']:>9.0f} "
+              f"{r['db_bytes_per_prediction']:>10.0f} {r['prepare_p50_ms']:>8.2f} {r['writes_per_sec']:>9.1f} "
+              f"{r['rescore_mean_pixel_diff']:>5.1f}/{r['rescore_max_pixel_diff']:<4}")
+    print("-" * 72)
+    print("Diff: mean/max 0-255 error of the 48x48 model input re-derived from the stored bytes")
+
+
+# ==================== MAIN ====================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Emotion detection backend benchmarks')
+    parser.add_argument('--json', action='store_true', help='Print machine-readable JSON')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    preprocess = subparsers.add_parser('preprocess', help='Decode/preprocess pipeline latency and memory')
+    preprocess.add_argument('--runs', type=int, default=20)
+
+    db_writers = subparsers.add_parser('db-writers', help='Concurrent prediction writers, legacy vs pooled WAL')
+    db_writers.add_argument('--processes', type=int, default=4)
+    db_writers.add_argument('--writes', type=int, default=200, help='Writes per process')
+
+    image_store = subparsers.add_parser('image-store', help='Query times with inline vs content-addressed images')
+    image_store.add_argument('--rows', type=int, default=5000)
+    image_store.add_argument('--duplicates', type=float, default=0.5, help='Share of repeated images')
+
+    history = subparsers.add_parser('history', help='Keyset vs OFFSET history pagination at scale')
+    history.add_argument('--rows', type=int, default=1_000_000)
+    history.add_argument('--pages', type=int, default=20)
+
+    model_load = subparsers.add_parser('model-load', help='Startup time and memory, pickle vs mmap weights')
+    model_load.add_argument('--workers', type=int, default=4)
+    model_load.add_argument('--model', default=None, help='Pickled model (default: synthetic MLP)')
+
+    dataset = subparsers.add_parser('dataset', help='Training data loading, serial vs pooled vs cached')
+    dataset.add_argument('--images', type=int, default=5000, help='Synthetic images to generate')
+    dataset.add_argument('--data', default=None, help='Existing folder-per-class dataset to load instead')
+
+    e2e = subparsers.add_parser('e2e', help='End-to-end latency/throughput of functions, routes and gunicorn')
+    e2e.add_argument('--runs', type=int, default=30, help='Runs per scenario (12 MP images use a fifth)')
+    e2e.add_argument('--gunicorn', action='store_true', help='Also load test a real local gunicorn')
+    e2e.add_argument('--duration', type=float, default=10.0, help='Seconds of gunicorn load')
+    e2e.add_argument('--stub', action='store_true', help='Use random weights even if model.pkl exists')
+    e2e.add_argument('--output', default=None, help='Also write the JSON results to this file')
+    e2e.add_argument('--baseline', default=None, help='Earlier --output file to compare against')
+    e2e.add_argument('--threshold', type=float, default=0.15, help='Allowed relative slowdown')
+
+    storage = subparsers.add_parser('storage', help='Bytes, encode cost and write throughput per storage mode')
+    storage.add_argument('--images', type=int, default=200, help='Images per mode (12 MP uses a fifth)')
+    storage.add_argument('--quality', type=int, default=None, help='JPEG/WebP quality (default: JPEG_QUALITY)')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'preprocess':
+        results, printer = bench_preprocess(args.runs), print_preprocess
+    elif args.command == 'db-writers':
+        results, printer = bench_db_writers(args.processes, args.writes), print_db_writers
+    elif args.command == 'image-store':
+        results, printer = bench_image_store(args.rows, args.duplicates), print_image_store
+    elif args.command == 'history':
+        results, printer = bench_history(args.rows, args.pages), print_history
+    elif args.command == 'model-load':
+        results, printer = bench_model_load(args.workers, args.model), print_model_load
+    elif args.command == 'dataset':
+        results, printer = bench_dataset(args.images, args.data), print_dataset
+    elif args.command == 'storage':
+        results, printer = bench_storage(args.images, quality=args.quality), print_storage
+    elif args.command == 'e2e':
+        results = bench_e2e(args.runs, args.gunicorn, args.stub, args.duration, args.baseline, args.threshold)
+        printer = print_e2e
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        printer(results)
+    if isinstance(results, dict) and results.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+cache.py
+
+In-process caches shared by the request handlers.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+class ByteLRUCache:
+    """
+    Thread-safe LRU cache of bytes values bounded by total size.
+
+    Values larger than max_item_bytes are never cached so a single large
+    object can't flush everything else out.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_item_bytes=1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = min(max_item_bytes, max_bytes)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value: bytes):
+        size = len(value)
+        if size > self.max_item_bytes:
+            return
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= len(previous)
+            self._items[key] = value
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.current_bytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'items': len(self._items),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+def content_key(pixels: np.ndarray) -> bytes:
+    """Exact key for a 48x48 uint8 model image."""
+    return hashlib.blake2b(np.ascontiguousarray(pixels).tobytes(), digest_size=16).digest()
+
+
+def perceptual_key(pixels: np.ndarray) -> int:
+    """64-bit difference hash (dHash) of a model image."""
+    small = cv2.resize(pixels, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+class PredictionCache:
+    """
+    Thread-safe LRU cache of model outputs keyed by the 48x48 model input.
+
+    The model only ever sees the uint8 48x48 image, so two inputs that
+    reduce to the same pixels give the same output and the forward pass can
+    be skipped. Entries older than ttl seconds are treated as misses.
+
+    With perceptual=True keys are 64-bit dHashes instead, and a lookup also
+    matches any of the scan_limit most recent entries within tolerance
+    differing bits. That suits webcam streams, where consecutive frames of
+    a still face differ only by sensor noise.
+    """
+
+    def __init__(self, max_items=4096, ttl=None, perceptual=False, tolerance=0, scan_limit=256):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.perceptual = perceptual
+        self.tolerance = tolerance if perceptual else 0
+        self.scan_limit = scan_limit
+        self._items = OrderedDict()  # key -> (stored_at, index, probabilities)
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def key(self, pixels: np.ndarray):
+        return perceptual_key(pixels) if self.perceptual else content_key(pixels)
+
+    def _entry_bytes(self, key, probabilities):
+        return (len(key) if isinstance(key, bytes) else 8) + probabilities.nbytes
+
+    def _remove(self, key):
+        _, _, probabilities = self._items.pop(key)
+        self.current_bytes -= self._entry_bytes(key, probabilities)
+
+    def _find_near(self, key, now):
+        scanned = 0
+        for candidate in reversed(self._items):
+            if scanned >= self.scan_limit:
+                break
+            scanned += 1
+            if (candidate ^ key).bit_count() <= self.tolerance:
+                stored_at = self._items[candidate][0]
+                if self.ttl is None or now - stored_at <= self.ttl:
+                    return candidate
+        return None
+
+    def get(self, pixels: np.ndarray):
+        """Return (class index, probabilities) for pixels, or None."""
+        key = self.key(pixels)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None and self.ttl is not None and now - entry[0] > self.ttl:
+                self._remove(key)
+                self.expired += 1
+                entry = None
+            if entry is None and self.tolerance:
+                near = self._find_near(key, now)
+                if near is not None:
+                    key, entry = near, self._items[near]
+                    self.near_hits += 1
+            if entry is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, pixels: np.ndarray, index: int, probabilities: np.ndarray):
+        key = self.key(pixels)
+        # Copy so a cached row doesn't keep the whole output batch alive
+        probabilities = np.array(probabilities, copy=True)
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (time.monotonic(), int(index), probabilities)
+            self.current_bytes += self._entry_bytes(key, probabilities)
+            while len(self._items) > self.max_items:
+                self._remove(next(iter(self._items)))
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'mode': 'perceptual' if self.perceptual else 'exact',
+                'items': len(self._items),
+                'max_items': self.max_items,
+                'bytes': self.current_bytes,
+                'hits': self.hits,
+                'near_hits': self.near_hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+class SessionStore:
+    """
+    Thread-safe per-session state, created on first use.
+
+    Sessions unused for idle_timeout seconds are dropped, as are the least
+    recently used ones beyond max_sessions.
+    """
+
+    def __init__(self, factory, max_sessions=10000, idle_timeout=120.0):
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self._sessions = OrderedDict()  # session id -> (last used, state)
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    def get(self, session_id):
+        """Return the state for session_id, creating it if needed."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            state = entry[1] if entry is not None else self.factory()
+            self._sessions[session_id] = (now, state)
+            # Least recently used first, so stop at the first one still in use
+            while self._sessions:
+                oldest_id, (last_used, _) = next(iter(self._sessions.items()))
+                if len(self._sessions) <= self.max_sessions and now - last_used <= self.idle_timeout:
+                    break
+                del self._sessions[oldest_id]
+                self.evicted += 1
+            return state
+
+    def discard(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
@@ -0,0 +1,163 @@
+"""
+dataset.py
+
+Parallel, cached loader for the training images.
+
+The dataset is a folder per class. Images are decoded and resized to 48x48
+grayscale in a process pool; workers write their rows straight into one
+preallocated uint8 (N, 2304) .npy file, so nothing is copied back through
+the pool and the array is a quarter of the size of the float64 one.
+
+The file is kept as a cache keyed by a manifest of the directory (every
+file's path, size and mtime). Later runs on an unchanged directory just
+memory-map it and skip decoding; adding, removing or touching an image
+produces a new key and a fresh decode, which replaces the old entry.
+
+Usage:
+    python dataset.py DATA_DIR [--cache-dir dataset_cache] [--workers N]
+"""
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+IMG_SIZE = 48
+CACHE_DIR = os.environ.get('DATASET_CACHE_DIR', 'dataset_cache')
+CHUNK_SIZE = 256  # Images per pool task
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.webp', '.tif', '.tiff')
+
+
+def scan(data_dir):
+    """
+    List the dataset: (class names, [(path, label)], manifest digest).
+
+    Classes are sorted folder names, as in the original loader.
+    """
+    classes = sorted(name for name in os.listdir(data_dir)
+                     if os.path.isdir(os.path.join(data_dir, name)))
+    files = []
+    manifest = hashlib.sha256(f'{IMG_SIZE}\n'.encode())
+    for label, name in enumerate(classes):
+        class_dir = os.path.join(data_dir, name)
+        for entry in sorted(os.scandir(class_dir), key=lambda e: e.name):
+            if not entry.is_file() or not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            stat = entry.stat()
+            manifest.update(f'{name}/{entry.name}\t{stat.st_size}\t{stat.st_mtime_ns}\n'.encode())
+            files.append((entry.path, label))
+    return classes, files, manifest.hexdigest()
+
+
+def _decode_chunk(array_path, start, paths):
+    """Pool task: decode paths into rows [start, start + len(paths)); returns failed rows."""
+    cv2.setNumThreads(1)  # The pool already uses every core
+    X = np.load(array_path, mmap_mode='r+')
+    failed = []
+    for offset, path in enumerate(paths):
+        img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            failed.append(start + offset)
+            continue
+        X[start + offset] = cv2.resize(img, (IMG_SIZE, IMG_SIZE)).reshape(-1)
+    X.flush()
+    return failed
+
+
+def _cache_paths(cache_dir, key):
+    base = os.path.join(cache_dir, key[:32])
+    return base + '.X.npy', base + '.y.npy', base + '.json'
+
+
+def _prune(cache_dir, data_dir, keep_meta_path):
+    """Delete older cache entries for data_dir."""
+    for name in os.listdir(cache_dir):
+        meta_path = os.path.join(cache_dir, name)
+        if not name.endswith('.json') or meta_path == keep_meta_path:
+            continue
+        try:
+            with open(meta_path) as f:
+                if json.load(f).get('data_dir') != data_dir:
+                    continue
+        except (OSError, ValueError):
+            continue
+        base = meta_path[:-len('.json')]
+        for path in (meta_path, base + '.X.npy', base + '.y.npy'):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def load_dataset(data_dir, cache_dir=CACHE_DIR, workers=None, progress=None):
+    """
+    Return (X, y, classes) for data_dir.
+
+    X is a read-only memory-mapped uint8 array of shape (N, 2304), y the
+    int64 labels. Unreadable images are left out.
+    """
+    classes, files, key = scan(data_dir)
+    x_path, y_path, meta_path = _cache_paths(cache_dir, key)
+    if os.path.exists(meta_path):
+        return np.load(x_path, mmap_mode='r'), np.load(y_path), classes
+
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_path = x_path + '.tmp.npy'
+    X = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.uint8,
+                                  shape=(len(files), IMG_SIZE * IMG_SIZE))
+    del X  # Workers write through their own mappings
+    y = np.array([label for _, label in files], dtype=np.int64)
+
+    failed = []
+    chunks = [(start, [path for path, _ in files[start:start + CHUNK_SIZE]])
+              for start in range(0, len(files), CHUNK_SIZE)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_decode_chunk, temp_path, start, paths) for start, paths in chunks]
+        for done, future in enumerate(futures, 1):
+            failed.extend(future.result())
+            if progress:
+                progress(min(done * CHUNK_SIZE, len(files)), len(files))
+
+    if failed:
+        keep = np.ones(len(files), dtype=bool)
+        keep[failed] = False
+        np.save(x_path, np.load(temp_path, mmap_mode='r')[keep])
+        os.remove(temp_path)
+        y = y[keep]
+    else:
+        os.replace(temp_path, x_path)
+    np.save(y_path, y)
+
+    # Written last: its presence marks a complete cache entry
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump({'data_dir': os.path.abspath(data_dir), 'classes': classes,
+                   'samples': int(len(y)), 'skipped': len(failed)}, f, indent=2)
+    os.replace(meta_path + '.tmp', meta_path)
+    _prune(cache_dir, os.path.abspath(data_dir), meta_path)
+    return np.load(x_path, mmap_mode='r'), y, classes
+
+
+def to_features(X, chunk_rows=8192):
+    """Scale uint8 pixels to float32 in [0, 1], a chunk at a time."""
+    features = np.empty(X.shape, dtype=np.float32)
+    for start in range(0, len(X), chunk_rows):
+        np.multiply(X[start:start + chunk_rows], np.float32(1 / 255.0),
+                    out=features[start:start + chunk_rows], casting='unsafe')
+    return features
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Decode and cache a training image folder')
+    parser.add_argument('data_dir')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    X, y, classes = load_dataset(args.data_dir, args.cache_dir, args.workers,
+                                 progress=lambda done, total: print(f"   Decoded {done}/{total}", end='\r'))
+    print(f"\n✅ {len(y)} images, {len(classes)} classes {classes} "
+          f"in {time.perf_counter() - started:.2f}s ({X.nbytes / (1024 * 1024):.1f} MB uint8)")
@@ -0,0 +1,291 @@
+"""
+db.py
+
+Shared SQLite access layer for the app and the maintenance scripts.
+
+Connections are pooled per thread (and per process, so forked gunicorn
+workers never reuse the master's handles) and configured for concurrent use:
+WAL journaling, synchronous=NORMAL, a larger page cache, memory-mapped I/O,
+a statement cache for prepared statements and a busy timeout. Writes go
+through transaction(), which takes the write lock up front with
+BEGIN IMMEDIATE and retries with backoff while another worker holds it.
+"""
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+DB_FILE = 'emotion_detection.db'
+
+BUSY_TIMEOUT_MS = 5000           # SQLite's own busy handler per statement
+CACHE_SIZE_KB = 16 * 1024        # Page cache per connection
+MMAP_SIZE = 256 * 1024 * 1024    # Memory-mapped I/O window
+STATEMENT_CACHE_SIZE = 256       # Prepared statements kept per connection
+LOCK_RETRIES = 8                 # Extra attempts for BEGIN IMMEDIATE after busy timeout
+
+_local = threading.local()
+
+
+def connect(db_file=DB_FILE) -> sqlite3.Connection:
+    """Open a new connection with the shared pragmas applied."""
+    conn = sqlite3.connect(
+        db_file,
+        timeout=BUSY_TIMEOUT_MS / 1000.0,
+        isolation_level=None,  # Autocommit; writes use transaction()
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    return conn
+
+
+def get_connection(db_file=DB_FILE) -> sqlite3.Connection:
+    """Return this thread's pooled connection for db_file, opening it if needed."""
+    pool = getattr(_local, 'pool', None)
+    if pool is None or _local.pid != os.getpid():
+        # Fresh thread, or a forked child holding the parent's handles
+        pool = _local.pool = {}
+        _local.pid = os.getpid()
+
+    conn = pool.get(db_file)
+    if conn is None:
+        conn = pool[db_file] = connect(db_file)
+    return conn
+
+
+def close_connections():
+    """Close this thread's pooled connections."""
+    pool = getattr(_local, 'pool', None)
+    if pool and _local.pid == os.getpid():
+        for conn in pool.values():
+            conn.close()
+    _local.pool = {}
+    _local.pid = os.getpid()
+
+
+def _is_busy(error: sqlite3.OperationalError) -> bool:
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+
+@contextmanager
+def transaction(conn: sqlite3.Connection, immediate=True):
+    """
+    Run a block inside one transaction, committing on success.
+
+    BEGIN IMMEDIATE takes the write lock before any reads, so two writers
+    can't deadlock upgrading read locks; if the busy timeout still expires,
+    the BEGIN is retried with jittered exponential backoff.
+    """
+    begin = "BEGIN IMMEDIATE" if immediate else "BEGIN"
+    for attempt in range(LOCK_RETRIES + 1):
+        try:
+            conn.execute(begin)
+            break
+        except sqlite3.OperationalError as e:
+            if not _is_busy(e) or attempt == LOCK_RETRIES:
+                raise
+            time.sleep(min(0.01 * 2 ** attempt, 1.0) * random.uniform(0.5, 1.5))
+
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    else:
+        conn.execute("COMMIT")
+
+
+# Tables holding large BLOBs. SQLite reads a row's columns in order, and a
+# big BLOB spills into overflow pages, so any column declared after it can
+# only be reached by walking the whole BLOB. The BLOB column goes last.
+BLOB_TABLES = {
+    'images': """
+                hash TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                created_at TEXT NOT NULL,
+                data BLOB NOT NULL
+            """,
+    'image_variants': """
+                hash TEXT NOT NULL,
+                max_side INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (hash, max_side)
+            """,
+}
+
+
+def create_tables(conn: sqlite3.Connection):
+    """Create the app's tables if they don't exist."""
+    if conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone() is None:
+        # Lets retention.py give space back a few pages at a time. The WAL
+        # switch in connect() already initialized the file, so the setting
+        # needs a VACUUM, which is instant while the database is empty.
+        # Older databases are converted by migrate_database.py --vacuum.
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+
+    with transaction(conn):
+        # Table 1: predictions - stores all prediction results; the image
+        # itself lives in `images` under its content hash
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS predictions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_name TEXT NOT NULL,
+                image_path TEXT,
+                image_hash TEXT,
+                predicted_emotion TEXT NOT NULL,
+                confidence REAL NOT NULL,
+                all_probabilities TEXT,
+                timestamp TEXT NOT NULL,
+                source TEXT NOT NULL,
+                upload_id INTEGER,
+                face_box TEXT,
+                storage_mode TEXT
+            )
+        """)
+
+        # Table 2: users - tracks users (optional, for statistics)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                first_used TEXT NOT NULL,
+                total_predictions INTEGER DEFAULT 0
+            )
+        """)
+
+        # Table 3: model_info - stores model training information
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS model_info (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                model_name TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                accuracy REAL,
+                epochs INTEGER,
+                description TEXT
+            )
+        """)
+
+        # Table 4: images - content-addressed image bytes, stored once per hash
+        conn.execute(f"CREATE TABLE IF NOT EXISTS images ({BLOB_TABLES['images']})")
+
+        # Table 5: image_variants - derived images (thumbnails), evicted
+        # oldest-first once they exceed their size budget
+        conn.execute(f"CREATE TABLE IF NOT EXISTS image_variants ({BLOB_TABLES['image_variants']})")
+
+        # Table 6: uploads - one row per submitted image; each face found in
+        # it is a predictions row pointing here through upload_id
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS uploads (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_name TEXT NOT NULL,
+                image_path TEXT,
+                image_hash TEXT,
+                face_count INTEGER NOT NULL DEFAULT 0,
+                timestamp TEXT NOT NULL,
+                source TEXT NOT NULL
+            )
+        """)
+
+        # Table 7: image_archive - images moved out of `images` into
+        # append-only segment files by the retention job
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS image_archive (
+                hash TEXT PRIMARY KEY,
+                segment TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                codec INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                archived_at TEXT NOT NULL
+            )
+        """)
+
+        # Oldest-first scans for retention; covering, so they never read the
+        # image data itself
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_images_created
+            ON images(created_at, size, hash)
+        """)
+
+
+# Columns added to predictions after its first release: name -> type
+PREDICTION_COLUMNS = {
+    'upload_id': 'INTEGER',
+    'face_box': 'TEXT',
+    'storage_mode': 'TEXT',  # NULL: written before storage modes, i.e. 'jpeg'
+}
+
+
+def migrate_prediction_columns(conn: sqlite3.Connection):
+    """Add predictions columns missing from databases created by older versions."""
+    with transaction(conn):
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(predictions)")}
+        for name, column_type in PREDICTION_COLUMNS.items():
+            if name not in existing:
+                conn.execute(f"ALTER TABLE predictions ADD COLUMN {name} {column_type}")
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_predictions_upload
+            ON predictions(upload_id) WHERE upload_id IS NOT NULL
+        """)
+
+
+def migrate_blob_columns(conn: sqlite3.Connection) -> list:
+    """
+    Rebuild BLOB_TABLES created by older versions with their BLOB column last.
+
+    Copies the table (keeping rowids) in one transaction and recreates its
+    indexes and triggers. Returns the names of the tables rebuilt.
+    """
+    rebuilt = []
+    for table, columns in BLOB_TABLES.items():
+        with transaction(conn):
+            existing = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+            if not existing or existing[-1] == 'data':
+                continue
+
+            dependents = [sql for (sql,) in conn.execute("""
+                SELECT sql FROM sqlite_master
+                WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL
+            """, (table,))]
+            names = ', '.join(existing)
+            conn.execute(f"CREATE TABLE {table}_rebuild ({columns})")
+            conn.execute(f"""
+                INSERT INTO {table}_rebuild (rowid, {names})
+                SELECT rowid, {names} FROM {table}
+            """)
+            conn.execute(f"DROP TABLE {table}")
+            # Triggers on other tables (the statistics ones) name this table;
+            # the legacy rename doesn't re-check them while it's missing
+            conn.execute("PRAGMA legacy_alter_table=ON")
+            try:
+                conn.execute(f"ALTER TABLE {table}_rebuild RENAME TO {table}")
+            finally:
+                conn.execute("PRAGMA legacy_alter_table=OFF")
+            for sql in dependents:
+                conn.execute(sql)
+        rebuilt.append(table)
+    return rebuilt
+
+
+def ensure_schema(conn: sqlite3.Connection, progress=None):
+    """Create missing tables and migrate databases written by older versions."""
+    from image_store import migrate_inline_images
+    from aggregates import create_statistics_tables, rebuild_statistics
+    from history import create_history_indexes
+
+    create_tables(conn)
+    migrate_blob_columns(conn)
+    migrate_prediction_columns(conn)
+    migrate_inline_images(conn, progress=progress)
+    create_history_indexes(conn)
+    if create_statistics_tables(conn):
+        rebuild_statistics(conn)
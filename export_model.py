@@ -0,0 +1,43 @@
+"""
+export_model.py
+
+Export the trained sklearn model as memory-mappable float32 weights.
+
+Writes one .npy file per weight matrix and bias vector plus meta.json
+(labels, input shape, normalization, source checksum) into the output
+directory. The app loads this directory with mmap instead of unpickling
+model.pkl, so sklearn is never imported while serving.
+
+Usage:
+    python export_model.py [model.pkl] [model_weights]
+"""
+import argparse
+
+import joblib
+
+from inference import InferenceEngine, export_weights, load_weights, verify_against_sklearn
+
+EMOTION_LABELS = ['Angry', 'Fear', 'Happy', 'Sad', 'Suprise']
+
+
+def export(model_path='model.pkl', output_dir='model_weights', labels=EMOTION_LABELS):
+    """Export model_path to output_dir and check the result against sklearn."""
+    print(f"📦 Exporting {model_path} -> {output_dir}/")
+    model = joblib.load(model_path)
+    export_weights(InferenceEngine.from_sklearn(model), output_dir,
+                   labels=labels, source_path=model_path)
+
+    engine, meta = load_weights(output_dir)
+    report = verify_against_sklearn(model, engine)
+    print(f"   Layers:        {[layer['shape'] for layer in meta['layers']]}")
+    print(f"   Max |Δ proba|: {report['max_abs_diff']:.2e}")
+    print("✅ Export verified" if report['passed'] else "❌ Exported weights don't match the model")
+    return report['passed']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export model.pkl as memory-mapped weights')
+    parser.add_argument('model_path', nargs='?', default='model.pkl')
+    parser.add_argument('output_dir', nargs='?', default='model_weights')
+    args = parser.parse_args()
+    raise SystemExit(0 if export(args.model_path, args.output_dir) else 1)
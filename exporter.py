@@ -0,0 +1,380 @@
+"""
+exporter.py
+
+Streaming export of the predictions table as CSV, JSON Lines, Parquet or
+Arrow.
+
+Rows are read with fetchmany() in id order and encoded a batch at a time, so
+memory stays flat however large the table is. CSV and JSON Lines can be
+gzipped on the fly; Parquet (one row group per ROW_GROUP_ROWS rows) and the
+Arrow IPC stream need pyarrow, imported only when one of them is asked for.
+
+Filters: since/until (ISO timestamps, inclusive / exclusive, as in /history)
+and after_id. Every export is bounded by the highest id present when it
+started; last_id is the highest id it contains below until. Ids are not a
+safe cursor: with several gunicorn workers they are reserved in blocks (see
+persistence.py), and the write-behind queue commits rows some time after
+they were stamped, so a lower id can be committed after a higher one has
+been exported. Incremental exports (--state, and /export by default)
+therefore advance by time: each one stops at a cutoff SETTLE_SECONDS in the
+past (settled_until()) and the next one starts at that cutoff.
+
+Usage:
+    python exporter.py [--format csv|jsonl|parquet|arrow] [--gzip] [-o FILE|-]
+                       [--since TS] [--until TS] [--after-id N] [--state FILE]
+"""
+import csv
+import io
+import json
+import os
+import sqlite3
+import sys
+import zlib
+from datetime import datetime, timedelta
+
+BATCH_SIZE = 1000           # Rows per fetchmany()
+ROW_GROUP_ROWS = 50_000     # Rows per Parquet row group
+SETTLE_SECONDS = 60         # How far behind now --state exports stop
+
+EXPORT_COLUMNS = [
+    'id', 'user_name', 'image_path', 'image_hash', 'predicted_emotion', 'confidence',
+    'all_probabilities', 'timestamp', 'source', 'upload_id', 'face_box', 'storage_mode',
+]
+JSON_COLUMNS = ('all_probabilities', 'face_box')  # Stored as JSON text
+
+# format -> (media type, file extension, text format that can be gzipped)
+FORMATS = {
+    'csv': ('text/csv; charset=utf-8', '.csv', True),
+    'jsonl': ('application/x-ndjson', '.jsonl', True),
+    'parquet': ('application/vnd.apache.parquet', '.parquet', False),
+    'arrow': ('application/vnd.apache.arrow.stream', '.arrows', False),
+}
+
+
+class ExportError(ValueError):
+    """Invalid export format or filter."""
+
+
+def iter_batches(conn: sqlite3.Connection, since=None, until=None, after_id=None,
+                 max_id=None, batch_size=BATCH_SIZE):
+    """Yield lists of predictions rows (tuples in EXPORT_COLUMNS order), by id."""
+    conditions = []
+    params = []
+    if after_id is not None:
+        conditions.append("id > ?")
+        params.append(after_id)
+    if max_id is not None:
+        conditions.append("id <= ?")
+        params.append(max_id)
+    if since:
+        conditions.append("timestamp >= ?")
+        params.append(since)
+    if until:
+        conditions.append("timestamp < ?")
+        params.append(until)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"""
+            SELECT {', '.join(EXPORT_COLUMNS)}
+            FROM predictions
+            {where}
+            ORDER BY id
+        """, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+
+
+# ==================== ENCODERS ====================
+
+def _csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def _json_value(column, value):
+    if column in JSON_COLUMNS and value is not None:
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
+
+
+def _jsonl_chunks(batches):
+    for rows in batches:
+        lines = [
+            json.dumps({column: _json_value(column, value) for column, value in zip(EXPORT_COLUMNS, row)})
+            for row in rows
+        ]
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ExportError('Parquet and Arrow export need pyarrow: pip install pyarrow')
+    return pyarrow
+
+
+def _arrow_schema(pa):
+    types = {'id': pa.int64(), 'confidence': pa.float64(), 'upload_id': pa.int64()}
+    return pa.schema([(column, types.get(column, pa.string())) for column in EXPORT_COLUMNS])
+
+
+def _arrow_table(pa, schema, rows):
+    columns = list(zip(*rows)) if rows else [()] * len(EXPORT_COLUMNS)
+    return pa.Table.from_arrays([pa.array(values, type=field.type)
+                                 for values, field in zip(columns, schema)], schema=schema)
+
+
+class _ChunkSink:
+    """Write-only file object that hands out what was written since the last take()."""
+
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _parquet_chunks(batches):
+    pa = _import_pyarrow()
+    import pyarrow.parquet as pq
+    schema = _arrow_schema(pa)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='snappy')
+    # Each batch is converted as it arrives; Arrow columns are far smaller
+    # than the row tuples, and row groups still get ROW_GROUP_ROWS rows
+    pending, pending_rows = [], 0
+    for rows in batches:
+        pending.append(_arrow_table(pa, schema, rows))
+        pending_rows += len(rows)
+        if pending_rows >= ROW_GROUP_ROWS:
+            writer.write_table(pa.concat_tables(pending), row_group_size=pending_rows)
+            pending, pending_rows = [], 0
+            yield sink.take()
+    if pending:
+        writer.write_table(pa.concat_tables(pending), row_group_size=pending_rows)
+    writer.close()
+    yield sink.take()
+
+
+def _arrow_chunks(batches):
+    pa = _import_pyarrow()
+    schema = _arrow_schema(pa)
+    sink = _ChunkSink()
+    writer = pa.ipc.new_stream(sink, schema)
+    for rows in batches:
+        writer.write_table(_arrow_table(pa, schema, rows))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+ENCODERS = {'csv': _csv_chunks, 'jsonl': _jsonl_chunks, 'parquet': _parquet_chunks, 'arrow': _arrow_chunks}
+
+
+def _gzip_chunks(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# ==================== EXPORT ====================
+
+def settled_until(settle=SETTLE_SECONDS) -> str:
+    """Cutoff before which every prediction has been committed (UTC, as stored)."""
+    return (datetime.utcnow() - timedelta(seconds=settle)).isoformat()
+
+
+def _parse_id(value):
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ExportError(f'Invalid after_id: {value}')
+
+
+def _parse_timestamp(value, name):
+    if not value:
+        return None
+    try:
+        datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ExportError(f'Invalid {name}: {value}')
+    return value
+
+
+class Export:
+    """
+    One export, validated up front so errors surface before any output.
+
+    last_id is the highest id this export can contain below until (after_id
+    if there is nothing newer). chunks() yields the encoded bytes; rows
+    counts the rows written so far.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, fmt='csv', compress=False, since=None,
+                 until=None, after_id=None, batch_size=BATCH_SIZE):
+        if fmt not in FORMATS:
+            raise ExportError(f"Unknown format: {fmt} (choose from {', '.join(FORMATS)})")
+        media_type, extension, text = FORMATS[fmt]
+        if compress and not text:
+            raise ExportError(f'{fmt} is compressed internally; gzip applies to csv and jsonl')
+        if not text:
+            _import_pyarrow()
+
+        self.conn = conn
+        self.format = fmt
+        self.compress = compress
+        self.since = _parse_timestamp(since, 'since')
+        self.until = _parse_timestamp(until, 'until')
+        self.after_id = _parse_id(after_id)
+        self.batch_size = batch_size
+        self.media_type = 'application/gzip' if compress else media_type
+        self.extension = extension + ('.gz' if compress else '')
+        self.rows = 0
+
+        max_id = conn.execute("SELECT MAX(id) FROM predictions").fetchone()[0]
+        self.max_id = max_id
+        if self.until and max_id is not None:
+            # Walk ids down from the top (the + keeps the planner off the
+            # timestamp index), so only rows newer than until are read
+            row = conn.execute("""
+                SELECT id FROM predictions WHERE +timestamp < ? ORDER BY id DESC LIMIT 1
+            """, (self.until,)).fetchone()
+            max_id = row[0] if row else None
+        self.last_id = max(max_id or 0, self.after_id or 0)
+
+    def filename(self, prefix='predictions_export'):
+        return f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}{self.extension}"
+
+    def _counted(self, batches):
+        for rows in batches:
+            self.rows += len(rows)
+            yield rows
+
+    def chunks(self):
+        batches = iter_batches(self.conn, self.since, self.until, self.after_id,
+                               self.max_id if self.max_id is not None else 0, self.batch_size)
+        chunks = ENCODERS[self.format](self._counted(batches))
+        return _gzip_chunks(chunks) if self.compress else chunks
+
+    def write_to(self, f) -> int:
+        """Write the whole export to a binary file object; returns the row count."""
+        for chunk in self.chunks():
+            f.write(chunk)
+        return self.rows
+
+
+def _read_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        raise ExportError(f'Unreadable state file: {path}')
+
+
+def _write_state(path, state):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def main(argv=None):
+    import argparse
+
+    from db import DB_FILE, connect
+
+    parser = argparse.ArgumentParser(description='Export predictions as CSV, JSON Lines, Parquet or Arrow')
+    parser.add_argument('--format', default='csv', choices=list(FORMATS))
+    parser.add_argument('--gzip', action='store_true', help='Gzip csv / jsonl output')
+    parser.add_argument('-o', '--output', default=None, help="Output file, '-' for stdout (default: timestamped name)")
+    parser.add_argument('--since', default=None, help='Only rows at or after this ISO timestamp')
+    parser.add_argument('--until', default=None, help='Only rows before this ISO timestamp')
+    parser.add_argument('--after-id', default=None, help='Only rows with a higher id')
+    parser.add_argument('--state', default=None,
+                        help='Incremental export: start where the previous run with this state file stopped')
+    parser.add_argument('--settle', type=float, default=SETTLE_SECONDS,
+                        help='With --state, leave out rows newer than this many seconds')
+    parser.add_argument('--db', default=DB_FILE)
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        print(f"❌ Database not found: {args.db}", file=sys.stderr)
+        return 1
+
+    since, until = args.since, args.until
+    state = None
+    if args.state:
+        state = _read_state(args.state)
+        since = since or state.get('until')
+        until = until or settled_until(args.settle)
+
+    conn = connect(args.db)
+    try:
+        export = Export(conn, args.format, args.gzip, since, until, args.after_id)
+        if args.output == '-':
+            export.write_to(sys.stdout.buffer)
+            output = 'stdout'
+        else:
+            output = args.output or export.filename()
+            with open(output + '.part', 'wb') as f:
+                export.write_to(f)
+            os.replace(output + '.part', output)
+    except ExportError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 2
+    finally:
+        conn.close()
+
+    if state is not None:
+        _write_state(args.state, {'until': until, 'last_id': export.last_id, 'rows': export.rows})
+    print(f"✅ Exported {export.rows} predictions to: {output} (last id {export.last_id})", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,192 @@
+"""
+faces.py
+
+Face localization ahead of the 48x48 model input.
+
+Resizing a whole webcam frame to 48x48 leaves the face a few pixels wide.
+FaceDetector finds faces with OpenCV's bundled Haar cascade on a copy
+downscaled to at most DETECT_MAX_PIXELS, and the model is fed a square crop
+around the face from the decoded grayscale image instead.
+FaceTracker follows a webcam session's face between frames by searching
+only around the previous box, with a full-frame detection every few frames.
+
+The cascade ships with opencv-python(-headless) 4.x. If it can't be loaded
+the detector reports itself unavailable and callers fall back to the whole
+image.
+"""
+import os
+import threading
+import time
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+CASCADE_FILE = 'haarcascade_frontalface_default.xml'
+DETECT_MAX_PIXELS = 320 * 320  # Detection runs on a copy no larger than this
+MIN_FACE_FRACTION = 0.12  # Smallest face, relative to the shorter side
+TRACK_FACE_SIDE = 48  # A tracked face is searched for at about this size
+FACE_MARGIN = 0.15  # Padding around the detected box on each side
+
+FaceBox = namedtuple('FaceBox', ['x', 'y', 'w', 'h'])
+
+FaceDetection = namedtuple('FaceDetection', ['boxes', 'elapsed_ms', 'tracked'])
+FaceDetection.__doc__ = """
+Result of one detection.
+
+boxes:      FaceBox list in image coordinates, largest first
+elapsed_ms: detector time for this image
+tracked:    True if only the region around a tracked face was searched
+"""
+
+
+def _cascade_path(cascade_file):
+    data = getattr(cv2, 'data', None)
+    directory = getattr(data, 'haarcascades', '')
+    return os.path.join(directory, cascade_file)
+
+
+class FaceDetector:
+    """
+    Haar cascade face detector, loaded once per worker thread.
+
+    CascadeClassifier isn't safe to share between threads, so each thread
+    that detects gets its own copy on first use.
+    """
+
+    def __init__(self, cascade_file=CASCADE_FILE, max_pixels=DETECT_MAX_PIXELS,
+                 min_face_fraction=MIN_FACE_FRACTION, scale_factor=1.2, min_neighbors=5):
+        self.cascade_path = _cascade_path(cascade_file)
+        self.max_pixels = max_pixels
+        self.min_face_fraction = min_face_fraction
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.available = hasattr(cv2, 'CascadeClassifier') and os.path.exists(self.cascade_path)
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.faces_found = 0
+        self.total_ms = 0.0
+
+    def _cascade(self):
+        cascade = getattr(self._local, 'cascade', None)
+        if cascade is None:
+            cascade = cv2.CascadeClassifier(self.cascade_path)
+            if cascade.empty():
+                raise RuntimeError(f'Could not load face cascade: {self.cascade_path}')
+            self._local.cascade = cascade
+        return cascade
+
+    def detect(self, gray: np.ndarray, region: FaceBox = None, face_side=None) -> FaceDetection:
+        """
+        Find faces in gray, largest first.
+
+        With region and face_side (the expected face width) only that region
+        is searched, scaled so the face is about TRACK_FACE_SIDE pixels and
+        only face sizes close to it are tried. That is several times cheaper
+        than a full-frame search.
+        """
+        if not self.available:
+            return FaceDetection([], 0.0, False)
+
+        start = time.perf_counter()
+        tracked = region is not None and face_side is not None
+        offset_x = offset_y = 0
+        if region is not None:
+            offset_x, offset_y = region.x, region.y
+            gray = gray[region.y:region.y + region.h, region.x:region.x + region.w]
+
+        height, width = gray.shape[:2]
+        if tracked:
+            scale = min(1.0, TRACK_FACE_SIDE / face_side)
+        else:
+            scale = min(1.0, (self.max_pixels / (height * width)) ** 0.5)
+        small = gray
+        if scale < 1.0:
+            small = cv2.resize(gray, (max(1, round(width * scale)), max(1, round(height * scale))),
+                               interpolation=cv2.INTER_AREA)
+        small = cv2.equalizeHist(small)
+
+        if tracked:
+            expected = face_side * scale
+            min_size = (max(int(expected * 0.7), 20),) * 2
+            max_size = (int(expected * 1.5) + 1,) * 2
+        else:
+            min_size = (max(int(min(small.shape[:2]) * self.min_face_fraction), 20),) * 2
+            max_size = (0, 0)  # No upper limit
+
+        found = self._cascade().detectMultiScale(
+            small, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors,
+            minSize=min_size, maxSize=max_size)
+
+        boxes = [
+            FaceBox(offset_x + round(x / scale), offset_y + round(y / scale),
+                    round(w / scale), round(h / scale))
+            for x, y, w, h in (found if len(found) else [])
+        ]
+        boxes.sort(key=lambda box: box.w * box.h, reverse=True)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        with self._lock:
+            self.calls += 1
+            self.faces_found += len(boxes)
+            self.total_ms += elapsed_ms
+        return FaceDetection(boxes, elapsed_ms, tracked)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'available': self.available,
+                'calls': self.calls,
+                'faces_found': self.faces_found,
+                'average_ms': self.total_ms / self.calls if self.calls else 0.0,
+            }
+
+
+class FaceTracker:
+    """
+    Follows the main face of a webcam session between frames.
+
+    While a face is being tracked only the area around its last box (grown
+    by roi_margin on each side) is searched; a full-frame detection runs
+    when the face is lost and every redetect_every frames.
+    """
+
+    __slots__ = ('redetect_every', 'roi_margin', 'box', 'frames_since_detect')
+
+    def __init__(self, redetect_every=10, roi_margin=0.5):
+        self.redetect_every = redetect_every
+        self.roi_margin = roi_margin
+        self.box = None
+        self.frames_since_detect = 0
+
+    def detect(self, detector: FaceDetector, gray: np.ndarray) -> FaceDetection:
+        if self.box is not None and self.frames_since_detect < self.redetect_every:
+            region = expand_box(self.box, self.roi_margin, gray.shape)
+            detection = detector.detect(gray, region=region, face_side=max(self.box.w, self.box.h))
+            if detection.boxes:
+                self.box = detection.boxes[0]
+                self.frames_since_detect += 1
+                return detection
+
+        detection = detector.detect(gray)
+        self.box = detection.boxes[0] if detection.boxes else None
+        self.frames_since_detect = 0
+        return detection
+
+
+def expand_box(box: FaceBox, margin: float, shape) -> FaceBox:
+    """Grow box by margin * size on each side, as a square clipped to the image."""
+    height, width = shape[:2]
+    side = round(max(box.w, box.h) * (1 + 2 * margin))
+    center_x, center_y = box.x + box.w / 2, box.y + box.h / 2
+    x = max(0, round(center_x - side / 2))
+    y = max(0, round(center_y - side / 2))
+    return FaceBox(x, y, min(side, width - x), min(side, height - y))
+
+
+def crop_face(gray: np.ndarray, box: FaceBox, margin=FACE_MARGIN) -> np.ndarray:
+    """Square crop around a face, padded by margin and clipped to the image."""
+    region = expand_box(box, margin, gray.shape)
+    return gray[region.y:region.y + region.h, region.x:region.x + region.w]
@@ -0,0 +1,114 @@
+"""
+gunicorn.conf.py
+
+Production launcher configuration: gunicorn -c gunicorn.conf.py app:app
+
+The app is imported once in the master (preload_app): the schema check,
+model loading and startup logging run a single time, and workers are forked
+from it so the model weights (memory-mapped, see export_model.py) and the
+imported libraries are shared copy-on-write instead of loaded per worker.
+
+Workers and threads are sized from the CPUs available to this process. Each
+worker's BLAS and OpenCV thread pools get an equal share of those CPUs, so
+workers x BLAS threads never exceeds the core count.
+
+Each worker writes its metrics snapshot to METRICS_DIR so /metrics can
+report all of them, whichever worker answers the scrape.
+
+Streaming sessions (/stream) live in the memory of the worker that opened
+them, and a session's frame uploads and event stream must reach that same
+process. With several workers /stream answers 503 instead of losing frames
+to other workers. STREAMING=1 opts into a single worker with more threads
+so /stream works, at the cost of running all inference in one process.
+
+Override with WEB_CONCURRENCY (workers), GUNICORN_THREADS (threads per
+worker), BLAS_THREADS and STREAMING=1 (one worker, /stream enabled).
+"""
+import gc
+import os
+import tempfile
+
+
+def available_cpus() -> int:
+    """CPUs this process may use: affinity mask, capped by a cgroup CPU quota."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:  # cgroup v2, e.g. "200000 100000"
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return max(1, cpus)
+
+
+CPUS = available_cpus()
+
+STREAMING = os.environ.get('STREAMING', '0') != '0'
+
+# Inference is CPU-bound, so one process per core; threads cover the time
+# requests spend in SQLite, image decoding and network I/O. A streaming
+# server (opt-in) keeps one process, and each open event stream holds a thread.
+workers = int(os.environ.get('WEB_CONCURRENCY', '1' if STREAMING else str(CPUS)))
+threads = int(os.environ.get('GUNICORN_THREADS', str(max(8, 4 * CPUS)) if workers == 1 and STREAMING else '4'))
+worker_class = 'gthread' if threads > 1 else 'sync'
+BLAS_THREADS = int(os.environ.get('BLAS_THREADS', str(max(1, CPUS // workers))))
+
+# BLAS libraries read these when NumPy is first imported, which happens
+# after this file is loaded, when the master preloads the app
+for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS'):
+    os.environ.setdefault(variable, str(BLAS_THREADS))
+
+# Read by the app: sessions only work when every request reaches one process
+os.environ['STREAMING'] = '1' if STREAMING and workers == 1 else '0'
+
+# Shared by the workers for /metrics; read when the app module is preloaded
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), f'emotion-metrics-{os.getpid()}'))
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+preload_app = True
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+# Recycle workers now and then so slow leaks can't accumulate
+max_requests = 5000
+max_requests_jitter = 500
+
+
+def on_starting(server):
+    from metrics import reset_directory
+    reset_directory()
+
+
+def when_ready(server):
+    # SQLite handles must not cross fork(): close the master's connections
+    # (opened by the startup schema check) before any worker is forked
+    from db import close_connections
+    close_connections()
+    # Move everything allocated so far out of the garbage collector's reach,
+    # so collections in the workers don't write to (and copy) shared pages
+    gc.freeze()
+    server.log.info(f"{CPUS} CPUs: {workers} workers x {threads} threads, "
+                    f"{BLAS_THREADS} BLAS thread(s) per worker")
+    if STREAMING and workers > 1:
+        server.log.warning("Streaming (/stream) is off: its sessions need WEB_CONCURRENCY=1")
+
+
+def post_fork(server, worker):
+    # Start from an empty connection pool; the writer and batcher threads
+    # start themselves on first use in this process
+    from db import close_connections
+    close_connections()
+
+    import cv2
+    cv2.setNumThreads(BLAS_THREADS)
+
+
+def child_exit(server, worker):
+    # Keep an exited worker's counters in the /metrics totals
+    from metrics import mark_process_dead
+    mark_process_dead(worker.pid)
@@ -0,0 +1,150 @@
+"""
+history.py
+
+Keyset-paginated, filterable prediction history.
+
+Pages are ordered by (timestamp, id) descending. Instead of OFFSET, each page
+returns an opaque cursor holding the (timestamp, id) of its last row, and the
+next page continues strictly after it. With the composite indexes created by
+create_history_indexes() every page is an index range scan, however deep.
+"""
+import base64
+import json
+import sqlite3
+
+from db import transaction
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+HISTORY_COLUMNS = """
+    id, user_name, image_path, predicted_emotion,
+    confidence, all_probabilities, timestamp, source, upload_id, face_box, storage_mode
+"""
+
+# Older init_database.py versions created these single-column indexes; the
+# composite ones below cover the same queries and also serve the sort.
+LEGACY_INDEXES = ['idx_predictions_timestamp', 'idx_predictions_user', 'idx_predictions_emotion']
+
+# Every index implicitly ends with the rowid (id), so each one is ordered
+# by (..., timestamp, id) and satisfies ORDER BY timestamp DESC, id DESC.
+HISTORY_INDEXES = {
+    'idx_predictions_time': 'predictions(timestamp)',
+    'idx_predictions_user_time': 'predictions(user_name, timestamp)',
+    'idx_predictions_emotion_time': 'predictions(predicted_emotion, timestamp)',
+    'idx_predictions_source_time': 'predictions(source, timestamp)',
+}
+
+
+class HistoryQueryError(ValueError):
+    """Invalid history filter or cursor."""
+
+
+def create_history_indexes(conn: sqlite3.Connection):
+    """Create the composite history indexes and drop the ones they replace."""
+    with transaction(conn):
+        for name in LEGACY_INDEXES:
+            conn.execute(f"DROP INDEX IF EXISTS {name}")
+        for name, definition in HISTORY_INDEXES.items():
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+    conn.execute("PRAGMA optimize")
+
+
+def encode_cursor(timestamp: str, prediction_id: int) -> str:
+    raw = json.dumps([timestamp, prediction_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        timestamp, prediction_id = json.loads(raw)
+        if not isinstance(timestamp, str) or not isinstance(prediction_id, int):
+            raise ValueError
+        return timestamp, prediction_id
+    except Exception:
+        raise HistoryQueryError('Invalid cursor')
+
+
+def _parse_float(value, name):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise HistoryQueryError(f'Invalid {name}: {value}')
+
+
+def query_history(conn: sqlite3.Connection, limit=DEFAULT_LIMIT, cursor=None, user=None,
+                  emotion=None, source=None, min_confidence=None, max_confidence=None,
+                  since=None, until=None):
+    """
+    Return (rows, next_cursor) for one page of history, newest first.
+
+    since/until are ISO timestamps (inclusive / exclusive); next_cursor is
+    None on the last page.
+    """
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise HistoryQueryError(f'Invalid limit: {limit}')
+    limit = max(1, min(limit, MAX_LIMIT))
+
+    conditions = []
+    params = []
+    for column, value in (('user_name', user), ('predicted_emotion', emotion), ('source', source)):
+        if value:
+            conditions.append(f"{column} = ?")
+            params.append(value)
+    if min_confidence not in (None, ''):
+        conditions.append("confidence >= ?")
+        params.append(_parse_float(min_confidence, 'min_confidence'))
+    if max_confidence not in (None, ''):
+        conditions.append("confidence <= ?")
+        params.append(_parse_float(max_confidence, 'max_confidence'))
+    if since:
+        conditions.append("timestamp >= ?")
+        params.append(since)
+    if until:
+        conditions.append("timestamp < ?")
+        params.append(until)
+    if cursor:
+        conditions.append("(timestamp, id) < (?, ?)")
+        params.extend(decode_cursor(cursor))
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    db_cursor = conn.cursor()
+    db_cursor.row_factory = sqlite3.Row
+    db_cursor.execute(f"""
+        SELECT {HISTORY_COLUMNS}
+        FROM predictions
+        {where}
+        ORDER BY timestamp DESC, id DESC
+        LIMIT ?
+    """, (*params, limit + 1))
+
+    rows = [dict(row) for row in db_cursor.fetchall()]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['timestamp'], rows[-1]['id'])
+    return rows, next_cursor
+
+
+def get_upload(conn: sqlite3.Connection, upload_id: int):
+    """Return an upload with its per-face predictions, or None."""
+    db_cursor = conn.cursor()
+    db_cursor.row_factory = sqlite3.Row
+    upload = db_cursor.execute("""
+        SELECT id, user_name, image_path, face_count, timestamp, source
+        FROM uploads WHERE id = ?
+    """, (upload_id,)).fetchone()
+    if upload is None:
+        return None
+
+    upload = dict(upload)
+    upload['faces'] = [dict(row) for row in db_cursor.execute(f"""
+        SELECT {HISTORY_COLUMNS}
+        FROM predictions
+        WHERE upload_id = ?
+        ORDER BY id
+    """, (upload_id,))]
+    return upload
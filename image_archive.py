@@ -0,0 +1,232 @@
+"""
+image_archive.py
+
+Append-only segment files for images moved out of the database.
+
+The retention job (retention.py) moves old images out of the images table
+into ARCHIVE_DIR/segment-NNNNNN.seg files. Each record is a small header
+(magic, codec, SHA-256, lengths) followed by the image bytes, zlib-compressed
+when that makes them smaller. Segments are only ever appended to, and a new
+one is started once the current one reaches SEGMENT_BYTES. The image_archive
+table maps each hash to its segment, offset and length, so /image can still
+serve an archived image with a single read.
+
+The headers make segments self-describing: reindex_archive() rebuilds the
+index from the files alone, and a record cut short by a crash is trimmed
+before the next append.
+"""
+import hashlib
+import os
+import sqlite3
+import struct
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+
+from db import transaction
+
+ARCHIVE_DIR = os.environ.get('IMAGE_ARCHIVE_DIR', 'image_archive')
+SEGMENT_BYTES = 256 * 1024 * 1024  # Start a new segment past this size
+COMPRESSION_LEVEL = 6
+
+MAGIC = b'EIMG'
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+# magic, codec, raw SHA-256, stored length, original size
+RECORD_HEADER = struct.Struct('<4sB32sII')
+
+
+class ArchiveError(Exception):
+    """An archived image is missing or doesn't match its hash."""
+
+
+def _segment_name(number: int) -> str:
+    return f'segment-{number:06d}.seg'
+
+
+def _segment_numbers(archive_dir):
+    numbers = []
+    for name in os.listdir(archive_dir):
+        if name.startswith('segment-') and name.endswith('.seg'):
+            try:
+                numbers.append(int(name[len('segment-'):-len('.seg')]))
+            except ValueError:
+                continue
+    return sorted(numbers)
+
+
+@contextmanager
+def archive_lock(archive_dir=ARCHIVE_DIR, blocking=True):
+    """
+    Hold the archive's writer lock; yields False if blocking=False and it is taken.
+
+    Only one process may append to the segments at a time. Without fcntl
+    (Windows) there is no cross-process lock, so run a single retention job.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    try:
+        import fcntl
+    except ImportError:
+        yield True
+        return
+    with open(os.path.join(archive_dir, '.lock'), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class SegmentWriter:
+    """
+    Appends image records to the newest segment; use under archive_lock().
+
+    append() buffers nothing: records go straight to the file. sync() must
+    be called (and succeed) before the index rows pointing at them are
+    committed, so the database never references bytes that aren't on disk.
+    """
+
+    def __init__(self, archive_dir=ARCHIVE_DIR, segment_bytes=SEGMENT_BYTES,
+                 compression_level=COMPRESSION_LEVEL):
+        self.archive_dir = archive_dir
+        self.segment_bytes = segment_bytes
+        self.compression_level = compression_level
+        os.makedirs(archive_dir, exist_ok=True)
+        numbers = _segment_numbers(archive_dir)
+        self.number = numbers[-1] if numbers else 1
+        self._file = None
+
+    def _open(self):
+        if self._file is None:
+            path = os.path.join(self.archive_dir, _segment_name(self.number))
+            if os.path.exists(path):
+                end = _complete_length(path)
+                if end < os.path.getsize(path):
+                    os.truncate(path, end)  # Drop a partial record left by a crash
+            self._file = open(path, 'ab')
+        return self._file
+
+    def append(self, key: str, data: bytes):
+        """Write one image; returns (segment, offset, length, codec) of its payload."""
+        f = self._open()
+        if f.tell() >= self.segment_bytes:
+            self.sync()
+            f.close()
+            self.number += 1
+            self._file = None
+            f = self._open()
+
+        codec, payload = CODEC_RAW, data
+        compressed = zlib.compress(data, self.compression_level)
+        if len(compressed) < len(data):
+            codec, payload = CODEC_ZLIB, compressed
+
+        f.write(RECORD_HEADER.pack(MAGIC, codec, bytes.fromhex(key), len(payload), len(data)))
+        offset = f.tell()
+        f.write(payload)
+        return _segment_name(self.number), offset, len(payload), codec
+
+    def sync(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+
+def archive_rows(conn: sqlite3.Connection, entries):
+    """
+    Index archived images: entries are (hash, segment, offset, length, codec, size).
+
+    Must be called inside a transaction.
+    """
+    archived_at = datetime.utcnow().isoformat()
+    conn.executemany("""
+        INSERT OR IGNORE INTO image_archive (hash, segment, offset, length, codec, size, archived_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, [(*entry, archived_at) for entry in entries])
+
+
+def get_archived_image_info(conn: sqlite3.Connection, prediction_id: int):
+    """Return (hash, size, storage_mode) of a prediction's archived image, or None."""
+    return conn.execute("""
+        SELECT image_archive.hash, image_archive.size, COALESCE(predictions.storage_mode, 'jpeg')
+        FROM predictions JOIN image_archive ON image_archive.hash = predictions.image_hash
+        WHERE predictions.id = ?
+    """, (prediction_id,)).fetchone()
+
+
+def read_archived_image(conn: sqlite3.Connection, key: str, archive_dir=ARCHIVE_DIR):
+    """Return the archived bytes stored under key, or None if it was never archived."""
+    row = conn.execute("""
+        SELECT segment, offset, length, codec, size FROM image_archive WHERE hash = ?
+    """, (key,)).fetchone()
+    if row is None:
+        return None
+
+    segment, offset, length, codec, size = row
+    path = os.path.join(archive_dir, segment)
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    except FileNotFoundError:
+        raise ArchiveError(f'Archive segment missing: {path}')
+    try:
+        payload = os.pread(fd, length, offset) if hasattr(os, 'pread') else _read_at(fd, offset, length)
+    finally:
+        os.close(fd)
+
+    data = zlib.decompress(payload) if codec == CODEC_ZLIB else payload
+    if len(data) != size or hashlib.sha256(data).hexdigest() != key:
+        raise ArchiveError(f'Archived image {key} is corrupt ({segment} at {offset})')
+    return data
+
+
+def _read_at(fd, offset, length):
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+
+def iter_segment(path):
+    """Yield (hash, codec, offset, length, size) for every complete record in a segment file."""
+    end = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            magic, codec, digest, length, size = RECORD_HEADER.unpack(header)
+            offset = f.tell()
+            if magic != MAGIC or offset + length > end:
+                return  # A record cut short by a crash
+            f.seek(length, os.SEEK_CUR)
+            yield digest.hex(), codec, offset, length, size
+
+
+def _complete_length(path) -> int:
+    """Bytes of path taken up by complete records."""
+    end = 0
+    for _, _, offset, length, _ in iter_segment(path):
+        end = offset + length
+    return end
+
+
+def reindex_archive(conn: sqlite3.Connection, archive_dir=ARCHIVE_DIR) -> int:
+    """Re-create missing image_archive rows from the segment files; returns rows added."""
+    added = 0
+    for number in _segment_numbers(archive_dir):
+        segment = _segment_name(number)
+        entries = [(key, segment, offset, length, codec, size)
+                   for key, codec, offset, length, size in iter_segment(os.path.join(archive_dir, segment))]
+        with transaction(conn):
+            before = conn.total_changes
+            archive_rows(conn, entries)
+            added += conn.total_changes - before
+    return added
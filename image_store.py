@@ -0,0 +1,145 @@
+"""
+image_store.py
+
+Content-addressed storage for prediction images.
+
+Images live in the `images` side table keyed by the SHA-256 of their bytes;
+predictions only keep that key in `image_hash`. Identical images (repeated
+uploads, unchanged webcam frames) are stored once, and scans over the
+predictions table no longer have to page through image data.
+"""
+import hashlib
+import sqlite3
+from datetime import datetime
+
+from db import transaction
+
+
+def image_key(data: bytes) -> str:
+    """Content address for image bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def put_image(conn: sqlite3.Connection, data: bytes) -> str:
+    """
+    Store image bytes if not already present and return their key.
+
+    Must be called inside a transaction; it doesn't commit.
+    """
+    key = image_key(data)
+    conn.execute("""
+        INSERT OR IGNORE INTO images (hash, data, size, created_at)
+        VALUES (?, ?, ?, ?)
+    """, (key, data, len(data), datetime.utcnow().isoformat()))
+    return key
+
+
+def get_image(conn: sqlite3.Connection, key: str):
+    """Return the bytes stored under key, or None."""
+    row = conn.execute("SELECT data FROM images WHERE hash = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def get_prediction_image(conn: sqlite3.Connection, prediction_id: int):
+    """Return the image bytes of a prediction, or None."""
+    row = conn.execute("""
+        SELECT images.data
+        FROM predictions JOIN images ON images.hash = predictions.image_hash
+        WHERE predictions.id = ?
+    """, (prediction_id,)).fetchone()
+    return row[0] if row else None
+
+
+def get_prediction_image_info(conn: sqlite3.Connection, prediction_id: int):
+    """Return (hash, size, rowid, storage_mode) of a prediction's image without reading it, or None."""
+    return conn.execute("""
+        SELECT images.hash, images.size, images.rowid, COALESCE(predictions.storage_mode, 'jpeg')
+        FROM predictions JOIN images ON images.hash = predictions.image_hash
+        WHERE predictions.id = ?
+    """, (prediction_id,)).fetchone()
+
+
+def sniff_mimetype(head: bytes) -> str:
+    """Media type of stored image bytes, from their first few bytes."""
+    if head[:3] == b'\xff\xd8\xff':
+        return 'image/jpeg'
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'image/png'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head[:4] == b'GIF8':
+        return 'image/gif'
+    if head[:2] == b'BM':
+        return 'image/bmp'
+    if head[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'image/tiff'
+    return 'application/octet-stream'
+
+
+def iter_image_blob(conn: sqlite3.Connection, rowid: int, start=0, stop=None,
+                    chunk_size=64 * 1024):
+    """
+    Yield bytes [start, stop) of a stored image using incremental blob I/O.
+
+    Only chunk_size bytes are held in Python memory at a time.
+    """
+    with conn.blobopen('images', 'data', rowid, readonly=True) as blob:
+        stop = len(blob) if stop is None else stop
+        blob.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = blob.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+# ==================== MIGRATION ====================
+
+def has_inline_images(conn: sqlite3.Connection) -> bool:
+    """True if predictions still has the legacy image_data column."""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(predictions)")]
+    return 'image_data' in columns
+
+
+def migrate_inline_images(conn: sqlite3.Connection, batch_size=500, progress=None) -> int:
+    """
+    Move predictions.image_data BLOBs into the images table.
+
+    Works in small transactions so the database stays usable, and is safe
+    to re-run or to run from several processes at once: each batch only
+    picks up rows that don't have an image_hash yet, and the legacy column
+    is dropped once none are left. Returns the number of rows migrated.
+    """
+    if not has_inline_images(conn):
+        return 0
+
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(predictions)")]
+    if 'image_hash' not in columns:
+        with transaction(conn):
+            if 'image_hash' not in [row[1] for row in conn.execute("PRAGMA table_info(predictions)")]:
+                conn.execute("ALTER TABLE predictions ADD COLUMN image_hash TEXT")
+
+    migrated = 0
+    while True:
+        with transaction(conn):
+            rows = conn.execute("""
+                SELECT id, image_data FROM predictions
+                WHERE image_hash IS NULL
+                LIMIT ?
+            """, (batch_size,)).fetchall()
+            for prediction_id, data in rows:
+                key = put_image(conn, data or b'')
+                conn.execute("UPDATE predictions SET image_hash = ? WHERE id = ?",
+                             (key, prediction_id))
+        migrated += len(rows)
+        if progress and rows:
+            progress(migrated)
+        if len(rows) < batch_size:
+            break
+
+    with transaction(conn):
+        if has_inline_images(conn):
+            conn.execute("ALTER TABLE predictions DROP COLUMN image_data")
+    return migrated
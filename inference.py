@@ -0,0 +1,454 @@
+"""
+inference.py
+
+Lightweight inference engine for the emotion detection MLP.
+
+Pulls the weights out of a fitted sklearn MLPClassifier once at startup and
+runs a single vectorized float32 NumPy forward pass that returns both the
+predicted class and the full probability vector.
+
+export_weights() writes the weights as float32 .npy files plus meta.json.
+load_weights() maps them back read-only (mmap), so serving doesn't need
+sklearn or unpickling, and workers forked from one parent share the pages.
+
+with_precision() switches an engine between float64, float32 (the default)
+and int8 weights. precision_report() compares each mode against sklearn.
+"""
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+WEIGHTS_FORMAT = 1
+META_FILE = 'meta.json'
+PRECISIONS = ('float64', 'float32', 'int8')
+
+
+def _relu(x):
+    return np.maximum(x, 0, out=x)
+
+
+def _logistic(x):
+    np.negative(x, out=x)
+    np.exp(x, out=x)
+    x += 1
+    return np.reciprocal(x, out=x)
+
+
+def _tanh(x):
+    return np.tanh(x, out=x)
+
+
+def _identity(x):
+    return x
+
+
+def _softmax(x):
+    x -= x.max(axis=1, keepdims=True)
+    np.exp(x, out=x)
+    x /= x.sum(axis=1, keepdims=True)
+    return x
+
+
+HIDDEN_ACTIVATIONS = {
+    'relu': _relu,
+    'logistic': _logistic,
+    'tanh': _tanh,
+    'identity': _identity,
+}
+
+
+class InferenceEngine:
+    """Single-pass forward propagation over weights extracted from an MLP."""
+
+    precision = None  # Set from dtype; 'int8' for QuantizedInferenceEngine
+
+    def __init__(self, coefs, intercepts, classes, activation='relu',
+                 out_activation='softmax', dtype=np.float32):
+        if out_activation not in ('softmax', 'logistic'):
+            raise ValueError(f"Unsupported output activation: {out_activation}")
+        if activation not in HIDDEN_ACTIVATIONS:
+            raise ValueError(f"Unsupported hidden activation: {activation}")
+
+        self.dtype = np.dtype(dtype)
+        self.coefs = [np.ascontiguousarray(w, dtype=self.dtype) for w in coefs]
+        self.intercepts = [np.ascontiguousarray(b, dtype=self.dtype) for b in intercepts]
+        self.classes = np.asarray(classes)
+        self.activation = activation
+        self.out_activation = out_activation
+        self.n_features = self.coefs[0].shape[0]
+        self.precision = self.precision or self.dtype.name
+
+    @classmethod
+    def from_sklearn(cls, model, dtype=np.float32):
+        """Build an engine from a fitted sklearn MLPClassifier."""
+        return cls(
+            coefs=model.coefs_,
+            intercepts=model.intercepts_,
+            classes=model.classes_,
+            activation=model.activation,
+            out_activation=model.out_activation_,
+            dtype=dtype,
+        )
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """Build an engine from an export_weights() directory."""
+        return load_weights(directory, mmap_mode=mmap_mode)[0]
+
+    def with_precision(self, precision):
+        """
+        Return an engine running these weights at precision.
+
+        'float64' and 'float32' cast the weights; 'int8' quantizes them (see
+        QuantizedInferenceEngine). Weights loaded from a float32 export stay
+        float32-rounded in float64 mode.
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision: {precision} (expected one of {', '.join(PRECISIONS)})")
+        if precision == self.precision:
+            return self
+        if precision == 'int8':
+            return QuantizedInferenceEngine(self.float_coefs(), self.intercepts, self.classes,
+                                            self.activation, self.out_activation)
+        return InferenceEngine(self.float_coefs(), self.intercepts, self.classes,
+                               self.activation, self.out_activation, dtype=precision)
+
+    def float_coefs(self):
+        """Weight matrices as real values."""
+        return self.coefs
+
+    @property
+    def weight_bytes(self) -> int:
+        """Size of the weights and biases in this precision (int8 plus scales when quantized)."""
+        return sum(w.nbytes + b.nbytes for w, b in zip(self.coefs, self.intercepts))
+
+    def _affine(self, activations, i):
+        activations = activations @ self.coefs[i]
+        activations += self.intercepts[i]
+        return activations
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        """Return class probabilities with shape (n_samples, n_classes)."""
+        activations = np.asarray(X, dtype=self.dtype)
+        if activations.ndim == 1:
+            activations = activations.reshape(1, -1)
+
+        hidden = HIDDEN_ACTIVATIONS[self.activation]
+        last = len(self.coefs) - 1
+        for i in range(len(self.coefs)):
+            activations = self._affine(activations, i)
+            if i != last:
+                activations = hidden(activations)
+
+        if self.out_activation == 'softmax':
+            return _softmax(activations)
+
+        # Binary problem: sklearn emits a single logistic unit
+        positive = _logistic(activations)
+        if positive.shape[1] == 1:
+            return np.hstack([1 - positive, positive])
+        return positive
+
+    def predict(self, X: np.ndarray):
+        """
+        Run one forward pass and return (class indices, probabilities).
+
+        Class indices are positions into `classes` (and therefore into the
+        probability vector), not the raw class values.
+        """
+        probabilities = self.predict_proba(X)
+        return probabilities.argmax(axis=1), probabilities
+
+
+def quantize_columns(w: np.ndarray):
+    """Symmetric per-output-channel int8 quantization; returns (int8 weights, float32 scales)."""
+    w = np.asarray(w, dtype=np.float32)
+    scales = np.abs(w).max(axis=0) / 127.0
+    scales[scales == 0] = 1.0
+    return np.round(w / scales).astype(np.int8), scales.astype(np.float32)
+
+
+def quantize_rows(x: np.ndarray):
+    """
+    Dynamic per-row quantization of activations; returns (integer-valued float32, scales).
+
+    Non-negative input (pixels, ReLU outputs) uses 0..255, anything else
+    -127..127. Pixel features (values k/255) come through exactly.
+    """
+    levels = 255.0 if x.min() >= 0 else 127.0
+    scales = np.abs(x).max(axis=1, keepdims=True) / levels
+    scales[scales == 0] = 1.0
+    return np.round(x / scales), scales
+
+
+class QuantizedInferenceEngine(InferenceEngine):
+    """
+    The same forward pass with int8 weights and int8/uint8 activations.
+
+    Each layer's weights are quantized per output channel and its input per
+    row. The integer products are accumulated by float32 BLAS over
+    integer-valued operands (NumPy has no fast integer GEMM), which matches
+    int32 accumulation exactly up to 2**24 and to about 1e-7 relative error
+    beyond, then rescaled by row scale x channel scale. Throughput is the
+    same as float32; the int8 weights are what an integer kernel or a
+    compact export would use.
+    """
+
+    precision = 'int8'
+
+    def __init__(self, coefs, intercepts, classes, activation='relu', out_activation='softmax'):
+        quantized = [quantize_columns(w) for w in coefs]
+        self.qcoefs = [q for q, _ in quantized]
+        self.scales = [scale for _, scale in quantized]
+        # Integer-valued float32 copies feed the BLAS matmul
+        super().__init__([q.astype(np.float32) for q in self.qcoefs], intercepts, classes,
+                         activation, out_activation, dtype=np.float32)
+
+    def float_coefs(self):
+        return [q * scale for q, scale in zip(self.qcoefs, self.scales)]
+
+    @property
+    def weight_bytes(self) -> int:
+        return sum(q.nbytes + s.nbytes + b.nbytes
+                   for q, s, b in zip(self.qcoefs, self.scales, self.intercepts))
+
+    def _affine(self, activations, i):
+        values, row_scales = quantize_rows(activations)
+        accumulated = values.astype(np.float32) @ self.coefs[i]
+        accumulated *= row_scales
+        accumulated *= self.scales[i]
+        accumulated += self.intercepts[i]
+        return accumulated
+
+
+def file_sha256(path, chunk_size=1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def export_weights(engine: InferenceEngine, directory, labels=None, input_shape=(48, 48),
+                   source_path=None) -> dict:
+    """
+    Save an engine as float32 .npy arrays plus meta.json in directory.
+
+    meta.json records the labels, input shape, input normalization and the
+    SHA-256 of the pickle it came from (to detect stale exports). It is
+    written last, so a directory with meta.json is a complete export.
+    """
+    os.makedirs(directory, exist_ok=True)
+    layers = []
+    for i, (w, b) in enumerate(zip(engine.coefs, engine.intercepts)):
+        coef_file, intercept_file = f'coef_{i}.npy', f'intercept_{i}.npy'
+        np.save(os.path.join(directory, coef_file), np.ascontiguousarray(w, dtype=np.float32))
+        np.save(os.path.join(directory, intercept_file), np.ascontiguousarray(b, dtype=np.float32))
+        layers.append({'coef': coef_file, 'intercept': intercept_file, 'shape': list(w.shape)})
+    np.save(os.path.join(directory, 'classes.npy'), engine.classes)
+
+    meta = {
+        'format': WEIGHTS_FORMAT,
+        'dtype': 'float32',
+        'activation': engine.activation,
+        'out_activation': engine.out_activation,
+        'layers': layers,
+        'classes': 'classes.npy',
+        'labels': list(labels) if labels is not None else None,
+        'input_shape': list(input_shape),
+        'normalization': {'scale': 1 / 255.0, 'offset': 0.0},
+        'source_sha256': file_sha256(source_path) if source_path else None,
+    }
+    temp_path = os.path.join(directory, META_FILE + '.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(temp_path, os.path.join(directory, META_FILE))
+    return meta
+
+
+def read_weights_meta(directory):
+    """Return the export's meta.json contents, or None if there is no complete export."""
+    try:
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('format') == WEIGHTS_FORMAT else None
+
+
+def load_weights(directory, mmap_mode='r'):
+    """
+    Load an export_weights() directory; returns (engine, meta).
+
+    With mmap_mode='r' the weight arrays are read-only views of the files.
+    """
+    meta = read_weights_meta(directory)
+    if meta is None:
+        raise FileNotFoundError(f'No exported weights in {directory}')
+
+    def load(name):
+        return np.load(os.path.join(directory, name), mmap_mode=mmap_mode)
+
+    engine = InferenceEngine(
+        coefs=[load(layer['coef']) for layer in meta['layers']],
+        intercepts=[load(layer['intercept']) for layer in meta['layers']],
+        classes=np.load(os.path.join(directory, meta['classes'])),
+        activation=meta['activation'],
+        out_activation=meta['out_activation'],
+    )
+    return engine, meta
+
+
+def verify_against_sklearn(model, engine=None, n_samples=256, atol=1e-4, seed=0):
+    """
+    Parity check between the engine and sklearn's predict/predict_proba.
+
+    Returns a dict describing the largest probability deviation and whether
+    the predicted labels agree on every sample.
+    """
+    if engine is None:
+        engine = InferenceEngine.from_sklearn(model)
+
+    rng = np.random.default_rng(seed)
+    X = rng.random((n_samples, engine.n_features))
+
+    expected_proba = model.predict_proba(X)
+    expected_labels = model.predict(X)
+
+    indices, probabilities = engine.predict(X)
+    labels = engine.classes[indices]
+
+    max_abs_diff = float(np.abs(probabilities - expected_proba).max())
+    labels_match = bool(np.array_equal(labels, expected_labels))
+
+    return {
+        'samples': n_samples,
+        'max_abs_diff': max_abs_diff,
+        'labels_match': labels_match,
+        'passed': labels_match and max_abs_diff <= atol,
+    }
+
+
+def _predictions_per_sec(engine, X, batch_size, min_seconds=0.5):
+    batch = np.ascontiguousarray(X[:batch_size])
+    engine.predict(batch)  # Warm-up
+    runs, started = 0, time.perf_counter()
+    while time.perf_counter() - started < min_seconds:
+        engine.predict(batch)
+        runs += 1
+    return runs * len(batch) / (time.perf_counter() - started)
+
+
+def precision_report(model, X, y=None, precisions=PRECISIONS, batch_sizes=(1, 32)):
+    """
+    Compare each precision mode against the float64 sklearn model on X.
+
+    Reports top-1 agreement with sklearn, probability deviations, accuracy
+    against y (when given), weight memory and predictions/sec at each batch
+    size. One row per precision.
+    """
+    X = np.asarray(X, dtype=np.float32)
+    expected_proba = model.predict_proba(X)
+    expected = expected_proba.argmax(axis=1)
+    base = InferenceEngine.from_sklearn(model, dtype=np.float64)
+
+    rows = []
+    for precision in precisions:
+        engine = base.with_precision(precision)
+        indices, probabilities = engine.predict(X)
+        deviation = np.abs(probabilities - expected_proba)
+        row = {
+            'precision': precision,
+            'samples': len(X),
+            'weight_mb': engine.weight_bytes / (1024 * 1024),
+            'agreement': float(np.mean(indices == expected)),
+            'max_abs_diff': float(deviation.max()),
+            'mean_abs_diff': float(deviation.mean()),
+            'accuracy': None,
+            'sklearn_accuracy': None,
+        }
+        if y is not None:
+            row['accuracy'] = float(np.mean(engine.classes[indices] == y))
+            row['sklearn_accuracy'] = float(np.mean(model.classes_[expected] == y))
+        for batch_size in batch_sizes:
+            row[f'per_sec_batch_{batch_size}'] = _predictions_per_sec(engine, X, batch_size)
+        rows.append(row)
+    return rows
+
+
+def load_image_folder(directory, per_class=None, size=(48, 48)):
+    """
+    Load a held-out set laid out like the training data (one folder per class).
+
+    Images are preprocessed as in model.py; returns (X, y, class names).
+    """
+    import cv2
+
+    classes = sorted(os.listdir(directory))
+    X, y = [], []
+    for label, name in enumerate(classes):
+        files = sorted(os.listdir(os.path.join(directory, name)))[:per_class]
+        for file_name in files:
+            img = cv2.imread(os.path.join(directory, name, file_name), cv2.IMREAD_GRAYSCALE)
+            if img is None:
+                continue
+            X.append(cv2.resize(img, size).flatten())
+            y.append(label)
+    return np.array(X, dtype=np.float32) / 255.0, np.array(y), classes
+
+
+def print_precision_report(rows):
+    print("\n🎯 PRECISION REPORT (vs float64 sklearn)\n")
+    print("-" * 90)
+    print(f"{'Mode':<8} {'Weights MB':>11} {'Agree %':>8} {'Acc %':>7} {'Max |Δp|':>10} "
+          f"{'Mean |Δp|':>10} {'Pred/s b=1':>11} {'Pred/s b=32':>12}")
+    print("-" * 90)
+    for r in rows:
+        accuracy = f"{r['accuracy'] * 100:.2f}" if r['accuracy'] is not None else '-'
+        print(f"{r['precision']:<8} {r['weight_mb']:>11.2f} {r['agreement'] * 100:>8.2f} {accuracy:>7} "
+              f"{r['max_abs_diff']:>10.2e} {r['mean_abs_diff']:>10.2e} "
+              f"{r.get('per_sec_batch_1', 0):>11.0f} {r.get('per_sec_batch_32', 0):>12.0f}")
+    print("-" * 90)
+    if rows and rows[0]['sklearn_accuracy'] is not None:
+        print(f"sklearn accuracy: {rows[0]['sklearn_accuracy'] * 100:.2f}%")
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    import joblib
+
+    parser = argparse.ArgumentParser(description='Check the inference engine against sklearn')
+    parser.add_argument('model_path', nargs='?', default='model.pkl')
+    parser.add_argument('--report', action='store_true',
+                        help='Compare float64/float32/int8 accuracy and speed')
+    parser.add_argument('--data', default=None,
+                        help='Held-out image folder (one subfolder per class) for --report')
+    parser.add_argument('--per-class', type=int, default=None, help='Images per class from --data')
+    parser.add_argument('--samples', type=int, default=2048, help='Random inputs when --data is not given')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    model = joblib.load(args.model_path)
+    if args.report:
+        if args.data:
+            X, y, _ = load_image_folder(args.data, args.per_class)
+        else:
+            X, y = np.random.default_rng(0).random((args.samples, model.coefs_[0].shape[0])), None
+        rows = precision_report(model, X, y)
+        if args.json:
+            print(json.dumps(rows, indent=2))
+        else:
+            print_precision_report(rows)
+        sys.exit(0)
+
+    print(f"🔍 Checking inference engine against sklearn ({args.model_path})...")
+    report = verify_against_sklearn(model)
+    print(f"   Samples:          {report['samples']}")
+    print(f"   Max |Δ proba|:    {report['max_abs_diff']:.2e}")
+    print(f"   Labels match:     {report['labels_match']}")
+    print("✅ Parity check passed" if report['passed'] else "❌ Parity check failed")
+    sys.exit(0 if report['passed'] else 1)
@@ -8,7 +8,7 @@ import sqlite3
 import os
 from datetime import datetime
 
-DB_FILE = 'emotion_detection.db'
+from db import DB_FILE, ensure_schema, get_connection
 
 
 def create_database():
@@ -21,68 +21,14 @@ def create_database():
     
     print(f"📊 Creating database: {DB_FILE}")
     
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    # Table 1: predictions
-    print("Creating table: predictions")
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS predictions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_name TEXT NOT NULL,
-            image_path TEXT,
-            image_data BLOB NOT NULL,
-            predicted_emotion TEXT NOT NULL,
-            confidence REAL NOT NULL,
-            all_probabilities TEXT,
-            timestamp TEXT NOT NULL,
-            source TEXT NOT NULL
-        )
-    """)
-    
-    # Table 2: users
-    print("Creating table: users")
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL UNIQUE,
-            first_used TEXT NOT NULL,
-            total_predictions INTEGER DEFAULT 0
-        )
-    """)
-    
-    # Table 3: model_info
-    print("Creating table: model_info")
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS model_info (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            model_name TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            accuracy REAL,
-            epochs INTEGER,
-            description TEXT
-        )
-    """)
-    
-    # Create indexes for better performance
-    print("Creating indexes...")
-    cursor.execute("""
-        CREATE INDEX IF NOT EXISTS idx_predictions_timestamp 
-        ON predictions(timestamp DESC)
-    """)
+    conn = get_connection(DB_FILE)
     
-    cursor.execute("""
-        CREATE INDEX IF NOT EXISTS idx_predictions_user 
-        ON predictions(user_name)
-    """)
-    
-    cursor.execute("""
-        CREATE INDEX IF NOT EXISTS idx_predictions_emotion 
-        ON predictions(predicted_emotion)
-    """)
-    
-    conn.commit()
-    conn.close()
+    # Tables: predictions, users, model_info, images (content-addressed
+    # image store), plus the statistics aggregates and history indexes.
+    # Databases from older versions are migrated in place.
+    print("Creating tables: predictions, users, model_info, images")
+    print("Creating statistics aggregates and indexes...")
+    ensure_schema(conn, progress=lambda n: print(f"   Moved {n} images into the image store..."))
     
     print("✅ Database created successfully!\n")
     
@@ -0,0 +1,189 @@
+"""
+loadtest.py
+
+Throughput curve of a running server (or of several gunicorn layouts).
+
+Posts distinct synthetic JPEGs to /predict from an increasing number of
+concurrent clients and reports requests/s and latency at each level. Start
+the server with PREDICTION_CACHE_SIZE=0 to measure the model path rather
+than cache hits.
+
+Usage:
+    python loadtest.py [--url http://127.0.0.1:8000] [--concurrency 1,2,4,8,16,32]
+    python loadtest.py --launch 1x8,2x4,4x2    # start gunicorn per WORKERSxTHREADS layout
+"""
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from benchmark import make_synthetic_jpeg
+
+BOUNDARY = 'loadtest-boundary'
+
+
+def multipart_body(image: bytes, name='loadtest') -> bytes:
+    return b''.join([
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="name"\r\n\r\n{name}\r\n'.encode(),
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="image"; filename="frame.jpg"\r\n'
+        f'Content-Type: image/jpeg\r\n\r\n'.encode(),
+        image,
+        f'\r\n--{BOUNDARY}--\r\n'.encode(),
+    ])
+
+
+def _client(url, bodies, offset, stop_at, latencies, errors):
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+    headers = {'Content-Type': f'multipart/form-data; boundary={BOUNDARY}'}
+    i = offset
+    while time.perf_counter() < stop_at:
+        body = bodies[i % len(bodies)]
+        i += 1
+        started = time.perf_counter()
+        try:
+            conn.request('POST', '/predict', body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+                continue
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(str(e))
+            conn.close()
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+            continue
+        latencies.append((time.perf_counter() - started) * 1000.0)
+    conn.close()
+
+
+def run_level(url, bodies, concurrency, duration):
+    """Run concurrency clients for duration seconds; returns one result row."""
+    latencies, errors = [], []
+    stop_at = time.perf_counter() + duration
+    clients = [
+        threading.Thread(target=_client,
+                         args=(url, bodies, i * len(bodies) // concurrency, stop_at, latencies, errors))
+        for i in range(concurrency)
+    ]
+    started = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - started
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'requests_per_sec': len(latencies) / elapsed,
+        'p50_ms': float(np.percentile(latencies, 50)) if latencies else None,
+        'p95_ms': float(np.percentile(latencies, 95)) if latencies else None,
+        'p99_ms': float(np.percentile(latencies, 99)) if latencies else None,
+    }
+
+
+def wait_for_server(url, timeout=120.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f'{url}/health', timeout=5) as response:
+                if response.status == 200:
+                    return True
+        except OSError:
+            time.sleep(0.5)
+    return False
+
+
+def launch(workers, threads, port, extra_env=None, cwd=None):
+    """
+    Start gunicorn with the given layout; returns the process.
+
+    workers=None keeps gunicorn.conf.py's autotuned layout. cwd is where the
+    app looks for its model and database (default: the current directory).
+    """
+    env = dict(os.environ, PORT=str(port), PREDICTION_CACHE_SIZE='0', **(extra_env or {}))
+    if workers is not None:
+        env.update(WEB_CONCURRENCY=str(workers), GUNICORN_THREADS=str(threads))
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(repo_dir, 'gunicorn.conf.py'),
+                             '--pythonpath', repo_dir, 'app:app'],
+                            env=env, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def sweep(url, bodies, levels, duration, layout=None):
+    results = []
+    run_level(url, bodies, min(levels), 1.0)  # Warm-up
+    for concurrency in levels:
+        result = run_level(url, bodies, concurrency, duration)
+        result['layout'] = layout
+        results.append(result)
+    return results
+
+
+def print_results(results):
+    print("\n🚦 LOAD TEST: /predict THROUGHPUT CURVE\n")
+    print("-" * 72)
+    print(f"{'Layout':<8} {'Clients':>8} {'Requests':>9} {'Errors':>7} {'Req/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    print("-" * 72)
+    for r in results:
+        p50 = f"{r['p50_ms']:.1f}" if r['p50_ms'] is not None else '-'
+        p99 = f"{r['p99_ms']:.1f}" if r['p99_ms'] is not None else '-'
+        print(f"{r['layout'] or '-':<8} {r['concurrency']:>8} {r['requests']:>9} {r['errors']:>7} "
+              f"{r['requests_per_sec']:>9.1f} {p50:>9} {p99:>9}")
+    print("-" * 72)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test /predict at increasing concurrency')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--concurrency', default='1,2,4,8,16,32', help='Comma-separated client counts')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds per concurrency level')
+    parser.add_argument('--images', type=int, default=256, help='Distinct synthetic images to cycle through')
+    parser.add_argument('--size', default='640x480', help='Synthetic image size, WIDTHxHEIGHT')
+    parser.add_argument('--launch', default=None,
+                        help='Comma-separated WORKERSxTHREADS gunicorn layouts to start and test in turn')
+    parser.add_argument('--json', action='store_true', help='Print machine-readable JSON')
+    args = parser.parse_args(argv)
+
+    levels = [int(level) for level in args.concurrency.split(',')]
+    width, height = (int(side) for side in args.size.split('x'))
+    bodies = [multipart_body(make_synthetic_jpeg(width, height, seed=i)) for i in range(args.images)]
+
+    results = []
+    if args.launch:
+        port = urlsplit(args.url).port or 8000
+        for layout in args.launch.split(','):
+            workers, threads = (int(n) for n in layout.split('x'))
+            server = launch(workers, threads, port)
+            try:
+                if not wait_for_server(args.url):
+                    print(f"❌ Server with layout {layout} did not start")
+                    continue
+                results.extend(sweep(args.url, bodies, levels, args.duration, layout))
+            finally:
+                server.terminate()
+                server.wait()
+    else:
+        if not wait_for_server(args.url, timeout=5):
+            print(f"❌ No server responding at {args.url}")
+            return 1
+        results = sweep(args.url, bodies, levels, args.duration)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
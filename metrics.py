@@ -0,0 +1,350 @@
+"""
+metrics.py
+
+Low-overhead latency and throughput metrics for the hot paths.
+
+Code records into module-level counters and histograms (a lock and a bisect
+per observation). stage() times one step of a request; the stages of the
+current request are also kept per thread so the app can return them as a
+Server-Timing header. render() produces the Prometheus text format.
+
+Each gunicorn worker has its own copy of these numbers. With METRICS_DIR
+set, every worker writes a snapshot to METRICS_DIR/worker-<pid>.json about
+once a second, and render() merges all of them, so a scrape that reaches any
+worker reports the whole server. When a worker exits, mark_process_dead()
+folds its counters into archive.json so totals never go backwards.
+"""
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_DIR = os.environ.get('METRICS_DIR') or None
+FLUSH_INTERVAL = 1.0  # Seconds between worker snapshots in METRICS_DIR
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+_lock = threading.Lock()
+_metrics = {}  # name -> Counter / Histogram
+_collectors = []  # (name, kind, help, labelnames, fn)
+_local = threading.local()
+
+
+class Counter:
+    """Monotonic counter, optionally split by label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, amount=1.0, *labelvalues):
+        with _lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def samples(self):
+        with _lock:
+            return [[list(labels), value] for labels, value in self._values.items()]
+
+
+class Histogram:
+    """Fixed-bucket histogram; per label values it keeps bucket counts, sum and count."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, *labelvalues):
+        slot = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                # One count per bucket plus +Inf, then sum and count
+                state = self._values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            state[slot] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self):
+        with _lock:
+            return [[list(labels), list(state)] for labels, state in self._values.items()]
+
+
+def counter(name, help, labelnames=()) -> Counter:
+    """Get or create a counter."""
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = Counter(name, help, labelnames)
+        return _metrics[name]
+
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+    """Get or create a histogram."""
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = Histogram(name, help, labelnames, buckets)
+        return _metrics[name]
+
+
+def register_collector(name, kind, help, labelnames, fn):
+    """
+    Report values owned by another object (cache hits, queue depth) at snapshot time.
+
+    fn() returns {labelvalues tuple: value}. kind is 'counter' for totals
+    that only grow, 'gauge' for current values.
+    """
+    _collectors.append((name, kind, help, tuple(labelnames), fn))
+
+
+STAGE_SECONDS = histogram('emotion_stage_seconds', 'Time spent in each request stage', ['stage'])
+
+
+# ==================== PER-REQUEST STAGES ====================
+
+def begin_request():
+    """Start collecting this thread's stage timings for a Server-Timing header."""
+    _local.stages = {}
+
+
+def end_request() -> dict:
+    """Return {stage: seconds} for this thread's request and stop collecting."""
+    stages = getattr(_local, 'stages', None) or {}
+    _local.stages = None
+    return stages
+
+
+@contextmanager
+def stage(name):
+    """Time a block as one stage of the current request."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, name)
+        stages = getattr(_local, 'stages', None)
+        if stages is not None:
+            stages[name] = stages.get(name, 0.0) + elapsed
+
+
+def server_timing(stages: dict, total=None) -> str:
+    """Format stage timings as a Server-Timing header value (milliseconds)."""
+    parts = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in stages.items()]
+    if total is not None:
+        parts.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(parts)
+
+
+# ==================== SNAPSHOTS ====================
+
+def snapshot() -> dict:
+    """This process's metrics as a JSON-serializable dict."""
+    with _lock:
+        metrics = list(_metrics.values())
+    result = {}
+    for metric in metrics:
+        result[metric.name] = {
+            'type': metric.kind,
+            'help': metric.help,
+            'labelnames': list(metric.labelnames),
+            'buckets': list(getattr(metric, 'buckets', ())),
+            'samples': metric.samples(),
+        }
+    for name, kind, help, labelnames, fn in _collectors:
+        try:
+            values = fn()
+        except Exception:
+            continue
+        result[name] = {
+            'type': kind,
+            'help': help,
+            'labelnames': list(labelnames),
+            'buckets': [],
+            'samples': [[list(labels), value] for labels, value in values.items()],
+        }
+    return result
+
+
+def merge(snapshots, include_gauges=True) -> dict:
+    """Sum snapshots from several processes into one."""
+    merged = {}
+    for snap in snapshots:
+        for name, metric in snap.items():
+            if metric['type'] == 'gauge' and not include_gauges:
+                continue
+            target = merged.setdefault(name, dict(metric, samples={}))
+            for labels, value in metric['samples']:
+                key = tuple(labels)
+                current = target['samples'].get(key)
+                if current is None:
+                    target['samples'][key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    target['samples'][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    target['samples'][key] = current + value
+    for metric in merged.values():
+        metric['samples'] = [[list(labels), value] for labels, value in metric['samples'].items()]
+    return merged
+
+
+def _write_json(path, data):
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+@contextmanager
+def _directory_lock(directory):
+    import fcntl  # Multi-worker mode only runs under gunicorn, so POSIX only
+    with open(os.path.join(directory, '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _worker_path(directory, pid):
+    return os.path.join(directory, f'worker-{pid}.json')
+
+
+def flush(directory=None):
+    """Write this process's snapshot to the metrics directory."""
+    directory = directory or METRICS_DIR
+    if directory:
+        _write_json(_worker_path(directory, os.getpid()), snapshot())
+
+
+class _Flusher:
+    # Threads don't survive fork(), so each worker starts its own on first use
+    def __init__(self):
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def ensure_started(self):
+        if not METRICS_DIR or self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            threading.Thread(target=self._run, name='metrics-flusher', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                flush()
+            except OSError:
+                pass
+
+
+_flusher = _Flusher()
+ensure_started = _flusher.ensure_started
+
+
+def collect() -> dict:
+    """Metrics for the whole server: every live worker plus exited ones."""
+    if not METRICS_DIR:
+        return merge([snapshot()])
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    flush()
+    snapshots = []
+    # Locked so an exiting worker isn't counted both live and archived
+    with _directory_lock(METRICS_DIR):
+        for name in os.listdir(METRICS_DIR):
+            if name.startswith('worker-') and name.endswith('.json') or name == 'archive.json':
+                data = _read_json(os.path.join(METRICS_DIR, name))
+                if data:
+                    snapshots.append(data)
+    return merge(snapshots)
+
+
+def mark_process_dead(pid, directory=None):
+    """Fold an exited worker's counters and histograms into archive.json (gauges are dropped)."""
+    directory = directory or METRICS_DIR
+    if not directory:
+        return
+    path = _worker_path(directory, pid)
+    with _directory_lock(directory):
+        data = _read_json(path)
+        if data:
+            archive_path = os.path.join(directory, 'archive.json')
+            archive = _read_json(archive_path) or {}
+            _write_json(archive_path, merge([archive, data], include_gauges=False))
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def reset_directory(directory=None):
+    """Clear snapshots left by a previous server run."""
+    directory = directory or METRICS_DIR
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith('.json') or name.endswith('.tmp'):
+            os.remove(os.path.join(directory, name))
+
+
+# ==================== PROMETHEUS TEXT ====================
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(metrics=None) -> str:
+    """Prometheus text exposition (version 0.0.4) of collect() or the given metrics."""
+    metrics = collect() if metrics is None else metrics
+    lines = []
+    for name in sorted(metrics):
+        metric = metrics[name]
+        names = metric['labelnames']
+        lines.append(f'# HELP {name} {metric["help"]}')
+        lines.append(f'# TYPE {name} {metric["type"]}')
+        for labels, value in sorted(metric['samples'], key=lambda sample: sample[0]):
+            if metric['type'] != 'histogram':
+                lines.append(f'{name}{_labels(names, labels)} {_number(value)}')
+                continue
+            cumulative = 0
+            bounds = list(metric['buckets']) + [float('inf')]
+            for bound, count in zip(bounds, value):
+                cumulative += count
+                le = _number(bound if isinstance(bound, float) else float(bound))
+                lines.append(f'{name}_bucket{_labels(names, labels, [("le", le)])} {cumulative}')
+            lines.append(f'{name}_sum{_labels(names, labels)} {_number(float(value[-2]))}')
+            lines.append(f'{name}_count{_labels(names, labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
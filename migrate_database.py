@@ -0,0 +1,62 @@
+"""
+migrate_database.py
+
+Bring an existing emotion_detection.db up to the current schema.
+
+Moves image BLOBs out of the predictions table into the content-addressed
+image store (duplicates are stored once) and rebuilds image tables created
+with their BLOB column before the others. Safe to interrupt and re-run.
+--vacuum also switches the file to auto_vacuum=INCREMENTAL, so the retention
+job (retention.py) can give space back without a full VACUUM again.
+
+Usage:
+    python migrate_database.py [db_file] [--vacuum] [--rebuild-stats]
+"""
+import argparse
+import os
+
+from db import DB_FILE, connect, ensure_schema
+from aggregates import rebuild_statistics
+
+
+def file_size_mb(path):
+    return os.path.getsize(path) / (1024 * 1024) if os.path.exists(path) else 0.0
+
+
+def migrate(db_file=DB_FILE, vacuum=False, rebuild_stats=False):
+    """Run all schema migrations on db_file."""
+    if not os.path.exists(db_file):
+        print(f"❌ Database not found: {db_file}")
+        return False
+
+    print(f"📊 Migrating database: {db_file} ({file_size_mb(db_file):.2f} MB)")
+    conn = connect(db_file)
+    ensure_schema(conn, progress=lambda n: print(f"   Moved {n} images into the image store..."))
+
+    predictions = conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+    images, image_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images").fetchone()
+    print(f"✅ Schema up to date: {predictions} predictions, {images} distinct images "
+          f"({image_bytes / (1024 * 1024):.2f} MB)")
+
+    if rebuild_stats:
+        print("🔄 Rebuilding statistics aggregates...")
+        rebuild_statistics(conn)
+
+    if vacuum:
+        print("🧹 Reclaiming free pages (VACUUM)...")
+        # Takes effect through this VACUUM; later space is reclaimed incrementally
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        print(f"✅ Database size now {file_size_mb(db_file):.2f} MB")
+
+    conn.close()
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate emotion_detection.db to the current schema')
+    parser.add_argument('db_file', nargs='?', default=DB_FILE)
+    parser.add_argument('--vacuum', action='store_true', help='VACUUM afterwards to shrink the file')
+    parser.add_argument('--rebuild-stats', action='store_true', help='Recompute the statistics aggregates')
+    args = parser.parse_args()
+    migrate(args.db_file, vacuum=args.vacuum, rebuild_stats=args.rebuild_stats)
@@ -1,76 +1,75 @@
 import os
-import cv2
-import numpy as np
-import os
-import cv2
-import numpy as np
 from sklearn.neural_network import MLPClassifier
 from sklearn.metrics import accuracy_score, classification_report
 import joblib
 import kagglehub
 
-# Download latest version
-path = kagglehub.dataset_download("samithsachidanandan/human-face-emotions")
+from dataset import load_dataset, to_features
+
+TRAIN_DIR = '/root/.cache/kagglehub/datasets/samithsachidanandan/human-face-emotions/versions/2/Data'
+# TEST_DIR = '/root/.cache/kagglehub/datasets/msambare/fer2013/versions/1/train'
 
-print("Path to dataset files:", path)
 
+def load_data(data_dir):
+    """
+    Load a folder-per-class image dataset as uint8 (N, 2304) pixels.
 
-train_dir = '/root/.cache/kagglehub/datasets/samithsachidanandan/human-face-emotions/versions/2/Data'
-# test_dir = '/root/.cache/kagglehub/datasets/msambare/fer2013/versions/1/train'
+    Decoding runs in a process pool and the result is cached as a
+    memory-mapped .npy (see dataset.py), so repeat runs skip it.
+    """
+    return load_dataset(data_dir, progress=lambda done, total: print(f"Decoded {done}/{total}", end='\r'))
 
-print("Train folders:", os.listdir(train_dir))
-# print("Test folders:", os.listdir(test_dir))
 
+def main():
+    # Download latest version
+    path = kagglehub.dataset_download("samithsachidanandan/human-face-emotions")
 
+    print("Path to dataset files:", path)
 
-def load_data(data_dir):
-    X, y = [], []
-    classes = os.listdir(data_dir)
-    classes.sort() # Sort classes to ensure consistent labeling
-    class_to_label = {c: i for i, c in enumerate(classes)}
+    train_dir = TRAIN_DIR
+    print("Train folders:", os.listdir(train_dir))
+    # print("Test folders:", os.listdir(test_dir))
 
-    for emotion in classes:
-        emotion_dir = os.path.join(data_dir, emotion)
-        for img_name in os.listdir(emotion_dir):
-            img_path = os.path.join(emotion_dir, img_name)
-            img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
-            img = cv2.resize(img, (48, 48))
-            X.append(img.flatten())   # flatten for scikit-learn
-            y.append(class_to_label[emotion])
+    X_train, y_train, train_class_names = load_data(train_dir)
+    # X_test, y_test, test_class_names = load_data(TEST_DIR)
 
-    return np.array(X), np.array(y), classes
+    print("\nTraining samples:", len(X_train))
+    # print("Test samples:", len(X_test))
+    print("Train Classes:", train_class_names)
+    # print("Test Classes:", test_class_names)
 
-X_train, y_train, train_class_names = load_data(train_dir)
-# X_test, y_test, test_class_names = load_data(test_dir)
+    # float32 in [0, 1]: half the memory of dividing by 255.0 in float64
+    X_train = to_features(X_train)
+    # X_test = to_features(X_test)
 
-print("Training samples:", len(X_train))
-# print("Test samples:", len(X_test))
-print("Train Classes:", train_class_names)
-# print("Test Classes:", test_class_names)
+    mlp = MLPClassifier(
+        hidden_layer_sizes=(256, 128),
+        activation='relu',
+        solver='adam',
+        batch_size=300,
+        learning_rate_init=0.002,
+        max_iter=80,
+        verbose=True,
+        random_state=42
+    )
 
+    mlp.fit(X_train, y_train)
 
-X_train = X_train / 255.0
-# X_test = X_test / 255.0
+    # y_pred = mlp.predict(X_test)
 
-mlp = MLPClassifier(
-    hidden_layer_sizes=(256, 128),
-    activation='relu',
-    solver='adam',
-    batch_size=300,
-    learning_rate_init=0.002,
-    max_iter=80,
-    verbose=True,
-    random_state=42
-)
+    # print("Accuracy:", accuracy_score(y_test, y_pred))
+    # print("\nClassification Report:\n", classification_report(y_test, y_pred, target_names=test_class_names))
 
-mlp.fit(X_train, y_train)
+    joblib.dump(mlp, "model.pkl")
 
-# y_pred = mlp.predict(X_test)
+    # Memory-mappable float32 copy of the weights that app.py serves from
+    from export_model import export
+    export("model.pkl", "model_weights")
 
-# print("Accuracy:", accuracy_score(y_test, y_pred))
-# print("\nClassification Report:\n", classification_report(y_test, y_pred, target_names=test_class_names))
+    from google.colab import files
+    files.download("model.pkl")
 
-joblib.dump(mlp, "model.pkl")
 
-from google.colab import files
-files.download("model.pkl")
\ No newline at end of file
+# The guard keeps the loader's worker processes from re-running training
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,375 @@
+"""
+persistence.py
+
+Prediction persistence for the emotion detection app.
+
+write_predictions() inserts a group of prediction rows and updates the users
+table in one transaction. PredictionWriter puts a write-behind queue in front
+of it: requests get their prediction ids immediately (from a block reserved in
+sqlite_sequence) and a background thread commits queued rows in batches, so
+disk sync latency no longer sits on the response path.
+
+Those ids have already been returned to clients when a write fails, so the
+writer retries with backoff and then falls back to one upload at a time,
+and only rows that can't be written on their own are dropped (and logged).
+"""
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from db import get_connection, transaction
+from image_store import put_image
+from metrics import SIZE_BUCKETS, histogram
+from thumbnails import get_thumbnail, store_thumbnails
+
+
+COMMIT_SECONDS = histogram('emotion_db_commit_seconds', 'Prediction write transaction latency')
+COMMIT_ROWS = histogram('emotion_db_commit_rows', 'Prediction rows per write transaction',
+                        buckets=SIZE_BUCKETS)
+
+WRITE_ATTEMPTS = 5        # Tries per transaction on sqlite3.OperationalError
+RETRY_DELAY = 0.05        # Seconds before the first retry, doubled each time
+RETRY_MAX_DELAY = 1.0
+
+
+def write_predictions(conn: sqlite3.Connection, records: list, thumbnail_sizes=()) -> list:
+    """
+    Insert prediction records and update user counters in one transaction.
+
+    Image bytes go to the content-addressed image store; the prediction row
+    only keeps their hash. Thumbnails in thumbnail_sizes are generated for
+    images that don't have them yet.
+
+    Records with an 'id' use it as the primary key; others get the next
+    AUTOINCREMENT id. Returns the ids in input order.
+
+    Records sharing an 'upload' dict (the faces of one image) are linked to
+    a single uploads row, inserted with them. Its id is taken from
+    upload['id'] or, if that is missing, assigned here and stored back.
+    """
+    cursor = conn.cursor()
+    prediction_ids = []
+    user_first_seen = {}
+    user_counts = {}
+    new_images = {}
+    written_uploads = set()
+
+    with transaction(conn):
+        for record in records:
+            timestamp = record.get('timestamp') or datetime.utcnow().isoformat()
+            image_hash = put_image(conn, record['image_bytes'])
+            if thumbnail_sizes and record.get('storage_mode') != 'tensor':
+                new_images.setdefault(image_hash, record['image_bytes'])
+
+            upload = record.get('upload')
+            if upload is not None and id(upload) not in written_uploads:
+                cursor.execute("""
+                    INSERT OR IGNORE INTO uploads
+                    (id, user_name, image_path, image_hash, face_count, timestamp, source)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (upload.get('id'), record['user_name'], record['image_path'], image_hash,
+                      upload['face_count'], timestamp, record['source']))
+                if upload.get('id') is None:
+                    upload['id'] = cursor.lastrowid
+                written_uploads.add(id(upload))
+
+            face_box = record.get('face_box')
+            cursor.execute("""
+                INSERT INTO predictions
+                (id, user_name, image_path, image_hash, predicted_emotion,
+                 confidence, all_probabilities, timestamp, source, upload_id, face_box,
+                 storage_mode)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                record.get('id'),
+                record['user_name'],
+                record['image_path'],
+                image_hash,
+                record['predicted_emotion'],
+                record['confidence'],
+                json.dumps(record['all_probs']),
+                timestamp,
+                record['source'],
+                upload['id'] if upload is not None else None,
+                json.dumps(list(face_box)) if face_box is not None else None,
+                record.get('storage_mode', 'jpeg')
+            ))
+            prediction_ids.append(cursor.lastrowid)
+
+            user_name = record['user_name']
+            user_counts[user_name] = user_counts.get(user_name, 0) + 1
+            user_first_seen.setdefault(user_name, timestamp)
+
+        # Update user statistics
+        for user_name, count in user_counts.items():
+            cursor.execute("""
+                UPDATE users
+                SET total_predictions = total_predictions + ?
+                WHERE name = ?
+            """, (count, user_name))
+            if cursor.rowcount == 0:
+                cursor.execute("""
+                    INSERT INTO users (name, first_used, total_predictions)
+                    VALUES (?, ?, ?)
+                """, (user_name, user_first_seen[user_name], count))
+
+        for image_hash, data in new_images.items():
+            missing = [size for size in thumbnail_sizes
+                       if get_thumbnail(conn, image_hash, size) is None]
+            if missing:
+                store_thumbnails(conn, image_hash, data, missing)
+
+    return prediction_ids
+
+
+def reserve_ids(conn: sqlite3.Connection, table: str, count: int) -> range:
+    """
+    Reserve a block of AUTOINCREMENT ids of table by advancing sqlite_sequence.
+
+    The reservation is atomic across processes, so every gunicorn worker can
+    hand out ids before the rows are written without colliding.
+    """
+    with transaction(conn):
+        conn.execute(f"""
+            INSERT INTO sqlite_sequence (name, seq)
+            SELECT ?, COALESCE(MAX(id), 0) FROM {table}
+            WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)
+        """, (table, table))
+        conn.execute("""
+            UPDATE sqlite_sequence SET seq = seq + ? WHERE name = ?
+        """, (count, table))
+        end = conn.execute("""
+            SELECT seq FROM sqlite_sequence WHERE name = ?
+        """, (table,)).fetchone()[0]
+    return range(end - count + 1, end + 1)
+
+
+def reserve_prediction_ids(conn: sqlite3.Connection, count: int) -> range:
+    """Reserve a block of prediction ids (see reserve_ids)."""
+    return reserve_ids(conn, 'predictions', count)
+
+
+class PredictionWriter:
+    """
+    Write-behind queue for prediction rows.
+
+    synchronous=True writes inline in the caller (useful for tests and
+    scripts). Otherwise rows are committed by a background thread in groups of
+    up to batch_size. When max_pending rows are already queued, submit() waits
+    up to put_timeout seconds and then writes inline, so a slow disk slows
+    requests down instead of growing the backlog without bound.
+
+    thumbnail_sizes are precomputed for new images as part of each write, so
+    the cost lands on the writer thread instead of the first /image request.
+    Write failures go to logger (the app passes its own).
+    """
+
+    def __init__(self, db_file, batch_size=64, flush_interval=0.05, max_pending=1000,
+                 put_timeout=1.0, id_block_size=64, synchronous=False, connect=None,
+                 thumbnail_sizes=(), logger=None):
+        self.db_file = db_file
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+        self.id_block_size = id_block_size
+        self.synchronous = synchronous
+        self.thumbnail_sizes = tuple(thumbnail_sizes)
+        self._connect = connect or (lambda: get_connection(self.db_file))
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._lock = threading.Lock()
+        self._ids = {}  # table -> iterator over its reserved id block
+        self._pending_images = {}
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._closed = False
+
+        self.written = 0
+        self.failed = 0
+        self.retried = 0
+        self.inline_writes = 0
+
+    # ---------------- worker lifecycle ----------------
+
+    def _ensure_started(self):
+        # Threads and reserved ids don't survive fork(): each process starts
+        # its own writer thread and reserves its own id blocks.
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                self._ids = {}
+                self._pending_images = {}
+            self._queue = queue.Queue(maxsize=self.max_pending)
+            self._thread = threading.Thread(target=self._run, name='prediction-writer', daemon=True)
+            self._pid = os.getpid()
+            self._closed = False
+            self._thread.start()
+
+    def _next_ids(self, count, table='predictions'):
+        ids = []
+        with self._lock:
+            while len(ids) < count:
+                next_id = next(self._ids.get(table, iter(())), None)
+                if next_id is None:
+                    block = reserve_ids(self._connect(), table, max(self.id_block_size, count - len(ids)))
+                    self._ids[table] = iter(block)
+                    continue
+                ids.append(next_id)
+        return ids
+
+    def _write(self, records):
+        started = time.perf_counter()
+        ids = write_predictions(self._connect(), records, self.thumbnail_sizes)
+        COMMIT_SECONDS.observe(time.perf_counter() - started)
+        COMMIT_ROWS.observe(len(records))
+        return ids
+
+    def _run(self):
+        q = self._queue
+        while True:
+            item = q.get()
+            if item is None:
+                q.task_done()
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    item = q.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    q.task_done()
+                    stop = True
+                    break
+                batch.append(item)
+
+            self._write_batch(batch)
+            for _ in batch:
+                q.task_done()
+            if stop:
+                return
+
+    def _write_with_retry(self, records, attempts=WRITE_ATTEMPTS):
+        """Write records in one transaction, retrying transient errors with exponential backoff."""
+        delay = RETRY_DELAY
+        for attempt in range(attempts):
+            try:
+                return self._write(records)
+            except sqlite3.OperationalError as e:
+                if attempt == attempts - 1:
+                    raise
+                self.retried += 1
+                self.logger.warning("Prediction write failed (%s), retrying in %.2fs", e, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, RETRY_MAX_DELAY)
+
+    def _drop(self, records, error):
+        self.failed += len(records)
+        self.logger.error("Dropped predictions %s: %s",
+                          ', '.join(str(record.get('id')) for record in records), error)
+
+    def _write_batch(self, batch):
+        try:
+            self._write_with_retry(batch)
+            self.written += len(batch)
+        except Exception as e:
+            # One bad row mustn't take the rest of the batch with it: write
+            # each upload (the faces of one image) on its own
+            groups = {}
+            for record in batch:
+                groups.setdefault(id(record.get('upload') or record), []).append(record)
+            if len(groups) == 1:
+                self._drop(batch, e)
+                return
+            self.logger.warning("Writing %d predictions failed (%s); writing them one upload at a time",
+                                len(batch), e)
+            for group in groups.values():
+                try:
+                    self._write_with_retry(group, attempts=2)
+                    self.written += len(group)
+                except Exception as group_error:
+                    self._drop(group, group_error)
+        finally:
+            with self._lock:
+                for record in batch:
+                    self._pending_images.pop(record['id'], None)
+
+    # ---------------- public API ----------------
+
+    def submit(self, records: list) -> list:
+        """
+        Queue prediction records and return their ids straight away.
+
+        The ids are final: the rows are inserted with exactly these ids once
+        the background thread commits them. Upload dicts attached to the
+        records get their final 'id' here too.
+        """
+        if self.synchronous or self._closed:
+            return self._write(records)
+
+        self._ensure_started()
+        uploads = {id(record['upload']): record['upload'] for record in records
+                   if record.get('upload') is not None and record['upload'].get('id') is None}
+        for upload, upload_id in zip(uploads.values(), self._next_ids(len(uploads), 'uploads')):
+            upload['id'] = upload_id
+        timestamp = datetime.utcnow().isoformat()
+        queued = []
+        for record, prediction_id in zip(records, self._next_ids(len(records))):
+            queued.append(dict(record, id=prediction_id, timestamp=record.get('timestamp') or timestamp))
+
+        with self._lock:
+            for record in queued:
+                self._pending_images[record['id']] = (record['image_bytes'],
+                                                      record.get('storage_mode', 'jpeg'))
+
+        for position, record in enumerate(queued):
+            try:
+                self._queue.put(record, timeout=self.put_timeout)
+            except queue.Full:
+                # Backpressure: write the rest inline instead of queueing
+                self.inline_writes += len(queued) - position
+                self._write_batch(queued[position:])
+                break
+
+        return [record['id'] for record in queued]
+
+    def pending_image(self, prediction_id):
+        """(image bytes, storage mode) of a queued row that hasn't been committed yet, or None."""
+        with self._lock:
+            return self._pending_images.get(prediction_id)
+
+    def flush(self):
+        """Block until every queued row has been committed."""
+        if self._queue is not None and self._pid == os.getpid():
+            self._queue.join()
+
+    def close(self):
+        """Flush pending rows and stop the writer thread (shutdown hook)."""
+        if self._queue is None or self._pid != os.getpid() or self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self):
+        return {
+            'synchronous': self.synchronous,
+            'pending': self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0,
+            'max_pending': self.max_pending,
+            'written': self.written,
+            'failed': self.failed,
+            'retried': self.retried,
+            'inline_writes': self.inline_writes,
+        }
@@ -0,0 +1,213 @@
+"""
+preprocessing.py
+
+Single-decode image pipeline shared by the upload, webcam and batch routes.
+
+Raw image bytes are decoded exactly once, straight to grayscale. The same
+grayscale buffer then feeds both the float32 48x48 model input and the JPEG
+stored in the database, so no PIL/RGB round trips are needed.
+
+With a face detector the model input is a crop around the largest face
+instead of the whole frame; the stored JPEG is still the whole image.
+
+Large JPEGs are decoded at reduced scale (see DECODE_MAX_SIDE), and that
+decoded image is what gets stored: a 4000x3000 photo is kept at 2000x1500.
+Use the 'original' mode when the full resolution must be kept.
+
+What gets stored is set by StorageOptions.mode:
+
+    jpeg      the decoded grayscale image as JPEG (the default, as before)
+    preview   grayscale WebP or JPEG no larger than preview_side pixels
+    tensor    the exact 2304-byte uint8 48x48 model input, so a stored
+              prediction can be re-scored bit for bit
+    original  the uploaded bytes, untouched
+"""
+from collections import namedtuple
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from faces import crop_face
+from metrics import stage
+
+IMG_SIZE = (48, 48)  # Model expects 48x48 images
+JPEG_QUALITY = 75  # Same as PIL's default, which the routes used before
+
+# JPEGs larger than this (longest side, in pixels) are decoded at 1/2, 1/4 or
+# 1/8 scale by the JPEG decoder itself, as long as the result stays at least
+# this big. A 12 MP phone photo is decoded at 2000x1500 instead of 4000x3000.
+DECODE_MAX_SIDE = 1024
+
+_REDUCED_GRAYSCALE = {
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+STORAGE_MODES = ('jpeg', 'preview', 'tensor', 'original')
+TENSOR_BYTES = IMG_SIZE[0] * IMG_SIZE[1]
+
+StorageOptions = namedtuple('StorageOptions', ['mode', 'quality', 'preview_side', 'preview_format'],
+                            defaults=('jpeg', JPEG_QUALITY, 256, 'webp'))
+StorageOptions.__doc__ = """
+How prepare_image() encodes the stored copy of an image.
+
+mode:           one of STORAGE_MODES
+quality:        JPEG / WebP quality for the jpeg and preview modes
+preview_side:   longest side of a preview, in pixels
+preview_format: 'webp' or 'jpeg'
+"""
+
+PreparedImage = namedtuple('PreparedImage', ['gray', 'pixels', 'features', 'stored_bytes', 'faces', 'storage_mode'],
+                           defaults=(None, 'jpeg'))
+PreparedImage.__doc__ = """
+Everything derived from one decoded image.
+
+gray:         full (possibly DCT-reduced) grayscale uint8 image
+pixels:       48x48 uint8 model image (largest face if one was found)
+features:     (1, 2304) float32 model input, normalized to 0-1
+stored_bytes: image bytes for the image store, encoded per storage_mode
+faces:        faces.FaceDetection, or None when detection wasn't run
+storage_mode: how stored_bytes was made (see StorageOptions)
+"""
+
+
+def _reduction_factor(data: bytes, max_side) -> int:
+    """Pick the largest JPEG DCT scale factor that keeps the image >= max_side."""
+    if not max_side or data[:2] != b'\xff\xd8':  # Only JPEGs support reduced decode
+        return 1
+    try:
+        width, height = Image.open(BytesIO(data)).size  # Header only, no decode
+    except Exception:
+        return 1
+    longest = max(width, height)
+    factor = 1
+    for candidate in (2, 4, 8):
+        if longest // candidate >= max_side:
+            factor = candidate
+    return factor
+
+
+def decode_grayscale(data: bytes, max_side=DECODE_MAX_SIDE) -> np.ndarray:
+    """Decode image bytes straight into a 2D uint8 grayscale array."""
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    factor = _reduction_factor(data, max_side)
+    flags = _REDUCED_GRAYSCALE.get(factor, cv2.IMREAD_GRAYSCALE)
+
+    gray = cv2.imdecode(buffer, flags)
+    if gray is None:
+        # Formats OpenCV can't read (e.g. some GIF/TIFF variants)
+        gray = np.asarray(Image.open(BytesIO(data)).convert('L'))
+    return gray
+
+
+def to_pixels(gray: np.ndarray) -> np.ndarray:
+    """Resize a grayscale image to the 48x48 uint8 model image."""
+    if gray.ndim == 3:
+        gray = cv2.cvtColor(gray, cv2.COLOR_RGB2GRAY)
+    return cv2.resize(gray, IMG_SIZE)
+
+
+def to_features(pixels: np.ndarray) -> np.ndarray:
+    """
+    Flatten and normalize 48x48 uint8 pixels into a (1, 2304) float32 row.
+
+    An (n, 48, 48) stack gives an (n, 2304) matrix.
+    """
+    rows = pixels.reshape(-1, IMG_SIZE[0] * IMG_SIZE[1])
+    return np.multiply(rows, np.float32(1 / 255.0), dtype=np.float32)
+
+
+def encode_jpeg(gray: np.ndarray, quality=JPEG_QUALITY) -> bytes:
+    """Encode a grayscale array as a single-channel JPEG."""
+    ok, encoded = cv2.imencode('.jpg', gray, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError('JPEG encoding failed')
+    return encoded.tobytes()
+
+
+def encode_webp(gray: np.ndarray, quality=JPEG_QUALITY) -> bytes:
+    """Encode a grayscale array as a lossy WebP."""
+    ok, encoded = cv2.imencode('.webp', gray, [cv2.IMWRITE_WEBP_QUALITY, quality])
+    if not ok:
+        raise ValueError('WebP encoding failed')
+    return encoded.tobytes()
+
+
+def encode_stored(data: bytes, gray: np.ndarray, pixels: np.ndarray, options: StorageOptions) -> bytes:
+    """Bytes to keep in the image store for one image, per options.mode."""
+    if options.mode == 'jpeg':
+        return encode_jpeg(gray, quality=options.quality)
+    if options.mode == 'tensor':
+        return np.ascontiguousarray(pixels, dtype=np.uint8).tobytes()
+    if options.mode == 'original':
+        return bytes(data)
+    if options.mode == 'preview':
+        height, width = gray.shape[:2]
+        scale = options.preview_side / max(height, width)
+        if scale < 1:
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            gray = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+        if options.preview_format == 'webp':
+            return encode_webp(gray, quality=options.quality)
+        return encode_jpeg(gray, quality=options.quality)
+    raise ValueError(f"Unknown storage mode: {options.mode} (choose from {', '.join(STORAGE_MODES)})")
+
+
+def tensor_pixels(data: bytes) -> np.ndarray:
+    """The 48x48 uint8 model image stored by the tensor mode."""
+    if len(data) != TENSOR_BYTES:
+        raise ValueError(f'Stored tensor has {len(data)} bytes, expected {TENSOR_BYTES}')
+    return np.frombuffer(data, dtype=np.uint8).reshape(IMG_SIZE)
+
+
+def stored_pixels(data: bytes, storage_mode: str) -> np.ndarray:
+    """
+    Whole-image 48x48 model input recovered from stored bytes, for re-scoring.
+
+    Exact for 'tensor' rows (including face crops) and for 'original'; the
+    jpeg and preview modes give an approximation of the original input.
+    """
+    if storage_mode == 'tensor':
+        return tensor_pixels(data)
+    max_side = DECODE_MAX_SIDE if storage_mode == 'original' else None
+    return to_pixels(decode_grayscale(data, max_side))
+
+
+def face_pixels(gray: np.ndarray, boxes) -> np.ndarray:
+    """Stack 48x48 model images of every face box into an (n, 48, 48) array."""
+    return np.stack([to_pixels(crop_face(gray, box)) for box in boxes])
+
+
+def prepare_image(data: bytes, max_side=DECODE_MAX_SIDE, detect=None,
+                  storage: StorageOptions = StorageOptions()) -> PreparedImage:
+    """
+    Decode once and derive the model input and the stored image.
+
+    detect(gray) -> FaceDetection is optional; when it finds faces the model
+    input is the largest one, otherwise the whole image.
+    """
+    with stage('decode'):
+        gray = decode_grayscale(data, max_side)
+    faces = None
+    if detect is not None:
+        with stage('face_detect'):
+            faces = detect(gray)
+    with stage('preprocess'):
+        if faces is not None and faces.boxes:
+            pixels = to_pixels(crop_face(gray, faces.boxes[0]))
+        else:
+            pixels = to_pixels(gray)
+        features = to_features(pixels)
+    with stage('encode'):
+        stored_bytes = encode_stored(data, gray, pixels, storage)
+    return PreparedImage(
+        gray=gray,
+        pixels=pixels,
+        features=features,
+        stored_bytes=stored_bytes,
+        faces=faces,
+        storage_mode=storage.mode,
+    )
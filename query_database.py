@@ -3,11 +3,11 @@ query_database.py
 
 Script to query and view data from the emotion detection database.
 """
-import sqlite3
 import os
-from datetime import datetime
 
-DB_FILE = 'emotion_detection.db'
+from db import DB_FILE, ensure_schema, get_connection
+from aggregates import get_summary, rebuild_statistics
+from exporter import BATCH_SIZE, Export
 
 
 def check_database_exists():
@@ -24,33 +24,36 @@ def view_all_predictions():
     if not check_database_exists():
         return
     
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT id, user_name, image_path, predicted_emotion, 
-               confidence, timestamp, source
-        FROM predictions
-        ORDER BY timestamp DESC
-    """)
-    
-    predictions = cursor.fetchall()
-    conn.close()
+    conn = get_connection(DB_FILE)
+    total = conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
     
-    if not predictions:
+    if not total:
         print("📭 No predictions found yet")
         return
     
-    print(f"\n📊 PREDICTIONS ({len(predictions)} total)\n")
+    print(f"\n📊 PREDICTIONS ({total} total)\n")
     print("-" * 100)
     print(f"{'ID':<5} {'User':<15} {'Image':<25} {'Emotion':<10} {'Conf.':<8} {'Source':<10} {'Timestamp':<20}")
     print("-" * 100)
     
-    for pred in predictions:
-        pid, user, img_path, emotion, conf, timestamp, source = pred
-        img_name = img_path[:22] + '...' if img_path and len(img_path) > 25 else (img_path or 'N/A')
-        time_str = timestamp[:19] if timestamp else 'N/A'
-        print(f"{pid:<5} {user:<15} {img_name:<25} {emotion:<10} {conf:.3f}    {source:<10} {time_str:<20}")
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT id, user_name, image_path, predicted_emotion, 
+               confidence, timestamp, source
+        FROM predictions
+        ORDER BY timestamp DESC
+    """)
+    
+    # Printed a batch at a time rather than loading the whole table
+    while True:
+        predictions = cursor.fetchmany(BATCH_SIZE)
+        if not predictions:
+            break
+        for pred in predictions:
+            pid, user, img_path, emotion, conf, timestamp, source = pred
+            img_name = img_path[:22] + '...' if img_path and len(img_path) > 25 else (img_path or 'N/A')
+            time_str = timestamp[:19] if timestamp else 'N/A'
+            print(f"{pid:<5} {user:<15} {img_name:<25} {emotion:<10} {conf:.3f}    {source:<10} {time_str:<20}")
     
     print("-" * 100)
 
@@ -60,7 +63,7 @@ def view_users():
     if not check_database_exists():
         return
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_connection(DB_FILE)
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -70,7 +73,6 @@ def view_users():
     """)
     
     users = cursor.fetchall()
-    conn.close()
     
     if not users:
         print("📭 No users found yet")
@@ -94,43 +96,15 @@ def view_statistics():
     if not check_database_exists():
         return
     
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    # Total predictions
-    cursor.execute("SELECT COUNT(*) FROM predictions")
-    total_preds = cursor.fetchone()[0]
-    
-    # Predictions by emotion
-    cursor.execute("""
-        SELECT predicted_emotion, COUNT(*) as count
-        FROM predictions
-        GROUP BY predicted_emotion
-        ORDER BY count DESC
-    """)
-    emotions = cursor.fetchall()
-    
-    # Total users
-    cursor.execute("SELECT COUNT(*) FROM users")
-    total_users = cursor.fetchone()[0]
-    
-    # Source breakdown
-    cursor.execute("""
-        SELECT source, COUNT(*) as count
-        FROM predictions
-        GROUP BY source
-    """)
-    sources = cursor.fetchall()
-    
-    # Average confidence
-    cursor.execute("SELECT AVG(confidence) FROM predictions")
-    avg_conf = cursor.fetchone()[0]
+    # Maintained aggregates: no scans over predictions or images
+    summary = get_summary(get_connection(DB_FILE))
     
-    # Database size
-    cursor.execute("SELECT SUM(LENGTH(image_data)) FROM predictions")
-    total_size = cursor.fetchone()[0] or 0
-    
-    conn.close()
+    total_preds = summary['total_predictions']
+    total_users = summary['total_users']
+    avg_conf = summary['average_confidence']
+    total_size = summary['stored_image_bytes']
+    emotions = sorted(summary['emotions_count'].items(), key=lambda x: x[1], reverse=True)
+    sources = list(summary['source_count'].items())
     
     print("\n📊 DATABASE STATISTICS\n")
     print("=" * 60)
@@ -162,30 +136,32 @@ def view_image_info(prediction_id):
     if not check_database_exists():
         return
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_connection(DB_FILE)
     cursor = conn.cursor()
     
     cursor.execute("""
-        SELECT id, user_name, image_path, predicted_emotion, confidence,
-               all_probabilities, timestamp, source, LENGTH(image_data) as img_size
-        FROM predictions
-        WHERE id = ?
+        SELECT p.id, p.user_name, p.image_path, p.predicted_emotion, p.confidence,
+               p.all_probabilities, p.timestamp, p.source, COALESCE(i.size, a.size, 0) as img_size,
+               COALESCE(p.storage_mode, 'jpeg')
+        FROM predictions p
+        LEFT JOIN images i ON i.hash = p.image_hash
+        LEFT JOIN image_archive a ON a.hash = p.image_hash
+        WHERE p.id = ?
     """, (prediction_id,))
     
     result = cursor.fetchone()
-    conn.close()
     
     if not result:
         print(f"❌ Prediction ID {prediction_id} not found")
         return
     
-    pid, user, img_path, emotion, conf, all_probs, timestamp, source, img_size = result
+    pid, user, img_path, emotion, conf, all_probs, timestamp, source, img_size, storage_mode = result
     
     print(f"\n📸 PREDICTION DETAILS (ID: {pid})\n")
     print("=" * 60)
     print(f"User:              {user}")
     print(f"Image Path:        {img_path}")
-    print(f"Image Size:        {img_size / 1024:.2f} KB")
+    print(f"Image Size:        {img_size / 1024:.2f} KB ({storage_mode})")
     print(f"Predicted Emotion: {emotion}")
     print(f"Confidence:        {conf:.3f} ({conf*100:.1f}%)")
     print(f"Source:            {source}")
@@ -208,34 +184,57 @@ def export_to_csv():
     if not check_database_exists():
         return
     
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT id, user_name, image_path, predicted_emotion, confidence,
-               timestamp, source
-        FROM predictions
-        ORDER BY timestamp DESC
-    """)
-    
-    predictions = cursor.fetchall()
-    conn.close()
-    
-    if not predictions:
+    export = Export(get_connection(DB_FILE), 'csv')
+    if export.max_id is None:
         print("📭 No predictions to export")
         return
     
-    filename = f"predictions_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    filename = export.filename()
+    with open(filename, 'wb') as f:
+        export.write_to(f)
     
-    with open(filename, 'w', encoding='utf-8') as f:
-        # Header
-        f.write("ID,User,Image Path,Emotion,Confidence,Timestamp,Source\n")
-        
-        # Data
-        for pred in predictions:
-            f.write(','.join([str(x) for x in pred]) + '\n')
+    print(f"✅ Exported {export.rows} predictions to: {filename}")
+    print("   For JSON Lines, Parquet, gzip or incremental exports: python exporter.py --help")
+
+
+def view_storage_modes():
+    """Stored image bytes per prediction, by storage mode."""
+    if not check_database_exists():
+        return
+    
+    conn = get_connection(DB_FILE)
+    # Scans predictions; images shared by several predictions count once per mode
+    rows = conn.execute("""
+        SELECT mode, COUNT(*), COUNT(DISTINCT image_hash), SUM(size), SUM(archived)
+        FROM (
+            SELECT COALESCE(p.storage_mode, 'jpeg') AS mode, p.image_hash,
+                   COALESCE(i.size, a.size, 0) AS size, a.hash IS NOT NULL AS archived
+            FROM predictions p
+            LEFT JOIN images i ON i.hash = p.image_hash
+            LEFT JOIN image_archive a ON a.hash = p.image_hash
+        )
+        GROUP BY mode
+        ORDER BY mode
+    """).fetchall()
+    
+    print("\n🗜️  IMAGE STORAGE BY MODE\n")
+    print("=" * 60)
+    print(f"{'Mode':<10} {'Predictions':>12} {'Images':>8} {'Bytes/pred':>11} {'Archived':>9}")
+    print("-" * 60)
+    for mode, predictions, images, total_bytes, archived in rows:
+        print(f"{mode:<10} {predictions:>12} {images:>8} {total_bytes / predictions:>11.0f} {archived:>9}")
+    print("=" * 60)
+    print("   Set the mode for new predictions with STORAGE_MODE; compare modes with: python benchmark.py storage")
+
+
+def rebuild_statistics_command():
+    """Recompute the statistics aggregates from the base tables."""
+    if not check_database_exists():
+        return
     
-    print(f"✅ Exported {len(predictions)} predictions to: {filename}")
+    print("🔄 Rebuilding statistics aggregates...")
+    rebuild_statistics(get_connection(DB_FILE))
+    print("✅ Statistics rebuilt")
 
 
 def menu():
@@ -249,9 +248,11 @@ def menu():
         print("3. View Statistics")
         print("4. View Specific Prediction (by ID)")
         print("5. Export to CSV")
-        print("6. Exit")
+        print("6. Rebuild Statistics")
+        print("7. Storage by Mode")
+        print("8. Exit")
         
-        choice = input("\nEnter your choice (1-6): ").strip()
+        choice = input("\nEnter your choice (1-8): ").strip()
         
         if choice == '1':
             view_all_predictions()
@@ -268,6 +269,10 @@ def menu():
         elif choice == '5':
             export_to_csv()
         elif choice == '6':
+            rebuild_statistics_command()
+        elif choice == '7':
+            view_storage_modes()
+        elif choice == '8':
             print("👋 Goodbye!")
             break
         else:
@@ -278,4 +283,5 @@ if __name__ == '__main__':
     if not check_database_exists():
         print("\nRun this first: python init_database.py")
     else:
+        ensure_schema(get_connection(DB_FILE))
         menu()
@@ -0,0 +1,313 @@
+"""
+retention.py
+
+Retention policies for stored images, and incremental vacuum.
+
+A policy limits what stays in the images table by age (images stored more
+than max_age_days ago) and/or by total size (the oldest images beyond
+max_bytes). Images it selects are either archived to append-only segment
+files (image_archive.py), where /image can still read them, or deleted;
+prediction rows and their metadata are always kept. Age counts from when an
+image's bytes were first stored, even if an identical image was uploaded
+again later.
+
+The job works oldest-first in transactions of BATCH_SIZE images, so the
+write lock is only held briefly. Afterwards it returns freed pages to the
+file system with PRAGMA incremental_vacuum, a few pages at a time, which
+needs auto_vacuum=INCREMENTAL: new databases get it from db.create_tables();
+convert an existing one once with python migrate_database.py --vacuum.
+
+In the app, RetentionWorker runs the job every RETENTION_INTERVAL seconds
+when RETENTION_DAYS or RETENTION_MAX_MB is set. Under gunicorn each worker
+has one, and the archive lock lets only one of them run at a time.
+
+Usage:
+    python retention.py [db_file] [--days N] [--max-mb N] [--action archive|delete]
+                        [--dry-run] [--no-vacuum] [--reindex]
+"""
+import os
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from db import DB_FILE, connect, transaction
+from image_archive import ARCHIVE_DIR, SegmentWriter, archive_lock, archive_rows, reindex_archive
+from metrics import counter
+
+RETENTION_DAYS = float(os.environ['RETENTION_DAYS']) if os.environ.get('RETENTION_DAYS') else None
+RETENTION_MAX_MB = float(os.environ['RETENTION_MAX_MB']) if os.environ.get('RETENTION_MAX_MB') else None
+RETENTION_ACTION = os.environ.get('RETENTION_ACTION', 'archive')
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', '3600'))  # Seconds between runs in the app
+
+ACTIONS = ('archive', 'delete')
+BATCH_SIZE = 100       # Images per transaction
+VACUUM_PAGES = 256     # Pages released per incremental_vacuum step
+VACUUM_PAUSE = 0.01    # Seconds between steps, so writers get the lock
+
+RetentionPolicy = namedtuple('RetentionPolicy', ['max_age_days', 'max_bytes', 'action'])
+RetentionPolicy.__doc__ = """
+What the retention job keeps in the images table.
+
+max_age_days: images stored longer ago than this are moved out (None: no limit)
+max_bytes:    the oldest images beyond this total are moved out (None: no limit)
+action:       'archive' (to segment files, still served) or 'delete'
+"""
+
+RETAINED_IMAGES = counter('emotion_retention_images_total', 'Images moved out of the database by retention',
+                          ['action'])
+RETAINED_BYTES = counter('emotion_retention_bytes_total', 'Image bytes moved out of the database by retention',
+                         ['action'])
+
+
+def policy_from_env() -> RetentionPolicy:
+    max_bytes = int(RETENTION_MAX_MB * 1024 * 1024) if RETENTION_MAX_MB is not None else None
+    return RetentionPolicy(RETENTION_DAYS, max_bytes, RETENTION_ACTION)
+
+
+def policy_enabled(policy: RetentionPolicy) -> bool:
+    return policy.max_age_days is not None or policy.max_bytes is not None
+
+
+def stored_image_bytes(conn) -> int:
+    """Total size of the images still in the database (read off idx_images_created)."""
+    return conn.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()[0]
+
+
+def _eligible(rows, cutoff, excess):
+    """Leading (hash, size) pairs of oldest-first rows that the policy moves out."""
+    selected = []
+    for key, size, created_at in rows:
+        if not ((cutoff is not None and created_at < cutoff) or excess > 0):
+            break
+        selected.append((key, size))
+        excess -= size
+    return selected
+
+
+def _archive_batch(conn, writer: SegmentWriter, batch):
+    entries = []
+    for key, _ in batch:
+        row = conn.execute("SELECT data FROM images WHERE hash = ?", (key,)).fetchone()
+        if row is None:
+            continue
+        segment, offset, length, codec = writer.append(key, row[0])
+        entries.append((key, segment, offset, length, codec, len(row[0])))
+    # On disk before anything points at it
+    writer.sync()
+    with transaction(conn):
+        archive_rows(conn, entries)
+        conn.executemany("DELETE FROM images WHERE hash = ?", [(entry[0],) for entry in entries])
+
+
+def _delete_batch(conn, batch):
+    with transaction(conn):
+        conn.executemany("DELETE FROM images WHERE hash = ?", [(key,) for key, _ in batch])
+        conn.executemany("DELETE FROM image_variants WHERE hash = ?", [(key,) for key, _ in batch])
+
+
+def incremental_vacuum(conn, pages=VACUUM_PAGES, pause=VACUUM_PAUSE) -> int:
+    """Release free pages to the file system in small steps; returns pages released."""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:  # 2 = INCREMENTAL
+        return 0
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    released = 0
+    for _ in range(-(-free // pages)):
+        # Each step is its own short write transaction. executescript() steps
+        # the pragma to completion; execute() would free a single page.
+        conn.executescript(f"PRAGMA incremental_vacuum({pages});")
+        remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        released += free - remaining
+        if remaining == 0 or remaining == free:
+            break
+        free = remaining
+        time.sleep(pause)
+    # Copy the shrunken pages back so the file itself gets shorter
+    conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+    return released
+
+
+def run_retention(conn, policy: RetentionPolicy, archive_dir=ARCHIVE_DIR, batch_size=BATCH_SIZE,
+                  dry_run=False, vacuum=True, blocking=True, now=None):
+    """
+    Apply policy to the images table; returns a summary dict.
+
+    With blocking=False the run is skipped (and None returned) while another
+    process holds the archive lock. dry_run only counts what would move.
+    """
+    if policy.action not in ACTIONS:
+        raise ValueError(f"Unknown retention action: {policy.action} (choose from {', '.join(ACTIONS)})")
+    now = now or datetime.utcnow()
+    cutoff = (now - timedelta(days=policy.max_age_days)).isoformat() if policy.max_age_days is not None else None
+    total_before = stored_image_bytes(conn)
+    excess = total_before - policy.max_bytes if policy.max_bytes is not None else 0
+    result = {'action': policy.action, 'dry_run': dry_run, 'images': 0, 'bytes': 0,
+              'stored_bytes_before': total_before, 'pages_released': 0}
+
+    if dry_run:
+        rows = conn.execute("SELECT hash, size, created_at FROM images ORDER BY created_at")
+        selected = _eligible(rows, cutoff, excess)
+        result['images'] = len(selected)
+        result['bytes'] = sum(size for _, size in selected)
+        return result
+
+    started = time.perf_counter()
+    with archive_lock(archive_dir, blocking=blocking) as locked:
+        if not locked:
+            return None
+        writer = SegmentWriter(archive_dir) if policy.action == 'archive' else None
+        try:
+            while True:
+                rows = conn.execute("""
+                    SELECT hash, size, created_at FROM images ORDER BY created_at LIMIT ?
+                """, (batch_size,)).fetchall()
+                batch = _eligible(rows, cutoff, excess)
+                if not batch:
+                    break
+                if writer is not None:
+                    _archive_batch(conn, writer, batch)
+                else:
+                    _delete_batch(conn, batch)
+                moved = sum(size for _, size in batch)
+                excess -= moved
+                result['images'] += len(batch)
+                result['bytes'] += moved
+                RETAINED_IMAGES.inc(len(batch), policy.action)
+                RETAINED_BYTES.inc(moved, policy.action)
+                if len(batch) < len(rows):
+                    break
+        finally:
+            if writer is not None:
+                writer.close()
+
+    if vacuum:
+        result['pages_released'] = incremental_vacuum(conn)
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+
+class RetentionWorker:
+    """
+    Runs run_retention() every interval seconds on a background thread.
+
+    Threads don't survive fork(), so each process starts its own on first
+    use (ensure_started()); runs that find the archive lock taken are
+    skipped.
+    """
+
+    def __init__(self, db_file, policy: RetentionPolicy, interval=RETENTION_INTERVAL,
+                 archive_dir=ARCHIVE_DIR):
+        self.db_file = db_file
+        self.policy = policy
+        self.interval = interval
+        self.archive_dir = archive_dir
+        self._lock = threading.Lock()
+        self._pid = None
+
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+        self.last_result = None
+        self.last_error = None
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='retention', daemon=True).start()
+
+    def run_once(self):
+        conn = connect(self.db_file)
+        try:
+            result = run_retention(conn, self.policy, self.archive_dir, blocking=False)
+        finally:
+            conn.close()
+        with self._lock:
+            if result is None:
+                self.skipped += 1
+            else:
+                self.runs += 1
+                self.last_result = dict(result, finished_at=datetime.utcnow().isoformat())
+        return result
+
+    def _run(self):
+        # Give startup a head start before the first pass
+        time.sleep(min(self.interval, 60.0))
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                with self._lock:
+                    self.failures += 1
+                    self.last_error = str(e)
+            time.sleep(self.interval)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'policy': self.policy._asdict(),
+                'interval': self.interval,
+                'runs': self.runs,
+                'skipped': self.skipped,
+                'failures': self.failures,
+                'last_result': self.last_result,
+                'last_error': self.last_error,
+            }
+
+
+def main(argv=None):
+    import argparse
+
+    defaults = policy_from_env()
+    parser = argparse.ArgumentParser(description='Archive or delete old images and reclaim space')
+    parser.add_argument('db_file', nargs='?', default=DB_FILE)
+    parser.add_argument('--days', type=float, default=defaults.max_age_days,
+                        help='Move out images stored more than this many days ago')
+    parser.add_argument('--max-mb', type=float, default=None,
+                        help='Move out the oldest images beyond this many MB in the database')
+    parser.add_argument('--action', choices=ACTIONS, default=defaults.action)
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR)
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would be moved')
+    parser.add_argument('--no-vacuum', action='store_true', help='Skip the incremental vacuum')
+    parser.add_argument('--reindex', action='store_true',
+                        help='Rebuild the image_archive table from the segment files and exit')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db_file):
+        print(f"❌ Database not found: {args.db_file}")
+        return 1
+    conn = connect(args.db_file)
+
+    if args.reindex:
+        added = reindex_archive(conn, args.archive_dir)
+        print(f"✅ Re-indexed {added} archived images from {args.archive_dir}")
+        return 0
+
+    max_bytes = int(args.max_mb * 1024 * 1024) if args.max_mb is not None else defaults.max_bytes
+    policy = RetentionPolicy(args.days, max_bytes, args.action)
+    if not policy_enabled(policy):
+        print("❌ No policy: pass --days and/or --max-mb (or set RETENTION_DAYS / RETENTION_MAX_MB)")
+        return 2
+
+    result = run_retention(conn, policy, args.archive_dir, dry_run=args.dry_run, vacuum=not args.no_vacuum)
+    mb = result['bytes'] / (1024 * 1024)
+    if args.dry_run:
+        print(f"🔎 Would {policy.action} {result['images']} images ({mb:.2f} MB) "
+              f"of {result['stored_bytes_before'] / (1024 * 1024):.2f} MB stored")
+        return 0
+
+    verb = 'Archived' if policy.action == 'archive' else 'Deleted'
+    print(f"✅ {verb} {result['images']} images ({mb:.2f} MB) in {result['seconds']:.2f}s; "
+          f"released {result['pages_released']} free pages")
+    if not args.no_vacuum and conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        print("💡 auto_vacuum is not INCREMENTAL on this database, so the file won't shrink; "
+              "convert it once with: python migrate_database.py --vacuum")
+    conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,130 @@
+"""
+smoothing.py
+
+Per-session temporal smoothing for webcam prediction streams.
+
+Consecutive webcam frames produce flickering predictions. A TemporalSmoother
+keeps a compact state per session (the smoothed probability vector, the
+displayed label and the last processed 48x48 frame) and:
+
+- smooths probabilities with an EMA, or by majority vote over a window;
+- only switches the displayed emotion when the challenger beats it by a
+  hysteresis margin;
+- lets callers skip inference when a frame barely differs from the last
+  processed one, reusing the smoothed result instead.
+
+SmootherRegistry holds one smoother per session id and drops idle ones.
+"""
+import threading
+from collections import deque
+
+import cv2
+import numpy as np
+
+from cache import SessionStore
+
+SMOOTHING_MODES = ('ema', 'majority')
+
+
+def frame_difference(a: np.ndarray, b: np.ndarray) -> float:
+    """Mean absolute difference between two uint8 frames, in gray levels."""
+    return float(cv2.absdiff(a, b).mean())
+
+
+class TemporalSmoother:
+    """
+    Smoothed predictions for one stream.
+
+    mode='ema' uses an exponential moving average with alpha = 2/(window+1);
+    mode='majority' votes over the argmax of the last window frames and
+    reports their mean probabilities. skip_threshold is the mean absolute
+    48x48 difference below which a frame may reuse the previous result, for
+    at most max_skip frames in a row.
+    """
+
+    __slots__ = ('mode', 'window', 'hysteresis', 'skip_threshold', 'max_skip', 'alpha',
+                 'probabilities', 'label', 'last_pixels', 'skipped',
+                 '_votes', '_history')
+
+    def __init__(self, mode='ema', window=5, hysteresis=0.1, skip_threshold=0.0, max_skip=10):
+        if mode not in SMOOTHING_MODES:
+            raise ValueError(f'Unknown smoothing mode: {mode}')
+        self.mode = mode
+        self.window = max(int(window), 1)
+        self.hysteresis = hysteresis
+        self.skip_threshold = skip_threshold
+        self.max_skip = max_skip
+        self.alpha = np.float32(2.0 / (self.window + 1))
+
+        self.probabilities = None  # Smoothed probability vector (float32)
+        self.label = None  # Displayed class index
+        self.last_pixels = None  # Last frame that went through the model
+        self.skipped = 0  # Consecutive frames answered without inference
+        self._votes = deque(maxlen=self.window) if mode == 'majority' else None
+        self._history = deque(maxlen=self.window) if mode == 'majority' else None
+
+    def should_skip(self, pixels: np.ndarray) -> bool:
+        """True if pixels are close enough to the last processed frame to reuse its result."""
+        if (self.probabilities is None or self.skip_threshold <= 0
+                or self.skipped >= self.max_skip):
+            return False
+        if frame_difference(pixels, self.last_pixels) >= self.skip_threshold:
+            return False
+        self.skipped += 1
+        return True
+
+    def update(self, pixels: np.ndarray, probabilities: np.ndarray):
+        """Fold in a new model output; returns (label, smoothed probabilities)."""
+        probabilities = np.asarray(probabilities, dtype=np.float32)
+        self.last_pixels = pixels.copy()
+        self.skipped = 0
+
+        if self.mode == 'ema':
+            if self.probabilities is None:
+                self.probabilities = probabilities.copy()
+            else:
+                self.probabilities += self.alpha * (probabilities - self.probabilities)
+            scores = self.probabilities
+        else:
+            self._votes.append(int(np.argmax(probabilities)))
+            self._history.append(probabilities)
+            self.probabilities = np.mean(self._history, axis=0, dtype=np.float32)
+            scores = np.bincount(self._votes, minlength=len(probabilities)) / len(self._votes)
+
+        best = int(np.argmax(scores))
+        if self.label is None or scores[best] - scores[self.label] >= self.hysteresis:
+            self.label = best
+        return self.current()
+
+    def current(self):
+        """The last smoothed (label, probabilities)."""
+        return self.label, self.probabilities
+
+
+class SmootherRegistry(SessionStore):
+    """One TemporalSmoother per session id, dropped when idle, plus skip counters."""
+
+    def __init__(self, max_sessions=10000, idle_timeout=120.0, **smoother_options):
+        super().__init__(lambda: TemporalSmoother(**smoother_options),
+                         max_sessions=max_sessions, idle_timeout=idle_timeout)
+        self._counter_lock = threading.Lock()
+        self.skipped_frames = 0
+        self.processed_frames = 0
+
+    def count(self, skipped: bool):
+        with self._counter_lock:
+            if skipped:
+                self.skipped_frames += 1
+            else:
+                self.processed_frames += 1
+
+    def stats(self):
+        with self._counter_lock:
+            frames = self.skipped_frames + self.processed_frames
+            return {
+                'sessions': len(self),
+                'evicted': self.evicted,
+                'processed_frames': self.processed_frames,
+                'skipped_frames': self.skipped_frames,
+                'skip_rate': self.skipped_frames / frames if frames else 0.0,
+            }
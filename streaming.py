@@ -0,0 +1,158 @@
+"""
+streaming.py
+
+Sessions for streaming webcam inference.
+
+A client opens a session, posts raw JPEG frames to it and reads predictions
+back from a Server-Sent Events stream. Each session holds only the newest
+unprocessed frame: a frame that arrives while the previous one is still
+waiting replaces it, so when inference falls behind, stale frames are
+dropped instead of queueing up latency.
+
+Sessions live in the memory of the worker process that created them.
+"""
+import secrets
+import threading
+import time
+
+
+class StreamSession:
+    """
+    One webcam stream: a single-slot frame mailbox plus persistence sampling.
+
+    persist_every=N saves every Nth processed frame; persist_on_change saves
+    a frame whenever the predicted emotion differs from the last saved one.
+    With neither set, nothing is written to the database.
+    """
+
+    def __init__(self, session_id, user_name='Anonymous', persist_every=0, persist_on_change=False):
+        self.session_id = session_id
+        self.user_name = user_name
+        self.persist_every = persist_every
+        self.persist_on_change = persist_on_change
+
+        self._cond = threading.Condition()
+        self._frame = None
+        self.closed = False
+        self.last_seen = time.monotonic()
+        self.last_result = None
+        self._last_saved_emotion = None
+
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        self.persisted = 0
+
+    def push(self, frame: bytes):
+        """Offer a frame, replacing any frame that hasn't been processed yet."""
+        with self._cond:
+            if self._frame is not None:
+                self.dropped += 1
+            self._frame = frame
+            self.received += 1
+            self.last_seen = time.monotonic()
+            self._cond.notify()
+
+    def next_frame(self, timeout=None):
+        """Wait for and take the newest frame; None on timeout or close."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._frame is not None or self.closed, timeout)
+            frame, self._frame = self._frame, None
+            if frame is not None:
+                self.last_seen = time.monotonic()
+            return frame
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._frame = None
+            self._cond.notify_all()
+
+    def record(self, result: dict) -> bool:
+        """Record a processed frame's result; True if it should be persisted."""
+        self.processed += 1
+        self.last_result = result
+        emotion = result.get('emotion')
+        persist = (
+            (self.persist_every and self.processed % self.persist_every == 0)
+            or (self.persist_on_change and emotion != self._last_saved_emotion)
+        )
+        if persist:
+            self._last_saved_emotion = emotion
+            self.persisted += 1
+        return bool(persist)
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'dropped': self.dropped,
+            'processed': self.processed,
+            'persisted': self.persisted,
+            'idle_seconds': round(time.monotonic() - self.last_seen, 1),
+        }
+
+
+class StreamRegistry:
+    """Thread-safe set of open sessions with idle eviction."""
+
+    def __init__(self, max_sessions=100, idle_timeout=60.0):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.evicted = 0
+        self._closed_totals = {'received': 0, 'dropped': 0, 'processed': 0}
+
+    def _retire(self, session):
+        # Called with the lock held once a session leaves the registry
+        for counter in self._closed_totals:
+            self._closed_totals[counter] += getattr(session, counter)
+
+    def create(self, **options) -> StreamSession:
+        """Open a new session; raises RuntimeError when the limit is reached."""
+        self.evict_idle()
+        with self._lock:
+            if len(self._sessions) >= self.max_sessions:
+                raise RuntimeError('Too many open streams')
+            session = StreamSession(secrets.token_urlsafe(16), **options)
+            self._sessions[session.session_id] = session
+            return session
+
+    def get(self, session_id):
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def close(self, session_id) -> bool:
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is not None:
+                self._retire(session)
+        if session is None:
+            return False
+        session.close()
+        return True
+
+    def evict_idle(self) -> int:
+        """Close sessions that haven't sent or consumed a frame recently."""
+        now = time.monotonic()
+        with self._lock:
+            idle = [s for s in self._sessions.values() if now - s.last_seen > self.idle_timeout]
+            for session in idle:
+                del self._sessions[session.session_id]
+                self._retire(session)
+        for session in idle:
+            session.close()
+        self.evicted += len(idle)
+        return len(idle)
+
+    def stats(self):
+        """Session count and frame counters over all sessions, open or closed."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+            totals = dict(self._closed_totals)
+        return {
+            'open': len(sessions),
+            'evicted': self.evicted,
+            **{f'frames_{counter}': total + sum(getattr(s, counter) for s in sessions)
+               for counter, total in totals.items()},
+        }
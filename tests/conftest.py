@@ -0,0 +1,96 @@
+import contextlib
+import io
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+# The app is a set of top-level modules, importable from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def conn(tmp_path):
+    """A fresh database with the full schema."""
+    from db import connect, ensure_schema
+
+    conn = connect(str(tmp_path / 'test.db'))
+    ensure_schema(conn)
+    yield conn
+    conn.close()
+
+
+def prediction_record(image_bytes, user_name='alice', emotion='Happy', source='upload',
+                      timestamp=None, **extra):
+    record = {
+        'user_name': user_name,
+        'image_path': 'test.jpg',
+        'image_bytes': image_bytes,
+        'predicted_emotion': emotion,
+        'confidence': 0.75,
+        'all_probs': {emotion: 0.75},
+        'source': source,
+        'timestamp': timestamp,
+    }
+    record.update(extra)
+    return record
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """app.py imported once, in an empty directory and with small random weights."""
+    from inference import InferenceEngine, export_weights
+
+    workdir = tmp_path_factory.mktemp('app')
+    rng = np.random.default_rng(0)
+    sizes = [48 * 48, 16, 5]
+    engine = InferenceEngine(
+        coefs=[rng.normal(0, 0.05, (a, b)) for a, b in zip(sizes, sizes[1:])],
+        intercepts=[np.zeros(b) for b in sizes[1:]],
+        classes=np.arange(5),
+    )
+    export_weights(engine, str(workdir / 'model_weights'),
+                   labels=['Angry', 'Fear', 'Happy', 'Sad', 'Suprise'])
+
+    with pytest.MonkeyPatch.context() as mp:
+        # The app keeps its database and weights relative to the working directory
+        mp.chdir(workdir)
+        mp.setenv('PREDICTION_CACHE_SIZE', '0')
+        with contextlib.redirect_stdout(io.StringIO()):
+            import app
+        yield app
+        app.writer.close()
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+def make_synthetic_jpeg(width, height, seed=0, quality=90) -> bytes:
+    """A face-like RGB JPEG (smooth background, ellipse, some noise)."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    img = np.empty((height, width, 3), dtype=np.uint8)
+    img[..., 0] = (x * 255 // max(width - 1, 1)).astype(np.uint8)
+    img[..., 1] = (y * 255 // max(height - 1, 1)).astype(np.uint8)
+    img[..., 2] = 128
+
+    center = (width // 2, height // 2)
+    axes = (width // 5, height // 3)
+    cv2.ellipse(img, center, axes, 0, 0, 360, (210, 180, 160), -1)
+    noise = rng.integers(0, 16, size=img.shape, dtype=np.uint8)
+    img = cv2.add(img, noise)
+
+    buffer = io.BytesIO()
+    Image.fromarray(img).save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def unique_jpeg(data: bytes, n: int) -> bytes:
+    """Same pixels, different bytes: a JPEG comment segment after SOI."""
+    comment = f'test-{n}'.encode()
+    return data[:2] + b'\xff\xfe' + (len(comment) + 2).to_bytes(2, 'big') + comment + data[2:]
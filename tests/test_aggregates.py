@@ -0,0 +1,28 @@
+from aggregates import get_summary
+from conftest import make_synthetic_jpeg, prediction_record
+from db import transaction
+from persistence import write_predictions
+from thumbnails import store_thumbnails
+
+
+def test_summary(conn):
+    write_predictions(conn, [
+        prediction_record(b'a' * 10, user_name='alice', emotion='Happy', timestamp='2026-04-01T10:00:00'),
+        prediction_record(b'b' * 20, user_name='bob', emotion='Sad', source='webcam',
+                          timestamp='2026-04-02T10:00:00'),
+        prediction_record(b'a' * 10, user_name='alice', emotion='Happy', timestamp='2026-04-02T11:00:00'),
+    ])
+    with transaction(conn):
+        store_thumbnails(conn, 'thumb', make_synthetic_jpeg(64, 64), [48])
+
+    summary = get_summary(conn)
+    assert summary['total_predictions'] == 3
+    assert summary['average_confidence'] == 0.75
+    assert summary['image_bytes'] == 40
+    # Thumbnails have their own store row and don't count as stored images
+    assert (summary['stored_images'], summary['stored_image_bytes']) == (2, 30)
+    assert summary['total_users'] == 2
+    assert summary['emotions_count'] == {'Happy': 2, 'Sad': 1}
+    assert summary['source_count'] == {'upload': 2, 'webcam': 1}
+    assert summary['daily_counts'] == {'2026-04-02': 2, '2026-04-01': 1}
+    assert summary['top_users'] == [{'name': 'alice', 'predictions': 2}, {'name': 'bob', 'predictions': 1}]
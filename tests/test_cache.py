@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+import cache
+from cache import ByteLRUCache, PredictionCache, content_key, perceptual_key
+from conftest import make_synthetic_jpeg, unique_jpeg
+
+
+def _pixels(seed=0):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:48, 0:48]
+    return np.clip(x * 4 + y * 2 + rng.integers(0, 8, (48, 48)), 0, 255).astype(np.uint8)
+
+
+def test_content_key_depends_only_on_pixels():
+    pixels = _pixels()
+    strided = np.zeros((48, 96), dtype=np.uint8)
+    strided[:, ::2] = pixels
+    assert content_key(pixels) == content_key(pixels.copy()) == content_key(strided[:, ::2])
+
+    changed = pixels.copy()
+    changed[10, 10] ^= 1
+    assert content_key(changed) != content_key(pixels)
+
+
+def test_same_model_input_from_different_files_hits():
+    from preprocessing import prepare_image
+
+    data = make_synthetic_jpeg(320, 240)
+    first, second = prepare_image(data), prepare_image(unique_jpeg(data, 1))
+    prediction_cache = PredictionCache()
+    prediction_cache.put(first.pixels, 2, np.array([0.1, 0.2, 0.7], dtype=np.float32))
+    index, probabilities = prediction_cache.get(second.pixels)
+    assert index == 2
+    np.testing.assert_allclose(probabilities, [0.1, 0.2, 0.7], rtol=1e-6)
+
+
+def test_lru_eviction_and_byte_accounting():
+    prediction_cache = PredictionCache(max_items=2)
+    probabilities = np.zeros(5, dtype=np.float32)
+    for seed in range(3):
+        prediction_cache.put(_pixels(seed), seed, probabilities)
+    assert prediction_cache.get(_pixels(0)) is None
+    assert prediction_cache.get(_pixels(2))[0] == 2
+    stats = prediction_cache.stats()
+    assert stats['items'] == 2
+    assert stats['bytes'] == 2 * (16 + probabilities.nbytes)
+
+
+def test_cached_probabilities_are_copies():
+    prediction_cache = PredictionCache()
+    batch = np.array([[0.5, 0.5], [0.9, 0.1]], dtype=np.float32)
+    prediction_cache.put(_pixels(), 0, batch[0])
+    batch[0] = 0
+    np.testing.assert_array_equal(prediction_cache.get(_pixels())[1], [0.5, 0.5])
+
+
+def test_ttl_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    prediction_cache = PredictionCache(ttl=5)
+    prediction_cache.put(_pixels(), 1, np.ones(2))
+    now[0] += 4
+    assert prediction_cache.get(_pixels()) is not None
+    now[0] += 2
+    assert prediction_cache.get(_pixels()) is None
+    assert prediction_cache.stats()['expired'] == 1
+
+
+def test_perceptual_cache_matches_within_tolerance():
+    pixels = _pixels()
+    noisy = np.clip(pixels.astype(np.int16) + np.random.default_rng(1).integers(-2, 3, pixels.shape), 0, 255)
+    noisy = noisy.astype(np.uint8)
+    distance = (perceptual_key(pixels) ^ perceptual_key(noisy)).bit_count()
+
+    strict = PredictionCache(perceptual=True, tolerance=max(distance - 1, 0))
+    strict.put(pixels, 3, np.ones(2))
+    if distance:
+        assert strict.get(noisy) is None
+
+    tolerant = PredictionCache(perceptual=True, tolerance=distance + 2)
+    tolerant.put(pixels, 3, np.ones(2))
+    assert tolerant.get(noisy)[0] == 3
+    assert tolerant.get(255 - pixels) is None
+
+
+@pytest.mark.parametrize('size', [10, 40])
+def test_byte_lru_cache_bounds(size):
+    byte_cache = ByteLRUCache(max_bytes=100, max_item_bytes=50)
+    for i in range(5):
+        byte_cache.put(i, bytes(size))
+    assert byte_cache.current_bytes <= 100
+    assert byte_cache.get(4) == bytes(size)
+    byte_cache.put('big', bytes(60))
+    assert byte_cache.get('big') is None
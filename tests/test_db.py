@@ -0,0 +1,50 @@
+from conftest import prediction_record
+from db import connect, ensure_schema
+from persistence import write_predictions
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def test_blob_column_is_last(conn):
+    assert _columns(conn, 'images')[-1] == 'data'
+    assert _columns(conn, 'image_variants')[-1] == 'data'
+
+
+def test_old_column_order_is_rebuilt(tmp_path):
+    conn = connect(str(tmp_path / 'old.db'))
+    # Layout written by earlier versions: size and created_at behind the BLOB
+    conn.execute("""
+        CREATE TABLE images (
+            hash TEXT PRIMARY KEY,
+            data BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE image_variants (
+            hash TEXT NOT NULL,
+            max_side INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            PRIMARY KEY (hash, max_side)
+        )
+    """)
+    conn.execute("INSERT INTO images VALUES ('a', x'0102', 2, '2026-01-01T00:00:00')")
+    conn.execute("INSERT INTO image_variants VALUES ('a', 48, x'010203', 3)")
+    ensure_schema(conn)
+    write_predictions(conn, [prediction_record(b'abc')])
+
+    assert _columns(conn, 'images') == ['hash', 'size', 'created_at', 'data']
+    assert _columns(conn, 'image_variants') == ['hash', 'max_side', 'size', 'data']
+    assert conn.execute(
+        "SELECT count, image_bytes FROM prediction_stats WHERE key = 'variants'").fetchone() == (1, 3)
+    assert conn.execute("SELECT data, size FROM images WHERE hash = 'a'").fetchone() == (b'\x01\x02', 2)
+    triggers = {name for (name,) in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'images'")}
+    assert triggers == {'trg_images_stats_insert', 'trg_images_stats_delete'}
+    assert conn.execute(
+        "SELECT count, image_bytes FROM prediction_stats WHERE dimension = 'store'").fetchone() == (2, 5)
+    conn.close()
@@ -0,0 +1,108 @@
+import csv
+import gzip
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import prediction_record
+from db import get_connection
+from exporter import EXPORT_COLUMNS, Export, ExportError
+from persistence import write_predictions
+
+AWKWARD_NAMES = ['plain', 'comma, inside', 'quote " inside', 'new\nline', '=SUM(A1)', 'ünïcode ☺']
+
+
+@pytest.fixture
+def exported(conn):
+    write_predictions(conn, [
+        prediction_record(bytes([i]), user_name=name, timestamp=f'2026-04-01T10:00:0{i}',
+                          face_box=(1, 2, 3, 4) if i % 2 else None)
+        for i, name in enumerate(AWKWARD_NAMES)
+    ])
+    return conn
+
+
+def _export(conn, fmt, **options):
+    return b''.join(Export(conn, fmt, batch_size=2, **options).chunks())
+
+
+def test_csv_quoting_round_trips(exported):
+    rows = list(csv.reader(io.StringIO(_export(exported, 'csv').decode('utf-8'), newline='')))
+    assert rows[0] == EXPORT_COLUMNS
+    assert [row[EXPORT_COLUMNS.index('user_name')] for row in rows[1:]] == AWKWARD_NAMES
+    assert all(len(row) == len(EXPORT_COLUMNS) for row in rows)
+
+
+def test_jsonl_parses_json_columns(exported):
+    lines = _export(exported, 'jsonl').decode('utf-8').splitlines()
+    records = [json.loads(line) for line in lines]
+    assert [record['user_name'] for record in records] == AWKWARD_NAMES
+    assert records[1]['face_box'] == [1, 2, 3, 4]
+    assert records[0]['face_box'] is None
+    assert records[0]['all_probabilities'] == {'Happy': 0.75}
+
+
+def test_gzip_matches_plain(exported):
+    assert gzip.decompress(_export(exported, 'csv', compress=True)) == _export(exported, 'csv')
+
+
+def test_filters_and_last_id(exported):
+    export = Export(exported, 'jsonl', after_id=2, since='2026-04-01T10:00:01', until='2026-04-01T10:00:05')
+    ids = [json.loads(line)['id'] for line in b''.join(export.chunks()).decode().splitlines()]
+    assert ids == [3, 4, 5]
+    assert export.rows == 3
+    # The highest id below until, not the newest row in the table
+    assert export.last_id == 5
+
+    # Nothing newer: last_id stays where the caller was
+    empty = Export(exported, 'csv', after_id=6)
+    assert b''.join(empty.chunks()).decode().strip() == ','.join(EXPORT_COLUMNS)
+    assert empty.last_id == 6
+
+
+def test_parquet_and_arrow(exported):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(io.BytesIO(_export(exported, 'parquet')))
+    assert table.column('user_name').to_pylist() == AWKWARD_NAMES
+    stream = pa.ipc.open_stream(io.BytesIO(_export(exported, 'arrow'))).read_all()
+    assert stream.column('id').to_pylist() == list(range(1, 7))
+
+
+@pytest.mark.parametrize('options', [
+    {'fmt': 'xml'},
+    {'fmt': 'parquet', 'compress': True},
+    {'since': 'yesterday'},
+    {'after_id': 'ten'},
+])
+def test_invalid_options(exported, options):
+    with pytest.raises(ExportError):
+        Export(exported, **options)
+
+
+def _ids(response, user_name):
+    return [row['id'] for row in map(json.loads, response.get_data(as_text=True).splitlines())
+            if row['user_name'] == user_name]
+
+
+def test_export_stops_at_settled_cutoff(app_module, client):
+    now = datetime.utcnow()
+    settled, recent = write_predictions(get_connection(app_module.DB_FILE), [
+        prediction_record(b'settled', user_name='exporter', timestamp=(now - timedelta(minutes=5)).isoformat()),
+        prediction_record(b'recent', user_name='exporter', timestamp=now.isoformat()),
+    ])
+
+    response = client.get('/export?format=jsonl')
+    assert response.status_code == 200
+    assert _ids(response, 'exporter') == [settled]
+    assert int(response.headers['X-Export-Last-Id']) == settled
+    until = response.headers['X-Export-Until']
+    assert until < now.isoformat()
+
+    # The next export starts at the cutoff and picks up the recent row
+    newer = client.get('/export', query_string={
+        'format': 'jsonl', 'since': until, 'until': (now + timedelta(seconds=1)).isoformat()})
+    assert _ids(newer, 'exporter') == [recent]
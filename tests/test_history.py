@@ -0,0 +1,67 @@
+import pytest
+
+from conftest import prediction_record
+from history import HistoryQueryError, decode_cursor, encode_cursor, query_history
+from persistence import write_predictions
+
+
+@pytest.fixture
+def history(conn):
+    records = []
+    for i in range(25):
+        # Repeated timestamps: the id must break ties between pages
+        records.append(prediction_record(bytes([i]), user_name='alice' if i % 2 else 'bob',
+                                         emotion='Happy' if i % 3 else 'Sad',
+                                         timestamp=f'2026-03-{i // 4 + 1:02d}T10:00:00'))
+    write_predictions(conn, records)
+    return conn
+
+
+def _all_pages(conn, limit, **filters):
+    rows, cursor, pages = [], None, 0
+    while True:
+        page, cursor = query_history(conn, limit=limit, cursor=cursor, **filters)
+        rows.extend(page)
+        pages += 1
+        if cursor is None:
+            return rows, pages
+
+
+def test_pages_cover_every_row_once_in_order(history):
+    rows, pages = _all_pages(history, limit=4)
+    assert pages == 7
+    keys = [(row['timestamp'], row['id']) for row in rows]
+    assert keys == sorted(keys, reverse=True)
+    assert len(set(keys)) == 25
+
+
+def test_filters_apply_across_pages(history):
+    rows, _ = _all_pages(history, limit=3, user='alice', emotion='Happy', since='2026-03-02', until='2026-03-06')
+    expected = history.execute("""
+        SELECT id FROM predictions
+        WHERE user_name = 'alice' AND predicted_emotion = 'Happy'
+          AND timestamp >= '2026-03-02' AND timestamp < '2026-03-06'
+        ORDER BY timestamp DESC, id DESC
+    """).fetchall()
+    assert [row['id'] for row in rows] == [row[0] for row in expected]
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor('2026-03-01T10:00:00', 42)
+    assert '=' not in cursor
+    assert decode_cursor(cursor) == ('2026-03-01T10:00:00', 42)
+
+
+@pytest.mark.parametrize('cursor', ['not-a-cursor', encode_cursor('x', 1)[:-2], 'WzEsMl0'])
+def test_invalid_cursor(history, cursor):
+    with pytest.raises(HistoryQueryError):
+        query_history(history, cursor=cursor)
+
+
+def test_invalid_limit_and_confidence(history):
+    with pytest.raises(HistoryQueryError):
+        query_history(history, limit='ten')
+    with pytest.raises(HistoryQueryError):
+        query_history(history, min_confidence='high')
+    rows, _ = query_history(history, limit=10_000)
+    assert len(rows) == 25
@@ -0,0 +1,47 @@
+import io
+
+import pytest
+
+from conftest import make_synthetic_jpeg, unique_jpeg
+
+
+@pytest.fixture
+def image_id(app_module, client):
+    data = unique_jpeg(make_synthetic_jpeg(64, 64), 1)
+    response = client.post('/predict', data={'image': (io.BytesIO(data), 'face.jpg'), 'name': 'alice'})
+    assert response.status_code == 200
+    app_module.writer.flush()
+    return response.get_json()['prediction_id']
+
+
+def test_if_none_match_returns_304(client, image_id):
+    response = client.get(f'/image/{image_id}')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+
+    cached = client.get(f'/image/{image_id}', headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+    assert cached.data == b''
+
+
+def test_single_range(client, image_id):
+    full = client.get(f'/image/{image_id}').data
+    response = client.get(f'/image/{image_id}', headers={'Range': 'bytes=2-9'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 2-9/{len(full)}'
+    assert response.data == full[2:10]
+
+
+def test_unsatisfiable_range_is_416(client, image_id):
+    full = client.get(f'/image/{image_id}').data
+    response = client.get(f'/image/{image_id}', headers={'Range': f'bytes={len(full) + 10}-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(full)}'
+
+
+def test_multiple_ranges_are_ignored(client, image_id):
+    full = client.get(f'/image/{image_id}').data
+    response = client.get(f'/image/{image_id}', headers={'Range': 'bytes=0-1,4-5'})
+    assert response.status_code == 200
+    assert 'Content-Range' not in response.headers
+    assert response.data == full
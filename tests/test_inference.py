@@ -0,0 +1,87 @@
+import warnings
+
+import numpy as np
+import pytest
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.neural_network import MLPClassifier
+
+from inference import InferenceEngine, export_weights, load_weights, verify_against_sklearn
+
+
+def _fit(classes=5, features=64, hidden=(32, 16), activation='relu', seed=0):
+    """A small MLP on separable clusters, so predictions have real margins."""
+    rng = np.random.default_rng(seed)
+    centers = rng.random((classes, features))
+    y = np.arange(400) % classes
+    X = np.clip(centers[y] + rng.normal(0, 0.15, (len(y), features)), 0, 1)
+    model = MLPClassifier(hidden_layer_sizes=hidden, activation=activation, max_iter=200, random_state=seed)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', ConvergenceWarning)
+        model.fit(X, y)
+    return model, X
+
+
+@pytest.mark.parametrize('activation', ['relu', 'logistic', 'tanh', 'identity'])
+def test_float64_matches_sklearn(activation):
+    model, X = _fit(activation=activation)
+    engine = InferenceEngine.from_sklearn(model, dtype=np.float64)
+    np.testing.assert_allclose(engine.predict_proba(X), model.predict_proba(X), rtol=0, atol=1e-12)
+    indices, _ = engine.predict(X)
+    assert np.array_equal(engine.classes[indices], model.predict(X))
+
+
+def test_float32_matches_sklearn():
+    model, X = _fit()
+    engine = InferenceEngine.from_sklearn(model)
+    np.testing.assert_allclose(engine.predict_proba(X), model.predict_proba(X), rtol=0, atol=1e-4)
+    assert verify_against_sklearn(model, engine)['passed']
+
+
+def test_binary_model_returns_both_columns():
+    model, X = _fit(classes=2)
+    engine = InferenceEngine.from_sklearn(model, dtype=np.float64)
+    probabilities = engine.predict_proba(X)
+    assert probabilities.shape == (len(X), 2)
+    np.testing.assert_allclose(probabilities, model.predict_proba(X), rtol=0, atol=1e-12)
+
+
+def test_int8_agrees_with_sklearn_argmax():
+    model, X = _fit()
+    engine = InferenceEngine.from_sklearn(model).with_precision('int8')
+    assert engine.precision == 'int8'
+    indices, probabilities = engine.predict(X)
+    agreement = np.mean(engine.classes[indices] == model.predict(X))
+    assert agreement >= 0.98
+    assert np.abs(probabilities - model.predict_proba(X)).max() < 0.05
+    np.testing.assert_allclose(probabilities.sum(axis=1), 1, atol=1e-5)
+
+
+def test_single_row_input():
+    model, X = _fit()
+    engine = InferenceEngine.from_sklearn(model)
+    indices, probabilities = engine.predict(X[0])
+    assert probabilities.shape == (1, len(model.classes_))
+    assert engine.classes[indices[0]] == model.predict(X[:1])[0]
+
+
+def test_export_round_trip(tmp_path):
+    model, X = _fit()
+    source = tmp_path / 'model.pkl'
+    source.write_bytes(b'pickle')
+    export_weights(InferenceEngine.from_sklearn(model), str(tmp_path / 'weights'),
+                   labels=['a', 'b', 'c', 'd', 'e'], source_path=str(source))
+
+    engine, meta = load_weights(str(tmp_path / 'weights'))
+    assert not engine.coefs[0].flags.writeable  # Read-only views of the mapped files
+    assert meta['labels'] == ['a', 'b', 'c', 'd', 'e']
+    assert meta['source_sha256'] is not None
+    np.testing.assert_allclose(engine.predict_proba(X), model.predict_proba(X), rtol=0, atol=1e-4)
+
+    # float64 on float32-rounded weights still agrees on every label
+    indices, _ = engine.with_precision('float64').predict(X)
+    assert np.array_equal(engine.classes[indices], model.predict(X))
+
+
+def test_load_without_export(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        load_weights(str(tmp_path))
@@ -0,0 +1,65 @@
+import logging
+import sqlite3
+
+import pytest
+
+import persistence
+from conftest import prediction_record
+from persistence import PredictionWriter
+
+
+@pytest.fixture
+def writer(conn, tmp_path, monkeypatch):
+    monkeypatch.setattr(persistence, 'RETRY_DELAY', 0.001)
+    writer = PredictionWriter(str(tmp_path / 'test.db'), flush_interval=0.2)
+    yield writer
+    writer.close()
+
+
+def _stored_ids(conn):
+    return [row[0] for row in conn.execute("SELECT id FROM predictions ORDER BY id")]
+
+
+def test_ids_are_final_and_rows_land(conn, writer):
+    ids = writer.submit([prediction_record(bytes([i])) for i in range(5)])
+    assert writer.pending_image(ids[0]) == (bytes([0]), 'jpeg')
+    writer.flush()
+    assert _stored_ids(conn) == ids
+    assert writer.pending_image(ids[0]) is None
+    assert writer.stats()['written'] == 5
+
+
+def test_transient_errors_are_retried(conn, writer, monkeypatch):
+    write = writer._write
+    failures = [2]
+
+    def flaky(records):
+        if failures[0]:
+            failures[0] -= 1
+            raise sqlite3.OperationalError('database is locked')
+        return write(records)
+
+    monkeypatch.setattr(writer, '_write', flaky)
+    ids = writer.submit([prediction_record(b'a'), prediction_record(b'b')])
+    writer.flush()
+    assert _stored_ids(conn) == ids
+    assert writer.stats()['retried'] == 2
+    assert writer.stats()['failed'] == 0
+
+
+def test_bad_row_only_drops_itself(conn, writer, caplog):
+    upload = {'face_count': 2}
+    records = [
+        prediction_record(b'a'),
+        prediction_record(b'faces', upload=upload),
+        prediction_record(b'faces', upload=upload),
+        prediction_record(b'bad', confidence=None),  # NOT NULL violation
+        prediction_record(b'c'),
+    ]
+    with caplog.at_level(logging.WARNING, logger='persistence'):
+        ids = writer.submit(records)
+        writer.flush()
+    assert _stored_ids(conn) == [ids[0], ids[1], ids[2], ids[4]]
+    assert writer.stats()['failed'] == 1
+    assert f'Dropped predictions {ids[3]}' in caplog.text
+    assert conn.execute("SELECT face_count FROM uploads WHERE id = ?", (upload['id'],)).fetchone() == (2,)
@@ -0,0 +1,28 @@
+import base64
+
+from conftest import make_synthetic_jpeg, unique_jpeg
+
+
+def _frames(count):
+    data = make_synthetic_jpeg(64, 64)
+    return [base64.b64encode(unique_jpeg(data, n)).decode() for n in range(count)]
+
+
+def test_bare_array_body(app_module, client):
+    frames = _frames(2)
+    response = client.post('/predict_batch', json=frames + ['aGVsbG8='])
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    assert [('error' in result) for result in results] == [False, False, True]
+    app_module.writer.flush()
+
+
+def test_object_body_and_invalid_bodies(app_module, client):
+    response = client.post('/predict_batch', json={'images': _frames(1), 'name': 'bob'})
+    assert response.status_code == 200
+    assert 'error' not in response.get_json()['results'][0]
+    app_module.writer.flush()
+
+    for body in ({}, {'images': 'aGVsbG8='}, 'aGVsbG8=', 3):
+        assert client.post('/predict_batch', json=body).status_code == 400
+    assert client.post('/predict_batch', data='[', content_type='application/json').status_code == 400
@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from aggregates import rebuild_statistics
+from conftest import prediction_record
+from db import transaction
+from image_archive import read_archived_image, reindex_archive
+from persistence import write_predictions
+from retention import RetentionPolicy, run_retention
+
+
+def _stats(conn):
+    return sorted(conn.execute(
+        "SELECT dimension, key, count, confidence_sum, image_bytes FROM prediction_stats WHERE count != 0"
+    ).fetchall())
+
+
+def _assert_matches_rebuild(conn):
+    incremental = _stats(conn)
+    rebuild_statistics(conn)
+    assert incremental == _stats(conn)
+
+
+def _fill(conn, images=6):
+    records = []
+    for i in range(images):
+        data = bytes([i]) * (1000 + i)
+        # Two predictions share each image, with different dimensions
+        records.append(prediction_record(data, emotion='Happy', source='upload',
+                                         timestamp=f'2026-01-0{i % 3 + 1}T12:00:00'))
+        records.append(prediction_record(data, emotion='Sad', source='webcam',
+                                         timestamp=f'2026-02-0{i % 3 + 1}T12:00:00'))
+    write_predictions(conn, records)
+    # Half the images are old enough for a 30-day policy
+    old = (datetime.utcnow() - timedelta(days=90)).isoformat()
+    with transaction(conn):
+        conn.execute("UPDATE images SET created_at = ? WHERE size < 1003", (old,))
+
+
+@pytest.mark.parametrize('action', ['archive', 'delete'])
+def test_statistics_follow_retention(conn, tmp_path, action):
+    _fill(conn)
+    result = run_retention(conn, RetentionPolicy(30, None, action), str(tmp_path / 'archive'), vacuum=False)
+    assert result['images'] == 3
+    assert conn.execute("SELECT COUNT(*) FROM images").fetchone()[0] == 3
+    _assert_matches_rebuild(conn)
+
+    # Removing a prediction whose image is gone must not subtract its size again
+    with transaction(conn):
+        conn.execute("DELETE FROM predictions WHERE id IN (1, 12)")
+    _assert_matches_rebuild(conn)
+
+
+def test_statistics_follow_reupload_after_delete(conn, tmp_path):
+    _fill(conn)
+    run_retention(conn, RetentionPolicy(30, None, 'delete'), str(tmp_path / 'archive'), vacuum=False)
+    # The same bytes come back: earlier predictions count them again
+    write_predictions(conn, [prediction_record(bytes([0]) * 1000)])
+    _assert_matches_rebuild(conn)
+
+
+def test_max_bytes_moves_oldest_first(conn, tmp_path):
+    _fill(conn)
+    total = conn.execute("SELECT SUM(size) FROM images").fetchone()[0]
+    run_retention(conn, RetentionPolicy(None, total - 2000, 'delete'), str(tmp_path / 'archive'), vacuum=False)
+    assert conn.execute("SELECT SUM(size) FROM images").fetchone()[0] <= total - 2000
+    # The three old images went first
+    assert conn.execute("SELECT MIN(size) FROM images").fetchone()[0] >= 1002
+
+
+def test_archive_reindex_restores_index(conn, tmp_path):
+    _fill(conn)
+    archive_dir = str(tmp_path / 'archive')
+    run_retention(conn, RetentionPolicy(30, None, 'archive'), archive_dir, vacuum=False)
+    archived = conn.execute("SELECT hash, size FROM image_archive ORDER BY hash").fetchall()
+    assert len(archived) == 3
+
+    with transaction(conn):
+        conn.execute("DELETE FROM image_archive")
+    assert reindex_archive(conn, archive_dir) == 3
+    assert conn.execute("SELECT hash, size FROM image_archive ORDER BY hash").fetchall() == archived
+    for key, size in archived:
+        assert len(read_archived_image(conn, key, archive_dir)) == size
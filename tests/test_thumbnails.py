@@ -0,0 +1,43 @@
+from conftest import make_synthetic_jpeg, unique_jpeg
+from db import transaction
+from thumbnails import evict_thumbnails, store_thumbnails, stored_thumbnail_bytes
+
+
+def _table_bytes(conn):
+    return conn.execute("SELECT COALESCE(SUM(size), 0) FROM image_variants").fetchone()[0]
+
+
+def _store(conn, n, sizes=(48, 96), budget=10**9):
+    with transaction(conn):
+        return store_thumbnails(conn, f'key-{n}', unique_jpeg(make_synthetic_jpeg(320, 240, seed=n), n),
+                                sizes, budget=budget)
+
+
+def test_counter_follows_inserts_and_deletes(conn):
+    for n in range(3):
+        _store(conn, n)
+    _store(conn, 0)  # Already stored: kept, not counted twice
+    assert stored_thumbnail_bytes(conn) == _table_bytes(conn) > 0
+    assert conn.execute("SELECT COUNT(*) FROM image_variants").fetchone()[0] == 6
+
+    with transaction(conn):
+        conn.execute("DELETE FROM image_variants WHERE hash = 'key-1'")
+    assert stored_thumbnail_bytes(conn) == _table_bytes(conn)
+
+
+def test_eviction_removes_oldest_down_to_budget(conn):
+    for n in range(6):
+        _store(conn, n)
+    total = _table_bytes(conn)
+    budget = total // 2
+
+    with transaction(conn):
+        evicted = evict_thumbnails(conn, budget)
+    assert evicted > 0
+    assert stored_thumbnail_bytes(conn) == _table_bytes(conn) <= budget * 0.9
+    remaining = {key for (key,) in conn.execute("SELECT DISTINCT hash FROM image_variants")}
+    assert 'key-5' in remaining and 'key-0' not in remaining
+
+    # Within budget: nothing to do
+    with transaction(conn):
+        assert evict_thumbnails(conn, budget) == 0
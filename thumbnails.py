@@ -0,0 +1,116 @@
+"""
+thumbnails.py
+
+On-demand thumbnails for stored prediction images.
+
+A thumbnail is generated the first time a size is requested and kept in the
+image_variants table, keyed by the source image hash and size. The table has
+a byte budget; once it's exceeded the oldest thumbnails are evicted. Its
+byte total is kept by triggers in prediction_stats (see aggregates.py), so
+checking the budget is a primary-key lookup rather than a table scan.
+"""
+import sqlite3
+
+import cv2
+
+from db import transaction
+from preprocessing import decode_grayscale, encode_jpeg
+
+THUMBNAIL_SIZES = (48, 96, 128, 256)  # Allowed longest-side sizes, in pixels
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_STORE_BYTES = 64 * 1024 * 1024  # Budget for the image_variants table
+
+
+def snap_size(requested: int) -> int:
+    """Round a requested size up to the nearest allowed thumbnail size."""
+    for size in THUMBNAIL_SIZES:
+        if requested <= size:
+            return size
+    return THUMBNAIL_SIZES[-1]
+
+
+def make_thumbnail(data: bytes, max_side: int) -> bytes:
+    """Downscale image bytes so the longest side is at most max_side."""
+    # The JPEG decoder does most of the shrinking (DCT scaling) for us
+    gray = decode_grayscale(data, max_side=max_side)
+    height, width = gray.shape[:2]
+    scale = max_side / max(height, width)
+    if scale < 1:
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        gray = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+    return encode_jpeg(gray, quality=THUMBNAIL_QUALITY)
+
+
+def get_thumbnail(conn: sqlite3.Connection, key: str, max_side: int):
+    """Return a stored thumbnail, or None."""
+    row = conn.execute("""
+        SELECT data FROM image_variants WHERE hash = ? AND max_side = ?
+    """, (key, max_side)).fetchone()
+    return row[0] if row else None
+
+
+def store_thumbnails(conn: sqlite3.Connection, key: str, data: bytes, sizes,
+                     budget=THUMBNAIL_STORE_BYTES) -> dict:
+    """
+    Generate and store thumbnails of data for each size.
+
+    Must be called inside a transaction. Returns {size: thumbnail bytes}.
+    """
+    thumbnails = {}
+    for max_side in sizes:
+        thumbnail = make_thumbnail(data, max_side)
+        # Same image and size, same thumbnail: a row stored concurrently is
+        # kept (REPLACE would also bypass the byte-total triggers)
+        conn.execute("""
+            INSERT OR IGNORE INTO image_variants (hash, max_side, size, data)
+            VALUES (?, ?, ?, ?)
+        """, (key, max_side, len(thumbnail), thumbnail))
+        thumbnails[max_side] = thumbnail
+    evict_thumbnails(conn, budget)
+    return thumbnails
+
+
+def stored_thumbnail_bytes(conn: sqlite3.Connection) -> int:
+    """Total size of the image_variants table, from its trigger-kept counter."""
+    row = conn.execute("""
+        SELECT image_bytes FROM prediction_stats WHERE dimension = 'store' AND key = 'variants'
+    """).fetchone()
+    return row[0] if row else 0
+
+
+def evict_thumbnails(conn: sqlite3.Connection, budget=THUMBNAIL_STORE_BYTES) -> int:
+    """Delete the oldest thumbnails until the table fits its budget."""
+    total = stored_thumbnail_bytes(conn)
+    if total <= budget:
+        return 0
+
+    # Evict down to 90% of the budget so this doesn't run on every insert
+    excess = total - int(budget * 0.9)
+    evicted, last_rowid = 0, None
+    cursor = conn.execute("SELECT rowid, size FROM image_variants ORDER BY rowid")
+    for rowid, size in cursor:
+        if excess <= 0:
+            break
+        excess -= size
+        evicted += 1
+        last_rowid = rowid
+    cursor.close()
+    if last_rowid is not None:
+        conn.execute("DELETE FROM image_variants WHERE rowid <= ?", (last_rowid,))
+    return evicted
+
+
+def get_or_create_thumbnail(conn: sqlite3.Connection, key: str, max_side: int, load_source):
+    """
+    Return the thumbnail for key at max_side, generating it on first use.
+
+    load_source() is only called on a miss and must return the original
+    image bytes.
+    """
+    thumbnail = get_thumbnail(conn, key, max_side)
+    if thumbnail is not None:
+        return thumbnail
+
+    data = load_source()
+    with transaction(conn):
+        return store_thumbnails(conn, key, data, [max_side])[max_side]